@@ -0,0 +1,368 @@
+import argparse
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from itertools import product
+from time import perf_counter, sleep
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from packet_corpus import (
+    get_corpus_path, get_dictionary_path, open_corpus
+)
+from send_packets import CONSUMER_ADDRESS, PROTOCOLS
+
+CLIENT_PATH = os.path.dirname(os.path.abspath(__file__))
+CONSUMER_PATH = os.path.join(CLIENT_PATH, '..', 'consumer')
+FAKE_INFLUXDB_PATH = os.path.join(CLIENT_PATH, 'fake_influxdb.py')
+PACKETS_PATH = os.getenv('PACKETS_PATH', 'test_data/packets')
+PROTOCOL = os.getenv('PROTOCOL', 'udp')
+
+BENCHMARK_FORMATS = os.getenv('BENCHMARK_FORMATS', 'msgpack,json,binary')
+# packets per second the consumer is loaded with, one run per rate
+BENCHMARK_RATES = os.getenv('BENCHMARK_RATES', '1000,5000,20000')
+BENCHMARK_DURATION = float(os.getenv('BENCHMARK_DURATION', 6))
+# short enough to get a few flushes within a run
+BENCHMARK_STORE_INTERVAL = os.getenv('BENCHMARK_STORE_INTERVAL', '2')
+METRICS_PORT = int(os.getenv('BENCHMARK_METRICS_PORT', 9400))
+INFLUXDB_PORT = int(os.getenv('BENCHMARK_INFLUXDB_PORT', 18086))
+# receiving is over after this long without progress
+SETTLE_TIME = float(os.getenv('SETTLE_TIME', 1))
+RESULTS_PATH = os.getenv('BENCHMARK_RESULTS_PATH', 'benchmark_results')
+# relative change of a value which is reported as a regression
+REGRESSION_THRESHOLD = float(os.getenv('REGRESSION_THRESHOLD', 0.05))
+# differences of loss rates are absolute
+LOSS_THRESHOLD = float(os.getenv('LOSS_THRESHOLD', 0.01))
+# flushes and stalls of the loop take a fraction of a millisecond,
+# smaller changes are noise
+FLUSH_THRESHOLD = float(os.getenv('FLUSH_THRESHOLD', 0.001))
+# often enough to catch short stalls of the loop
+BENCHMARK_LOOP_LAG_INTERVAL = os.getenv('BENCHMARK_LOOP_LAG_INTERVAL',
+                                        '0.01')
+SEND_TICK = 0.001
+
+SAMPLE = re.compile(r'^(\S+) (\S+)$', re.MULTILINE)
+CONFIGURATION_KEYS = ('data_format', 'save_raw_data', 'collect_stats',
+                      'rate')
+# whether a bigger value is better
+RESULT_KEYS = {
+    'pps': True,
+    'loss': False,
+    'cpu': False,
+    'rss_mib': False,
+    'flush_seconds': False,
+    'flush_p95_seconds': False,
+    'loop_lag_p99_seconds': False,
+    'loop_lag_max_seconds': False,
+}
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=CLIENT_PATH,
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def scrape_metrics():
+    url = f'http://127.0.0.1:{METRICS_PORT}/metrics'
+    with urlopen(url, timeout=1) as response:
+        body = response.read().decode()
+    return {name: float(value) for name, value in SAMPLE.findall(body)}
+
+
+def get_cpu_seconds(pid):
+    with open(f'/proc/{pid}/stat') as stat_file:
+        # the command name may contain spaces, fields follow the bracket
+        fields = stat_file.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def get_peak_rss(pid):
+    with open(f'/proc/{pid}/status') as status_file:
+        for line in status_file:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def get_quantile(samples, name, fraction, labels=None):
+    # the upper bound of the bucket holding the quantile
+    if labels:
+        count = samples.get(f'{name}_count{{{labels}}}', 0)
+        prefix = f'{name}_bucket{{{labels},le="'
+    else:
+        count = samples.get(f'{name}_count', 0)
+        prefix = f'{name}_bucket{{le="'
+    if not count:
+        return None
+
+    buckets = sorted(
+        (float(series[len(prefix):-2]), value)
+        for series, value in samples.items() if series.startswith(prefix)
+    )
+    return next(bound for bound, cumulative in buckets
+                if cumulative >= fraction * count)
+
+
+def get_flush_seconds(samples, collector):
+    # the mean and the 95th percentile
+    name = 'consumer_flush_seconds'
+    labels = f'collector="{collector}"'
+    count = samples.get(f'{name}_count{{{labels}}}', 0)
+    if not count:
+        return None, None
+
+    mean = samples[f'{name}_sum{{{labels}}}'] / count
+    return mean, get_quantile(samples, name, 0.95, labels)
+
+
+def wait_for_metrics(process):
+    while True:
+        try:
+            return scrape_metrics()
+        except (URLError, OSError):
+            if process.poll() is not None:
+                raise RuntimeError('The consumer has failed to start')
+            sleep(0.05)
+
+
+def send_paced(packets, rate, duration):
+    # open loop: packets due by now are sent every tick,
+    # no matter how fast the consumer takes them
+    protocol = PROTOCOLS[PROTOCOL]()
+    send = protocol.send
+    count = len(packets)
+    sent = 0
+    start_time = perf_counter()
+    try:
+        while True:
+            elapsed = perf_counter() - start_time
+            if elapsed >= duration:
+                break
+            for _ in range(int(elapsed * rate) - sent):
+                send(packets[sent % count], CONSUMER_ADDRESS)
+                sent += 1
+            sleep(SEND_TICK)
+    finally:
+        protocol.stop()
+    return sent, perf_counter() - start_time
+
+
+def wait_for_packets(count):
+    last_received = 0
+    last_progress_time = perf_counter()
+    while True:
+        samples = scrape_metrics()
+        received = samples.get('consumer_received_packets_total', 0)
+        if received >= count:
+            return samples
+
+        current_time = perf_counter()
+        if received != last_received:
+            last_received = received
+            last_progress_time = current_time
+        elif current_time - last_progress_time >= SETTLE_TIME:
+            return samples
+        sleep(0.01)
+
+
+def run_case(configuration, packets, raw_data_path):
+    env = dict(
+        os.environ,
+        DATA_FORMAT=configuration['data_format'],
+        SAVE_RAW_DATA=configuration['save_raw_data'],
+        COLLECT_STATS=configuration['collect_stats'],
+        RAW_DATA_PATH=raw_data_path,
+        STORE_INTERVAL=BENCHMARK_STORE_INTERVAL,
+        LOOP_LAG_INTERVAL=BENCHMARK_LOOP_LAG_INTERVAL,
+        INFLUXDB_PORT=str(INFLUXDB_PORT),
+        PROTOCOL=PROTOCOL, WORKERS='1', METRICS='1',
+        METRICS_PORT=str(METRICS_PORT),
+        BINARY_DICTIONARY_PATH=os.path.abspath(
+            get_dictionary_path(PACKETS_PATH)
+        ),
+    )
+    process = subprocess.Popen([sys.executable, 'consumer.py'],
+                               cwd=CONSUMER_PATH, env=env,
+                               stderr=subprocess.DEVNULL)
+    try:
+        wait_for_metrics(process)
+        cpu_start = get_cpu_seconds(process.pid)
+        sent, duration = send_paced(packets, configuration['rate'],
+                                    BENCHMARK_DURATION)
+        samples = wait_for_packets(sent)
+        cpu = (get_cpu_seconds(process.pid) - cpu_start) / duration
+        rss = get_peak_rss(process.pid)
+    finally:
+        process.send_signal(signal.SIGINT)
+        process.wait()
+
+    received = samples.get('consumer_received_packets_total', 0)
+    collector = 'stats' if configuration['collect_stats'] == '1' else 'raw'
+    flush_seconds, flush_p95_seconds = get_flush_seconds(samples, collector)
+    return dict(
+        configuration,
+        sent=sent,
+        received=int(received),
+        pps=received / duration,
+        loss=1 - received / sent if sent else 0,
+        cpu=cpu,
+        rss_mib=rss,
+        flush_seconds=flush_seconds,
+        flush_p95_seconds=flush_p95_seconds,
+        # stalls of the loop, flushes included
+        loop_lag_p99_seconds=get_quantile(
+            samples, 'consumer_loop_lag_seconds', 0.99
+        ),
+        loop_lag_max_seconds=get_quantile(
+            samples, 'consumer_loop_lag_seconds', 1
+        ),
+    )
+
+
+def format_result(result):
+    flush = ('-' if result['flush_seconds'] is None
+             else f'{result["flush_seconds"] * 1000:.01f} ms')
+    loop_lag = ('-' if result.get('loop_lag_max_seconds') is None
+                else f'{result["loop_lag_p99_seconds"] * 1000:.01f} ms p99, '
+                     f'{result["loop_lag_max_seconds"] * 1000:.01f} ms max')
+    return (f'{result["pps"]:.02f} pps, {result["loss"] * 100:.02f}% lost, '
+            f'{result["cpu"] * 100:.01f}% cpu, {result["rss_mib"]:.01f} MiB, '
+            f'flush: {flush}, loop lag: {loop_lag}')
+
+
+def format_configuration(result):
+    return (f'[{result["data_format"]}, raw: {result["save_raw_data"]}, '
+            f'stats: {result["collect_stats"]}, {result["rate"]} pps]')
+
+
+def run(output_path):
+    fake_influxdb = subprocess.Popen(
+        [sys.executable, FAKE_INFLUXDB_PATH],
+        env=dict(os.environ, FAKE_INFLUXDB_PORT=str(INFLUXDB_PORT)),
+        stdout=subprocess.DEVNULL
+    )
+    results = []
+    try:
+        for data_format in BENCHMARK_FORMATS.split(','):
+            if not os.path.exists(get_corpus_path(PACKETS_PATH,
+                                                  data_format)):
+                print(f'There are no {data_format} packets in '
+                      f'{PACKETS_PATH}, skipped')
+                continue
+            packets = open_corpus(PACKETS_PATH, data_format)
+
+            cases = product(('0', '1'), ('0', '1'),
+                            map(int, BENCHMARK_RATES.split(',')))
+            for save_raw_data, collect_stats, rate in cases:
+                configuration = dict(data_format=data_format,
+                                     save_raw_data=save_raw_data,
+                                     collect_stats=collect_stats, rate=rate)
+                with tempfile.TemporaryDirectory() as raw_data_path:
+                    result = run_case(configuration, packets, raw_data_path)
+                print(format_configuration(result), format_result(result),
+                      flush=True)
+                results.append(result)
+    finally:
+        fake_influxdb.terminate()
+        fake_influxdb.wait()
+
+    commit = get_commit()
+    if output_path is None:
+        os.makedirs(RESULTS_PATH, exist_ok=True)
+        output_path = os.path.join(RESULTS_PATH, f'{commit}.json')
+    with open(output_path, 'w') as output_file:
+        json.dump({
+            'commit': commit,
+            'time': datetime.utcnow().isoformat(),
+            'protocol': PROTOCOL,
+            'duration': BENCHMARK_DURATION,
+            'results': results,
+        }, output_file, indent=2)
+    print(f'Results have been written to {output_path}')
+
+
+def is_regression(key, base, current):
+    if base is None or current is None:
+        return False
+    if key == 'loss':
+        return current - base > LOSS_THRESHOLD
+    if (key.startswith(('flush', 'loop_lag')) and
+            current - base <= FLUSH_THRESHOLD):
+        return False
+    change = (current - base) / base if base else 0
+    if RESULT_KEYS[key]:
+        return change < -REGRESSION_THRESHOLD
+    return change > REGRESSION_THRESHOLD
+
+
+def compare(base_path, current_path):
+    # returns the count of regressions
+    with open(base_path) as base_file:
+        base = json.load(base_file)
+    with open(current_path) as current_file:
+        current = json.load(current_file)
+
+    def get_key(result):
+        return tuple(result[key] for key in CONFIGURATION_KEYS)
+
+    base_results = {get_key(result): result for result in base['results']}
+    regressions = 0
+    print(f'{base["commit"]} -> {current["commit"]}')
+    for result in current['results']:
+        base_result = base_results.get(get_key(result))
+        if base_result is None:
+            continue
+
+        changes = []
+        for key in RESULT_KEYS:
+            # results of older versions may lack the newer keys
+            old, new = base_result.get(key), result.get(key)
+            if old is None or new is None:
+                continue
+            flag = ''
+            if is_regression(key, old, new):
+                flag = ' REGRESSION'
+                regressions += 1
+            changes.append(f'{key}: {old:.04g} -> {new:.04g}{flag}')
+        print(format_configuration(result), ', '.join(changes))
+
+    print(f'{regressions} regressions were found')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='End-to-end throughput benchmark of the consumer'
+    )
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser(
+        'run', help='benchmark the consumer of the current tree'
+    )
+    run_parser.add_argument('--output', '-o',
+                            help='results file, named by the commit '
+                                 'by default')
+    compare_parser = subparsers.add_parser(
+        'compare', help='flag regressions between two results files'
+    )
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('current')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args.output)
+    elif compare(args.base, args.current):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
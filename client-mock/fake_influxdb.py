@@ -0,0 +1,121 @@
+import asyncio
+import os
+import random
+import signal
+import sys
+from os import getenv
+from time import time
+
+
+LISTEN_IP = getenv('FAKE_INFLUXDB_IP', '127.0.0.1')
+LISTEN_PORT = int(getenv('FAKE_INFLUXDB_PORT', 8086))
+LATENCY = float(getenv('FAKE_INFLUXDB_LATENCY', 0))
+FAILURE_RATE = float(getenv('FAKE_INFLUXDB_FAILURE_RATE', 0))
+# every write fails during an outage, SIGUSR1 starts and ends it
+OUTAGE = getenv('FAKE_INFLUXDB_OUTAGE') == '1'
+REPORT_INTERVAL = 10
+
+RESPONSES = {
+    204: b'HTTP/1.1 204 No Content\r\n\r\n',
+    404: b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n',
+    500: (b'HTTP/1.1 500 Internal Server Error\r\n'
+          b'Content-Type: application/json\r\nContent-Length: 26\r\n\r\n'
+          b'{"error":"fake failure"}\r\n'),
+}
+
+
+class FakeInfluxDB:
+
+    def __init__(self):
+        self.requests = 0
+        self.points = 0
+        self.failures = 0
+        self.outage = OUTAGE
+        self.last_report_time = time()
+
+    def toggle_outage(self):
+        self.outage = not self.outage
+        print('Outage has ' + ('started' if self.outage else 'ended'),
+              flush=True)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode().split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode().partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                body = b''
+                if 'content-length' in headers:
+                    body = await reader.readexactly(
+                        int(headers['content-length'])
+                    )
+
+                status = await self.handle_request(method, target, body)
+                writer.write(RESPONSES[status])
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, method, target, body):
+        path = target.partition('?')[0]
+        if path == '/ping':
+            return 204
+        if method != 'POST' or path != '/write':
+            return 404
+
+        if LATENCY:
+            await asyncio.sleep(LATENCY)
+        if self.outage or random.random() < FAILURE_RATE:
+            self.failures += 1
+            return 500
+
+        self.requests += 1
+        self.points += len(body.splitlines())
+        return 204
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(REPORT_INTERVAL)
+            current_time = time()
+            duration = current_time - self.last_report_time
+            print(f'{self.points} points were written with {self.requests} '
+                  f'requests in {duration:.03f} seconds '
+                  f'({self.failures} failed requests)', flush=True)
+            self.requests = self.points = self.failures = 0
+            self.last_report_time = current_time
+
+
+async def serve():
+    fake_influxdb = FakeInfluxDB()
+    server = await asyncio.start_server(fake_influxdb.handle_connection,
+                                        LISTEN_IP, LISTEN_PORT)
+    print(f'Fake InfluxDB is listening on {LISTEN_IP}:{LISTEN_PORT}, '
+          f'pid: {os.getpid()}', flush=True)
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGUSR1, fake_influxdb.toggle_outage)
+    loop.create_task(fake_influxdb.report())
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
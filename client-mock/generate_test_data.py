@@ -1,12 +1,25 @@
 import argparse
 import json
 import os
-import shutil
+import re
 import sys
+import zlib
+from functools import lru_cache
+from multiprocessing import Pool
+from uuid import UUID
 
 import msgpack
 from faker import Faker
 
+from packet_corpus import (
+    CorpusWriter, get_corpus_path, get_dictionary_path
+)
+
+# the binary format is defined by the consumer
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'consumer'))
+from binary_format import encode_binary_packet  # noqa: E402
+
 try:
     from test_data.countries import COUNTRIES
     from test_data.events import EVENTS
@@ -24,14 +37,17 @@ GARBAGE_PLACEHOLDER_PACKED = {
     'json': json.dumps(GARBAGE_PLACEHOLDER),
     'msgpack': msgpack.dumps(GARBAGE_PLACEHOLDER),
 }
-FORMAT_MODE = {
-    'json': 'w',
-    'msgpack': 'bw',
-}
 
 TARGET_PACKET_LENGTH = 50_000
+# packets of a chunk share a seed, so the corpus does not depend
+# on the count of the processes generating it
+CHUNK_SIZE = 64
 TEST_DATA_PATH = 'test_data'
 PACKETS_PATH = os.path.join(TEST_DATA_PATH, 'packets')
+DICTIONARY_PATH = get_dictionary_path(PACKETS_PATH)
+
+# the generator used to write every packet to a file of its own
+PACKET_FILENAME = re.compile(r'\d+\.(json|msgpack|binary)')
 
 
 def generate_data(title, seed, count, generator):
@@ -58,7 +74,36 @@ def generate_events(args):
     generate_data('events', args.seed, args.count, faker.catch_phrase)
 
 
-def generate_packet(packet_index, events_per_packet, packet_format):
+@lru_cache()
+def get_dictionary():
+    # duplicates of the names get a single identifier
+    countries = list(dict.fromkeys(COUNTRIES))
+    events = list(dict.fromkeys(EVENTS))
+    return {
+        'version': zlib.crc32(json.dumps([countries, events]).encode()),
+        'countries': countries,
+        'events': events,
+    }
+
+
+@lru_cache()
+def get_identifiers():
+    dictionary = get_dictionary()
+    return ({name: index for index, name in
+             enumerate(dictionary['countries'])},
+            {name: index for index, name in
+             enumerate(dictionary['events'])})
+
+
+def encode_binary(country, user, events):
+    country_ids, event_ids = get_identifiers()
+    return encode_binary_packet(
+        get_dictionary()['version'], country_ids[country], UUID(user).bytes,
+        [(event_ids[event['type']], event['duration']) for event in events]
+    )
+
+
+def generate_packet(events_per_packet, packet_format):
     choice = faker.random.choice
     random = faker.random.random
 
@@ -77,10 +122,16 @@ def generate_packet(packet_index, events_per_packet, packet_format):
             'duration': duration,
         })
 
+    country = choice(COUNTRIES)
+    user = faker.uuid4()
+    if packet_format == 'binary':
+        # the compact format carries no garbage
+        return encode_binary(country, user, events)
+
     dumps = globals()[packet_format].dumps
     packet = dumps({
-        'country': choice(COUNTRIES),
-        'user': faker.uuid4(),
+        'country': country,
+        'user': user,
         'events': events,
         'garbage': GARBAGE_PLACEHOLDER,
     })
@@ -92,11 +143,28 @@ def generate_packet(packet_index, events_per_packet, packet_format):
 
     packet = packet.replace(GARBAGE_PLACEHOLDER_PACKED[packet_format],
                             dumps('0' * garbage_length))
+    if packet_format == 'json':
+        packet = packet.encode()
+    return packet
 
-    filename = f'{packet_index:0>6d}.{packet_format}'
-    file_path = os.path.join(PACKETS_PATH, filename)
-    with open(file_path, mode=FORMAT_MODE[packet_format]) as packet_file:
-        packet_file.write(packet)
+
+def remove_packet_files(packet_format):
+    # stale packets of the format would be mixed up with the corpus
+    removed = 0
+    for filename in os.listdir(PACKETS_PATH):
+        match = PACKET_FILENAME.fullmatch(filename)
+        if match and match.group(1) == packet_format:
+            os.remove(os.path.join(PACKETS_PATH, filename))
+            removed += 1
+    if removed:
+        print(f'{removed} stale {packet_format} packet files were removed')
+
+
+def generate_chunk(seed, chunk_index, count, events_per_packet,
+                   packet_format):
+    faker.seed_instance(f'{seed}:{chunk_index}')
+    return [generate_packet(events_per_packet, packet_format)
+            for _ in range(count)]
 
 
 def generate_packets(args):
@@ -104,13 +172,32 @@ def generate_packets(args):
         print('Please generate countries and events first!')
         sys.exit(1)
 
-    shutil.rmtree(PACKETS_PATH, ignore_errors=True)
-    os.mkdir(PACKETS_PATH)
-
-    events_per_packet = args.events_per_packet
-    packet_format = 'msgpack' if args.msgpack else 'json'
-    for index in range(args.count):
-        generate_packet(index, events_per_packet, packet_format)
+    os.makedirs(PACKETS_PATH, exist_ok=True)
+
+    if args.binary:
+        packet_format = 'binary'
+        with open(DICTIONARY_PATH, 'w') as dictionary_file:
+            json.dump(get_dictionary(), dictionary_file, indent=2)
+    else:
+        packet_format = 'msgpack' if args.msgpack else 'json'
+    chunks = [
+        (args.seed, chunk_index,
+         min(CHUNK_SIZE, args.count - chunk_index * CHUNK_SIZE),
+         args.events_per_packet, packet_format)
+        for chunk_index in range(-(-args.count // CHUNK_SIZE))
+    ]
+    corpus_path = get_corpus_path(PACKETS_PATH, packet_format)
+    remove_packet_files(packet_format)
+    with Pool(args.workers) as pool, CorpusWriter(corpus_path) as writer:
+        # chunks are written in order as soon as they are ready
+        for packets in pool.imap(_generate_chunk, chunks):
+            for packet in packets:
+                writer.write(packet)
+    print(f'{args.count} packets have been written to {corpus_path}')
+
+
+def _generate_chunk(arguments):
+    return generate_chunk(*arguments)
 
 
 def main(args):
@@ -138,6 +225,11 @@ if __name__ == '__main__':
                         help='count of events in each packet (max 500)')
     parser.add_argument('--msgpack', action='store_true',
                         help='dumps with msgpack instead of json')
+    parser.add_argument('--binary', action='store_true',
+                        help='encode with the compact binary format and '
+                             'write its dictionary')
+    parser.add_argument('--workers', '-w', type=int, default=os.cpu_count(),
+                        help='processes generating packets')
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--countries', action='store_true',
@@ -0,0 +1,390 @@
+import argparse
+import random
+import socket
+import struct
+from bisect import bisect_left
+from collections import deque
+from multiprocessing import Process, Queue
+from time import monotonic, sleep
+
+from packet_corpus import open_corpus
+from reliability import (
+    ACK_HEADER, ACK_MAGIC, DELIVERY_TIMEOUT, RELIABLE, ReliableSender
+)
+from send_packets import (
+    CONFIRMATION, CONSUMER_ADDRESS, DATA_FORMAT, PACKETS_PATH
+)
+
+
+# socket.UDP_SEGMENT is not exposed by the standard library yet
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+# the payload of a single datagram is limited anyway
+MAX_GSO_SIZE = 65000
+MAX_GSO_SEGMENTS = 64
+TICK = 0.001
+# seconds, from 10 microseconds up to about 10 seconds
+LATENCY_BUCKETS = tuple(1e-5 * 2 ** power for power in range(21))
+
+
+class Sender:
+
+    # Sends its share of the load through its own connected socket
+    # following the arrival schedule, no matter how the consumer copes:
+    # falling behind shows up as lag, not as a lower offered rate.
+
+    def __init__(self, index, args, packets):
+        self.args = args
+        self.packets = packets
+        self.position = index * len(packets) // args.processes
+        self.rate = args.rate / args.processes
+        self.random = random.Random(args.seed + index)
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(CONSUMER_ADDRESS)
+        self.gso = args.gso
+        # acks and confirmations come back through the same socket
+        self.receive_size = max(ACK_HEADER.size, len(CONFIRMATION or b''))
+        self.reliable_sender = (ReliableSender(self._send_reliable)
+                                if RELIABLE else None)
+
+        self.sent = 0
+        self.errors = 0
+        self.send_calls = 0
+        self.max_lag = 0
+        self.confirmations = 0
+        self.send_times = deque()
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def run(self, start_time):
+        sleep(max(start_time - monotonic(), 0))
+        end_time = start_time + self.args.duration
+        tokens = 0
+        last_time = start_time
+        next_arrival = start_time + self.random.expovariate(self.rate)
+
+        while True:
+            current_time = monotonic()
+            if current_time >= end_time:
+                break
+
+            if self.args.pacing == 'poisson':
+                due = 0
+                # how late the oldest packet which is due gets sent
+                lag = max(current_time - next_arrival, 0)
+                while next_arrival <= current_time:
+                    due += 1
+                    next_arrival += self.random.expovariate(self.rate)
+            else:
+                # tokens above the burst are lost, so a stalled
+                # sender does not catch up with a huge burst
+                tokens = min(tokens + (current_time - last_time) * self.rate,
+                             self.args.burst)
+                last_time = current_time
+                due = int(tokens)
+                tokens -= due
+                lag = 0
+            self.max_lag = max(self.max_lag, lag)
+
+            for _ in range(0, due, self.args.batch):
+                self._send_batch(min(self.args.batch, due))
+                due -= self.args.batch
+
+            self._receive()
+            sleep(TICK)
+
+        if self.reliable_sender:
+            # unacknowledged packets are retransmitted for a while
+            deadline = monotonic() + DELIVERY_TIMEOUT
+            while not self.reliable_sender.done() and monotonic() < deadline:
+                self._receive()
+                sleep(TICK)
+        if CONFIRMATION:
+            # late confirmations of the last packets
+            drain_end = monotonic() + self.args.drain
+            while self.send_times and monotonic() < drain_end:
+                self._receive()
+                sleep(TICK)
+        self.socket.close()
+
+    def _next_packets(self, count):
+        packets = self.packets
+        position = self.position
+        batch = [packets[(position + offset) % len(packets)]
+                 for offset in range(count)]
+        self.position = (position + count) % len(packets)
+        return batch
+
+    def _send_batch(self, count):
+        batch = self._next_packets(count)
+        if self.reliable_sender:
+            self._send_reliable_batch(batch)
+            return
+        if self.gso:
+            groups = self._group_segments(batch)
+        else:
+            groups = [(packet, 1, None) for packet in batch]
+
+        send_time = monotonic()
+        for data, segments, segment_size in groups:
+            try:
+                if segment_size is None:
+                    self.socket.send(data)
+                else:
+                    self.socket.sendmsg([data], [(
+                        socket.SOL_UDP, UDP_SEGMENT,
+                        struct.pack('H', segment_size)
+                    )])
+            except OSError:
+                if segment_size is not None and not self.sent:
+                    # no GSO on this system, the packets go one by one
+                    self.gso = False
+                    self._send_packets(data, segment_size)
+                else:
+                    self.errors += segments
+                continue
+            self.send_calls += 1
+            self.sent += segments
+            if CONFIRMATION:
+                self.send_times.extend([send_time] * segments)
+
+    def _send_reliable_batch(self, batch):
+        # packets beyond the window wait for acks,
+        # so the sender falls behind the schedule
+        reliable_sender = self.reliable_sender
+        for packet in batch:
+            while not reliable_sender.can_send():
+                self._receive()
+                sleep(TICK)
+            send_time = monotonic()
+            reliable_sender.send(packet)
+            self.sent += 1
+            if CONFIRMATION:
+                self.send_times.append(send_time)
+        self._receive()
+
+    def _send_reliable(self, packet):
+        # first transmissions and retransmissions
+        try:
+            self.socket.send(packet)
+        except OSError:
+            self.errors += 1
+        else:
+            self.send_calls += 1
+
+    def _send_packets(self, data, segment_size):
+        for offset in range(0, len(data), segment_size):
+            try:
+                self.socket.send(data[offset:offset + segment_size])
+            except OSError:
+                self.errors += 1
+            else:
+                self.send_calls += 1
+                self.sent += 1
+                if CONFIRMATION:
+                    self.send_times.append(monotonic())
+
+    @staticmethod
+    def _group_segments(batch):
+        return [(group[0], 1, None) if len(group) == 1 else
+                (b''.join(group), len(group), len(group[0]))
+                for group in split_groups(batch)]
+
+    def _receive(self):
+        if self.reliable_sender:
+            self._receive_datagrams()
+            self.reliable_sender.retransmit()
+        elif CONFIRMATION:
+            self._receive_datagrams()
+
+    def _receive_datagrams(self):
+        # confirmations carry no packet id, so they are matched in order;
+        # lost packets make the following latencies look longer
+        while True:
+            try:
+                data = self.socket.recv(self.receive_size,
+                                        socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue
+
+            if (self.reliable_sender and len(data) == ACK_HEADER.size and
+                    data[:len(ACK_MAGIC)] == ACK_MAGIC):
+                self.reliable_sender.handle_ack(data)
+                continue
+            if data != CONFIRMATION:
+                continue
+
+            receive_time = monotonic()
+            self.confirmations += 1
+            if self.send_times:
+                latency = receive_time - self.send_times.popleft()
+                self.latencies[bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def get_results(self):
+        results = {
+            'sent': self.sent,
+            'errors': self.errors,
+            'send_calls': self.send_calls,
+            'max_lag': self.max_lag,
+            'confirmations': self.confirmations,
+            'latencies': self.latencies,
+        }
+        if self.reliable_sender:
+            results['acknowledged'] = self.reliable_sender.acknowledged
+            results['retransmitted'] = self.reliable_sender.retransmitted
+            results['given_up'] = self.reliable_sender.given_up
+            results['unacknowledged'] = len(self.reliable_sender.unacked)
+        return results
+
+
+def split_groups(batch):
+    # GSO splits a buffer into equally sized datagrams,
+    # only the last one may be shorter
+    groups = []
+    group = []
+    for packet in batch:
+        size = len(packet)
+        if group and (size != len(group[0]) or
+                      (len(group) + 1) * size > MAX_GSO_SIZE or
+                      len(group) >= MAX_GSO_SEGMENTS):
+            groups.append(group)
+            group = []
+        group.append(packet)
+    if group:
+        groups.append(group)
+    return groups
+
+
+def get_segments_per_call(packets, batch):
+    # consecutive packets of the same size are sent as a single buffer,
+    # two of them have to fit into MAX_GSO_SIZE
+    packets = list(packets)
+    calls = sum(len(split_groups(packets[start:start + batch]))
+                for start in range(0, len(packets), batch))
+    return len(packets) / max(calls, 1)
+
+
+def run_sender(index, args, start_time, results):
+    # every process maps the same corpus, the page cache is shared
+    sender = Sender(index, args, open_corpus(PACKETS_PATH, DATA_FORMAT))
+    try:
+        sender.run(start_time)
+    finally:
+        results.put(sender.get_results())
+
+
+def get_percentile(latencies, fraction):
+    # the upper bound of the bucket holding the percentile
+    total = sum(latencies)
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), latencies):
+        cumulative += count
+        if cumulative >= fraction * total:
+            return bound
+    return None
+
+
+def report(args, results):
+    sent = sum(result['sent'] for result in results)
+    errors = sum(result['errors'] for result in results)
+    send_calls = sum(result['send_calls'] for result in results)
+    max_lag = max(result['max_lag'] for result in results)
+    rate = sent / args.duration
+    print(f'{sent} packets were sent in {args.duration:.03f} seconds '
+          f'by {args.processes} processes with {send_calls} send calls: '
+          f'{rate:.02f} pps achieved of {args.rate:.02f} pps targeted '
+          f'({rate / args.rate * 100:.02f}%), {errors} send errors, '
+          f'max lag: {max_lag * 1000:.03f} ms')
+
+    if RELIABLE:
+        acknowledged, retransmitted, given_up, unacknowledged = (
+            sum(result[key] for result in results)
+            for key in ('acknowledged', 'retransmitted', 'given_up',
+                        'unacknowledged')
+        )
+        print(f'{acknowledged} packets were acknowledged, '
+              f'{retransmitted} retransmitted, {given_up} given up, '
+              f'{unacknowledged} unacknowledged')
+
+    if not CONFIRMATION:
+        return
+
+    confirmations = sum(result['confirmations'] for result in results)
+    latencies = [sum(counts) for counts in
+                 zip(*(result['latencies'] for result in results))]
+    print(f'{confirmations} confirmations were received '
+          f'({confirmations / max(sent, 1) * 100:.02f}% of sent packets)')
+    if not confirmations:
+        return
+
+    percentiles = ', '.join(
+        f'p{fraction * 100:g}: '
+        f'{get_percentile(latencies, fraction) * 1000:.03f} ms'
+        for fraction in (0.5, 0.9, 0.99, 0.999)
+    )
+    print(f'Confirmation round-trip time (bucket bounds): {percentiles}')
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS + (float('inf'),), latencies):
+        if not count:
+            continue
+        cumulative += count
+        print(f'  <= {bound * 1000:10.03f} ms: {count:10d} '
+              f'({cumulative / confirmations * 100:6.02f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Open loop load generator holding a target rate'
+    )
+    parser.add_argument('--rate', '-r', type=float, required=True,
+                        help='target packets per second in total')
+    parser.add_argument('--duration', '-d', type=float, default=10,
+                        help='seconds to send for')
+    parser.add_argument('--processes', '-p', type=int, default=1,
+                        help='sender processes, each with its own socket')
+    parser.add_argument('--pacing', choices=('token-bucket', 'poisson'),
+                        default='token-bucket')
+    parser.add_argument('--burst', type=float,
+                        help='token bucket size per process, 10 ms of '
+                             'the rate by default')
+    parser.add_argument('--batch', type=int, default=64,
+                        help='packets sent in a row without pacing checks')
+    parser.add_argument('--gso', action='store_true',
+                        help='send equally sized packets as a single '
+                             'UDP_SEGMENT buffer')
+    parser.add_argument('--drain', type=float, default=1,
+                        help='seconds to wait for late confirmations')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the Poisson arrivals')
+    args = parser.parse_args()
+    if args.burst is None:
+        args.burst = max(args.rate / args.processes * 0.01, 1)
+    if args.gso:
+        if RELIABLE:
+            parser.error('--gso can not be used with RELIABLE=1, '
+                         'sequenced packets are sent one by one')
+        segments = get_segments_per_call(open_corpus(PACKETS_PATH,
+                                                     DATA_FORMAT), args.batch)
+        if segments == 1:
+            parser.error(f'--gso has no effect: there are no consecutive '
+                         f'packets of the same size of up to '
+                         f'{MAX_GSO_SIZE // 2} bytes in the corpus')
+        print(f'GSO sends {segments:.02f} packets per call on average')
+
+    results = Queue()
+    # all the senders start at once, after the corpus is mapped
+    start_time = monotonic() + 0.5
+    processes = [Process(target=run_sender,
+                         args=(index, args, start_time, results))
+                 for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    collected = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    report(args, collected)
+
+
+if __name__ == '__main__':
+    main()
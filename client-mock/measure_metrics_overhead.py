@@ -0,0 +1,76 @@
+import os
+import subprocess
+import sys
+from statistics import median
+from time import perf_counter
+
+from packet_corpus import get_dictionary_path, open_corpus
+
+CONSUMER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'consumer')
+PACKETS_PATH = os.getenv('PACKETS_PATH', 'test_data/packets')
+PACKET_FORMAT = os.getenv('DATA_FORMAT', 'msgpack')
+ROUNDS = int(os.getenv('ROUNDS', 5))
+REPEAT = int(os.getenv('REPEAT', 10))
+BATCH_SIZE = 64
+
+
+def load_packets():
+    # memoryviews of the mapped corpus, which is kept open by them
+    return list(open_corpus(PACKETS_PATH, PACKET_FORMAT))
+
+
+def run_pipeline(mode):
+    # runs the real hot path of the consumer without sockets
+    sys.path.insert(0, CONSUMER_PATH)
+    from consumer import Consumer
+    from protocols import UDPProtocol
+
+    consumer = Consumer(UDPProtocol)
+    data = load_packets() * REPEAT
+
+    start_time = perf_counter()
+    if mode == 'packet':
+        consume_packet = consumer.consume_packet
+        for packet in data:
+            consume_packet(packet)
+    else:
+        for start in range(0, len(data), BATCH_SIZE):
+            consumer.consume_batch(data[start:start + BATCH_SIZE])
+    duration = perf_counter() - start_time
+    print(len(data) / duration)
+
+
+def measure_rate(mode, enabled):
+    env = dict(os.environ, METRICS='1' if enabled else '0',
+               COLLECT_STATS='1', SAVE_RAW_DATA='0')
+    env.setdefault('BINARY_DICTIONARY_PATH',
+                   os.path.abspath(get_dictionary_path(PACKETS_PATH)))
+    output = subprocess.check_output(
+        [sys.executable, __file__, 'child', mode], env=env,
+        stderr=subprocess.DEVNULL
+    )
+    return float(output)
+
+
+def measure(mode):
+    enabled_rates = []
+    disabled_rates = []
+    # alternating runs even out the frequency scaling and the noise
+    for _ in range(ROUNDS):
+        disabled_rates.append(measure_rate(mode, False))
+        enabled_rates.append(measure_rate(mode, True))
+
+    disabled = median(disabled_rates)
+    enabled = median(enabled_rates)
+    overhead = (disabled - enabled) / disabled * 100
+    print(f'[{mode}] {disabled:.02f} pps without metrics, '
+          f'{enabled:.02f} pps with metrics, overhead: {overhead:.02f}%')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['child']:
+        run_pipeline(sys.argv[2])
+    else:
+        for mode in ('packet', 'batch'):
+            measure(mode)
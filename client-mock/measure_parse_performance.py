@@ -1,12 +1,32 @@
+import argparse
 import importlib
 import json
 import os
+import resource
+import subprocess
 import sys
+import tracemalloc
 from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
-from time import time
+from itertools import product
+from statistics import median, quantiles
+from time import perf_counter
 
 import msgpack
 
+from packet_corpus import (
+    get_corpus_path, get_dictionary_path, open_corpus
+)
+
+PACKETS_PATH = os.getenv('PACKETS_PATH', 'test_data/packets')
+# the dictionary of binary packets is kept along with the corpora
+os.environ.setdefault('BINARY_DICTIONARY_PATH',
+                      get_dictionary_path(PACKETS_PATH))
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'consumer'))
+from collectors.stats_table import StatsTable  # noqa: E402
+from serialization import get_deserializer  # noqa: E402
+
 json_modules = [json]
 
 for name in ('simplejson', 'rapidjson', 'ujson'):
@@ -21,71 +41,251 @@ FORMAT_MODULES = {
     'json': json_modules,
     'msgpack': (msgpack,)
 }
+# the selective mode is implemented by the consumer, not by a library
+SELECTIVE_LIBRARY = 'serialization'
+# decoded by the consumer only, there is nothing to skip selectively
+BINARY_FORMAT = 'binary'
 
+INPUT_TYPES = {
+    'bytes': bytes,
+    'memoryview': memoryview,
+}
+# empty objects to find out whether a library accepts an input type
+EMPTY_PACKETS = {
+    'json': b'{}',
+    'msgpack': b'\x80',
+}
 
-PACKETS_PATH = os.getenv('PACKETS_PATH', 'test_data/packets')
 
+def load_packets(packet_format, multiplier):
+    # views of the mapped corpus, converted to the input type of a cell
+    return list(open_corpus(PACKETS_PATH, packet_format)) * multiplier
 
-class Timer:
 
-    def __init__(self, action, postfix='', count=None):
-        self.action = action
-        self.postfix = postfix
-        self.count = count
+def get_loads(packet_format, library, mode):
+    if mode == 'selective' or packet_format == BINARY_FORMAT:
+        return get_deserializer(packet_format, True)
+    if library == 'msgpack':
+        return get_deserializer('msgpack', False)
+    return importlib.import_module(library).loads
 
-    def __enter__(self):
-        self.start_time = time()
-        return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        duration = time() - self.start_time
-        print(f'{self.count} packets were {self.action} '
-              f'in {duration:.03f} seconds '
-              f'at {self.count/duration:.02f} pps rate '
-              f'{self.postfix}')
+def get_unsupported_reason(packet_format, library, mode, input_type):
+    # the consumer deserializers accept any buffer, libraries may not
+    if library == SELECTIVE_LIBRARY or packet_format == BINARY_FORMAT:
+        return None
+    loads = get_loads(packet_format, library, mode)
+    try:
+        loads(INPUT_TYPES[input_type](EMPTY_PACKETS[packet_format]))
+    except TypeError:
+        return f'{library}.loads does not accept {input_type} objects'
+    return None
 
 
-def measure(packet_format):
-    os.chdir(PACKETS_PATH)
+def parse_all(loads, data, executor, chunksize, aggregate):
+    # results are always consumed, so executors pay for sending them back
+    if executor is None:
+        packets = [loads(packet) for packet in data]
+    else:
+        packets = list(executor.map(loads, data, chunksize=chunksize))
+    if aggregate:
+        # formats are compared on getting the stats out of the packets
+        StatsTable().add_packets(packets)
+    return packets
+
+
+def create_executor(kind, workers):
+    if kind == 'threads':
+        return ThreadPoolExecutor(max_workers=workers)
+    if kind == 'processes':
+        return ProcessPoolExecutor(max_workers=workers)
+    return None
+
 
-    data = []
-    with Timer('loaded') as timer:
-        for filename in os.listdir('.'):
-            if filename.endswith(packet_format):
-                with open(filename, mode='rb') as input_file:
-                    data.append(input_file.read())
-        timer.count = len(data)
+def measure_allocations(loads, data):
+    # per packet peak and the size of the parsed results kept in memory
+    peak_total = 0
+    tracemalloc.start()
+    results = []
+    for packet in data:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        results.append(loads(packet))
+        peak_total += tracemalloc.get_traced_memory()[1] - current
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return peak_total / len(data), retained / len(data)
 
-    for module in FORMAT_MODULES[packet_format]:
-        measure_module_performance(module, data)
 
+def get_peak_rss():
+    # KiB on Linux, worker processes are counted separately
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return own / 1024, children / 1024
 
-def measure_module_performance(module, data):
-    loads = module.loads
-    count = len(data)
 
-    with Timer(f'parsed with {module.__name__}', '[main thread]', count):
-        for packet in data:
-            loads(packet)
+def measure_cell(cell):
+    data = load_packets(cell['format'], cell['multiplier'])
+    data = [INPUT_TYPES[cell['input']](packet) for packet in data]
+    loads = get_loads(cell['format'], cell['library'], cell['mode'])
+
+    executor = create_executor(cell['executor'], cell['workers'])
+    durations = []
+    try:
+        for repetition in range(cell['warmup'] + cell['repeats']):
+            start_time = perf_counter()
+            parse_all(loads, data, executor, cell['chunksize'],
+                      cell['aggregate'])
+            if repetition >= cell['warmup']:
+                durations.append(perf_counter() - start_time)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    result = dict(cell, packets=len(data))
+    duration = median(durations)
+    # the slow tail of the repetitions, not of single packets
+    slow_duration = (quantiles(durations, n=20)[-1] if len(durations) > 1
+                     else duration)
+    result['median_pps'] = len(data) / duration
+    result['p95_pps'] = len(data) / slow_duration
+    result['median_seconds'] = duration
+    result['p95_seconds'] = slow_duration
 
-    # DISCLAIMER:
-    # I understand that this approach is wrong.
-    # Data should be loaded in the same thread or process
-    # where it will be processed.
-    # Here I'm trying to measure the overhead.
+    # before tracemalloc adds its own overhead
+    rss, workers_rss = get_peak_rss()
+    result['rss_mib'] = rss
+    result['workers_rss_mib'] = workers_rss
 
-    with Timer(f'parsed with {module.__name__}', '[4 threads]', count):
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            executor.map(loads, data)
+    if cell['executor'] == 'inline':
+        peak, retained = measure_allocations(loads, data)
+        result['peak_kib_per_packet'] = peak / 1024
+        result['retained_kib_per_packet'] = retained / 1024
+    return result
 
-    with Timer(f'parsed with {module.__name__}', '[4 processes]', count):
-        with ProcessPoolExecutor(max_workers=4) as executor:
-            executor.map(loads, data)
+
+def get_cells(args):
+    formats = args.formats.split(',')
+    # chunksize is ignored by ThreadPoolExecutor.map
+    executors = [('inline', 0, 1), ('threads', args.workers, 1)]
+    for chunksize in map(int, args.chunksizes.split(',')):
+        executors.append(('processes', args.workers, chunksize))
+
+    for packet_format in formats:
+        if not os.path.exists(get_corpus_path(PACKETS_PATH, packet_format)):
+            print(f'There are no {packet_format} packets in {PACKETS_PATH}')
+            continue
+
+        if packet_format == BINARY_FORMAT:
+            libraries = [(SELECTIVE_LIBRARY, 'full')]
+        else:
+            libraries = [(module.__name__, 'full')
+                         for module in FORMAT_MODULES[packet_format]]
+            libraries.append((SELECTIVE_LIBRARY, 'selective'))
+        for (library, mode), input_type, executor in product(
+                libraries, INPUT_TYPES, executors):
+            kind, workers, chunksize = executor
+            if kind == 'processes' and input_type == 'memoryview':
+                # memoryviews can not be pickled
+                continue
+            unsupported = get_unsupported_reason(packet_format, library,
+                                                 mode, input_type)
+            yield {
+                'format': packet_format,
+                'library': library,
+                'mode': mode,
+                'input': input_type,
+                'executor': kind,
+                'workers': workers,
+                'chunksize': chunksize,
+                'multiplier': args.multiplier,
+                'warmup': args.warmup,
+                'repeats': args.repeats,
+                'aggregate': args.aggregate,
+                'unsupported': unsupported,
+            }
+
+
+def run_cell(cell):
+    if cell['unsupported']:
+        # reported as such instead of failing
+        return cell
+
+    # every cell runs in its own process, so the peak RSS is its own
+    process = subprocess.run(
+        [sys.executable, __file__, '--cell', json.dumps(cell)],
+        capture_output=True, text=True
+    )
+    if process.returncode:
+        error = process.stderr.strip().splitlines()[-1:]
+        return dict(cell, error=error[0] if error else 'failed')
+    return json.loads(process.stdout)
+
+
+def format_cell(result):
+    executor = result['executor']
+    if executor == 'threads':
+        executor = f'{result["workers"]} threads'
+    elif executor == 'processes':
+        executor = (f'{result["workers"]} processes, '
+                    f'chunksize {result["chunksize"]}')
+    aggregated = ', aggregated' if result['aggregate'] else ''
+    return (f'[{result["format"]}, {result["library"]}, {result["mode"]}, '
+            f'{result["input"]}, {executor}{aggregated}]')
+
+
+def format_result(result):
+    if result['unsupported']:
+        return f'unsupported: {result["unsupported"]}'
+    if 'error' in result:
+        return f'failed: {result["error"]}'
+
+    line = (f'{result["median_pps"]:.02f} pps median, '
+            f'{result["p95_pps"]:.02f} pps p95, '
+            f'{result["rss_mib"]:.01f} MiB peak RSS')
+    if result['workers_rss_mib']:
+        line += f' (+{result["workers_rss_mib"]:.01f} MiB by a worker)'
+    if 'peak_kib_per_packet' in result:
+        line += (f', {result["peak_kib_per_packet"]:.02f} KiB allocated '
+                 f'at peak, {result["retained_kib_per_packet"]:.02f} KiB '
+                 f'retained per packet')
+    return line
 
 
 def main():
-    packet_format = 'msgpack' if '--msgpack' in sys.argv else 'json'
-    measure(packet_format)
+    parser = argparse.ArgumentParser(
+        description='Parsing benchmark matrix: format x library x input '
+                    'type x executor x decode mode'
+    )
+    parser.add_argument('--formats', default='json,msgpack,binary')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='threads or processes of the executors')
+    parser.add_argument('--chunksizes', default='1,16',
+                        help='chunksizes of ProcessPoolExecutor.map')
+    parser.add_argument('--multiplier', type=int, default=10,
+                        help='times the packets are repeated in a pass')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeats', type=int, default=7)
+    parser.add_argument('--aggregate', action='store_true',
+                        help='aggregate the parsed packets into stats '
+                             'as the consumer does')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--cell', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.cell:
+        print(json.dumps(measure_cell(json.loads(args.cell))))
+        return
+
+    results = []
+    for cell in get_cells(args):
+        result = run_cell(cell)
+        print(format_cell(result), format_result(result), flush=True)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
 
 
 if __name__ == '__main__':
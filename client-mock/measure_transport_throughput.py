@@ -0,0 +1,107 @@
+import os
+import re
+import subprocess
+import sys
+from statistics import median
+from time import perf_counter, sleep
+from urllib.error import URLError
+from urllib.request import urlopen
+
+from packet_corpus import get_dictionary_path, open_corpus
+from send_packets import CONSUMER_ADDRESS, PROTOCOLS
+
+CONSUMER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'consumer')
+PACKETS_PATH = os.getenv('PACKETS_PATH', 'test_data/packets')
+PACKET_FORMAT = os.getenv('DATA_FORMAT', 'msgpack')
+TRANSPORTS = os.getenv('TRANSPORTS', 'udp,udp-batch,tcp,unix,unix-dgram')
+ROUNDS = int(os.getenv('ROUNDS', 3))
+REPEAT = int(os.getenv('REPEAT', 250))
+METRICS_PORT = int(os.getenv('BENCHMARK_METRICS_PORT', 9400))
+# udp may lose packets, receiving is over after this long without progress
+SETTLE_TIME = float(os.getenv('SETTLE_TIME', 1))
+POLL_INTERVAL = 0.005
+
+RECEIVED_PACKETS = re.compile(r'^consumer_received_packets_total (\S+)$',
+                              re.MULTILINE)
+
+
+def get_received_packets():
+    url = f'http://127.0.0.1:{METRICS_PORT}/metrics'
+    with urlopen(url, timeout=1) as response:
+        body = response.read().decode()
+    return int(float(RECEIVED_PACKETS.search(body).group(1)))
+
+
+def start_consumer(transport):
+    env = dict(os.environ, PROTOCOL=transport, WORKERS='1', METRICS='1',
+               METRICS_PORT=str(METRICS_PORT),
+               BINARY_DICTIONARY_PATH=os.path.abspath(
+                   get_dictionary_path(PACKETS_PATH)
+               ))
+    process = subprocess.Popen([sys.executable, 'consumer.py'],
+                               cwd=CONSUMER_PATH, env=env,
+                               stderr=subprocess.DEVNULL)
+    while True:
+        try:
+            get_received_packets()
+        except (URLError, OSError):
+            if process.poll() is not None:
+                raise RuntimeError(f'The consumer has failed for {transport}')
+            sleep(0.05)
+        else:
+            return process
+
+
+def wait_for_packets(count):
+    # returns the time the last packet has been received at
+    received = last_received = 0
+    last_progress_time = perf_counter()
+    while received < count:
+        received = get_received_packets()
+        current_time = perf_counter()
+        if received != last_received:
+            last_received = received
+            last_progress_time = current_time
+        elif current_time - last_progress_time >= SETTLE_TIME:
+            break
+        sleep(POLL_INTERVAL)
+    return received, last_progress_time
+
+
+def measure_round(transport, packets):
+    process = start_consumer(transport)
+    try:
+        protocol = PROTOCOLS[transport]()
+        send = protocol.send
+        start_time = perf_counter()
+        for _ in range(REPEAT):
+            for packet in packets:
+                send(packet, CONSUMER_ADDRESS)
+        received, end_time = wait_for_packets(len(packets) * REPEAT)
+        protocol.stop()
+    finally:
+        process.terminate()
+        process.wait()
+    return received, end_time - start_time
+
+
+def measure(transport, packets):
+    count = len(packets) * REPEAT
+    rates = []
+    delivered = []
+    for _ in range(ROUNDS):
+        received, duration = measure_round(transport, packets)
+        rates.append(received / duration)
+        delivered.append(received / count * 100)
+
+    rate = median(rates)
+    throughput = rate * packets.get_size() / len(packets) / 2 ** 20
+    print(f'[{transport}] {rate:.02f} pps, {throughput:.02f} MiB/s, '
+          f'{median(delivered):.02f}% delivered')
+
+
+if __name__ == '__main__':
+    packets = open_corpus(PACKETS_PATH, PACKET_FORMAT)
+    for transport in TRANSPORTS.split(','):
+        measure(transport, packets)
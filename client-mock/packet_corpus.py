@@ -0,0 +1,120 @@
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+
+# A corpus is a single file: the header, the packets prefixed with their
+# lengths one after another and the table of the record offsets.
+MAGIC = b'HLDCORP1'
+HEADER = struct.Struct('<8sQQ')  # magic, count, offset of the table
+RECORD_HEADER = struct.Struct('<I')
+OFFSET_SIZE = 8
+
+
+def get_corpus_path(packets_path, packet_format):
+    return os.path.join(packets_path, f'corpus.{packet_format}')
+
+
+def get_dictionary_path(packets_path):
+    # names the identifiers of binary packets refer to
+    return os.path.join(packets_path, 'dictionary.json')
+
+
+class CorpusWriter:
+
+    # Packets are streamed to a temporary file which replaces
+    # the corpus once the table is written.
+
+    def __init__(self, path):
+        self.path = path
+        self.temporary_path = f'{path}.tmp'
+        self.file = open(self.temporary_path, 'wb')
+        self.file.write(HEADER.pack(MAGIC, 0, 0))
+        self.offsets = array('Q')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.temporary_path)
+
+    def write(self, packet):
+        self.offsets.append(self.file.tell())
+        self.file.write(RECORD_HEADER.pack(len(packet)))
+        self.file.write(packet)
+
+    def close(self):
+        table_offset = self.file.tell()
+        if sys.byteorder == 'big':
+            self.offsets.byteswap()
+        self.offsets.tofile(self.file)
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, len(self.offsets), table_offset))
+        self.file.close()
+        os.replace(self.temporary_path, self.path)
+
+
+class PacketCorpus:
+
+    # A read-only memory map of a corpus. Packets are memoryviews of the
+    # map, so they are neither read nor copied until they are sent, and
+    # processes replaying the same corpus share the page cache.
+
+    def __init__(self, path):
+        with open(path, 'rb') as corpus_file:
+            self.map = mmap.mmap(corpus_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+        magic, self.count, table_offset = HEADER.unpack_from(self.map)
+        if magic != MAGIC:
+            self.map.close()
+            raise ValueError(f'{path} is not a packet corpus')
+
+        self.buffer = memoryview(self.map)
+        table = self.buffer[table_offset:
+                            table_offset + self.count * OFFSET_SIZE]
+        if sys.byteorder == 'big':
+            self.offsets = array('Q', table)
+            self.offsets.byteswap()
+        else:
+            self.offsets = table.cast('Q')
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        offset = self.offsets[index]
+        length, = RECORD_HEADER.unpack_from(self.map, offset)
+        offset += RECORD_HEADER.size
+        return self.buffer[offset:offset + length]
+
+    def __iter__(self):
+        # records are read in order, the table is not needed
+        buffer = self.buffer
+        offset = HEADER.size
+        for _ in range(self.count):
+            length, = RECORD_HEADER.unpack_from(buffer, offset)
+            offset += RECORD_HEADER.size
+            yield buffer[offset:offset + length]
+            offset += length
+
+    def get_size(self):
+        # of all the packets without the framing
+        return len(self.map) - HEADER.size - self.count * (
+            RECORD_HEADER.size + OFFSET_SIZE
+        )
+
+
+def open_corpus(packets_path, packet_format):
+    path = get_corpus_path(packets_path, packet_format)
+    if not os.path.exists(path):
+        raise FileNotFoundError(
+            f'There is no {packet_format} corpus in {packets_path}, '
+            f'please generate packets first'
+        )
+    return PacketCorpus(path)
@@ -0,0 +1,117 @@
+import random
+import struct
+from os import getenv
+from time import monotonic
+
+
+RELIABLE = getenv('RELIABLE') == '1'
+RETRANSMIT_TIMEOUT = float(getenv('RETRANSMIT_TIMEOUT', 0.2))
+MAX_RETRANSMIT_TIMEOUT = float(getenv('MAX_RETRANSMIT_TIMEOUT', 2))
+MAX_RETRANSMISSIONS = int(getenv('MAX_RETRANSMISSIONS', 10))
+# sequence numbers the sender may run ahead of the oldest unacknowledged
+# packet; the default is covered by the cumulative ack and its bitmap,
+# so received packets are not retransmitted because of a short bitmap
+MAX_IN_FLIGHT = int(getenv('MAX_IN_FLIGHT', 65))
+DELIVERY_TIMEOUT = float(getenv('DELIVERY_TIMEOUT', 30))
+
+# the same layout as consumer/protocols/reliability.py
+DATA_MAGIC = b'HR'
+ACK_MAGIC = b'HA'
+RELIABLE_VERSION = 1
+DATA_HEADER = struct.Struct('<2sBxIII')
+ACK_HEADER = struct.Struct('<2sBxIIQ')
+SACK_BITS = 64
+SEQUENCE_MODULO = 2 ** 32
+
+
+def get_distance(start, end):
+    # RFC 1982 serial number arithmetic, sequence numbers wrap around:
+    # how far the end is ahead of the start, negative when it is behind
+    return (end - start + SEQUENCE_MODULO // 2) % SEQUENCE_MODULO - (
+        SEQUENCE_MODULO // 2
+    )
+
+
+class ReliableSender:
+
+    # Numbers outgoing packets of a random stream, keeps them until they
+    # are acknowledged and retransmits them with exponential backoff.
+
+    def __init__(self, send):
+        self._send = send
+        self.stream_id = random.getrandbits(32)
+        self.sequence = 0
+        # sequence -> [packet, sent at, transmissions], ordered by sequence
+        self.unacked = {}
+        self.acknowledged = 0
+        self.retransmitted = 0
+        self.given_up = 0
+
+    @property
+    def base(self):
+        return next(iter(self.unacked), self.sequence)
+
+    def can_send(self):
+        return get_distance(self.base, self.sequence) < MAX_IN_FLIGHT
+
+    def done(self):
+        return not self.unacked
+
+    def send(self, payload):
+        sequence = self.sequence
+        packet = DATA_HEADER.pack(DATA_MAGIC, RELIABLE_VERSION,
+                                  self.stream_id, sequence,
+                                  self.base) + payload
+        self.sequence = (sequence + 1) % SEQUENCE_MODULO
+        self.unacked[sequence] = [packet, monotonic(), 1]
+        self._send(packet)
+
+    def handle_ack(self, data):
+        if len(data) != ACK_HEADER.size:
+            return
+        magic, version, stream_id, expected, bitmap = ACK_HEADER.unpack(data)
+        if (magic != ACK_MAGIC or version != RELIABLE_VERSION
+                or stream_id != self.stream_id):
+            return
+
+        unacked = self.unacked
+        for sequence in list(unacked):
+            if get_distance(expected, sequence) >= 0:
+                break
+            del unacked[sequence]
+            self.acknowledged += 1
+
+        while bitmap:
+            bit = bitmap & -bitmap
+            sequence = (expected + bit.bit_length()) % SEQUENCE_MODULO
+            if unacked.pop(sequence, None) is not None:
+                self.acknowledged += 1
+            bitmap ^= bit
+
+    def retransmit(self):
+        current_time = monotonic()
+        base = self.base
+        for sequence, entry in list(self.unacked.items()):
+            packet, sent_at, transmissions = entry
+            timeout = min(RETRANSMIT_TIMEOUT * 2 ** (transmissions - 1),
+                          MAX_RETRANSMIT_TIMEOUT)
+            if current_time - sent_at < timeout:
+                continue
+            if transmissions > MAX_RETRANSMISSIONS:
+                del self.unacked[sequence]
+                self.given_up += 1
+                continue
+
+            # the header carries the current base
+            packet = DATA_HEADER.pack(DATA_MAGIC, RELIABLE_VERSION,
+                                      self.stream_id, sequence,
+                                      base) + packet[DATA_HEADER.size:]
+            entry[:] = packet, current_time, transmissions + 1
+            self.retransmitted += 1
+            self._send(packet)
+
+    def report(self):
+        return (f'{self.acknowledged} packets were acknowledged, '
+                f'{self.retransmitted} retransmitted, '
+                f'{self.given_up} given up, '
+                f'{len(self.unacked)} unacknowledged')
@@ -1,11 +1,19 @@
-import os
+import select
 import socket
+import struct
 import sys
+from itertools import chain, repeat
 from os import getenv
-from time import sleep
+from time import monotonic, sleep
 
 from tqdm import tqdm
 
+from packet_corpus import open_corpus
+from reliability import (
+    ACK_HEADER, DELIVERY_TIMEOUT, RELIABLE, RETRANSMIT_TIMEOUT,
+    ReliableSender
+)
+
 
 CONSUMER_IP = getenv('CONSUMER_IP', '127.0.0.1')
 CONSUMER_PORT = int(getenv('CONSUMER_PORT', 51273))
@@ -16,6 +24,13 @@ if CONFIRMATION:
     CONFIRMATION = CONFIRMATION.encode()
 
 PACKETS_PATH = getenv('PACKETS_PATH', 'test_data/packets')
+DATA_FORMAT = getenv('DATA_FORMAT', 'msgpack')
+
+# the same names as the consumer protocols, udp-batch is plain udp
+PROTOCOL = getenv('PROTOCOL', 'udp')
+CONSUMER_PATH = getenv('CONSUMER_PATH', '/tmp/highload-demo.sock')
+# stream frames are prefixed with the length of their payload
+FRAME_HEADER = struct.Struct('<I')
 
 
 class UDPProtocol:
@@ -30,11 +45,99 @@ class UDPProtocol:
         self.transport.close()
 
 
+class ReliableUDPProtocol(UDPProtocol):
+
+    def __init__(self):
+        super().__init__()
+        self.sender = ReliableSender(
+            lambda packet: self.transport.sendto(packet, CONSUMER_ADDRESS)
+        )
+
+    def send(self, packet, address):
+        sender = self.sender
+        while not sender.can_send():
+            self._wait_for_acks(RETRANSMIT_TIMEOUT / 4)
+        sender.send(packet)
+        self._receive_acks()
+        sender.retransmit()
+
+    def _receive_acks(self):
+        while True:
+            try:
+                ack = self.transport.recv(ACK_HEADER.size, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue
+            self.sender.handle_ack(ack)
+
+    def _wait_for_acks(self, timeout):
+        select.select([self.transport], [], [], timeout)
+        self._receive_acks()
+        self.sender.retransmit()
+
+    def stop(self):
+        deadline = monotonic() + DELIVERY_TIMEOUT
+        while not self.sender.done() and monotonic() < deadline:
+            self._wait_for_acks(RETRANSMIT_TIMEOUT / 4)
+        print(self.sender.report())
+        super().stop()
+
+
+class TCPProtocol:
+
+    def __init__(self):
+        self.transport = socket.create_connection(CONSUMER_ADDRESS)
+
+    def send(self, packet, address):
+        self.transport.sendall(FRAME_HEADER.pack(len(packet)) + packet)
+
+    def stop(self):
+        self.transport.close()
+
+
+class UnixStreamProtocol(TCPProtocol):
+
+    def __init__(self):
+        self.transport = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.transport.connect(CONSUMER_PATH)
+
+
+class UnixDatagramProtocol(UDPProtocol):
+
+    # unlike udp, the sender blocks while the receive queue is full
+
+    def __init__(self):
+        self.transport = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def send(self, packet, address):
+        self.transport.sendto(packet, CONSUMER_PATH)
+
+
+PROTOCOLS = {
+    'udp': UDPProtocol,
+    'udp-batch': UDPProtocol,
+    'tcp': TCPProtocol,
+    'unix': UnixStreamProtocol,
+    'unix-dgram': UnixDatagramProtocol,
+}
+
+
+def get_protocol_class():
+    if RELIABLE:
+        return ReliableUDPProtocol
+    try:
+        return PROTOCOLS[PROTOCOL]
+    except KeyError:
+        raise ValueError(f'{PROTOCOL} protocol is not supported')
+
+
 class Producer:
 
-    def __init__(self, interval, packets, protocol_class):
+    def __init__(self, interval, packets, iterations, protocol_class):
         self.interval = interval
         self.packets = packets
+        self.iterations = iterations
         self.protocol = protocol_class()
 
     def run(self):
@@ -48,22 +151,20 @@ class Producer:
     def send_packets(self):
         interval = self.interval
         send = self.protocol.send
-        for packet in tqdm(self.packets, unit='packet'):
+        packets = chain.from_iterable(repeat(self.packets, self.iterations))
+        total = len(self.packets) * self.iterations
+        for packet in tqdm(packets, total=total, unit='packet'):
             send(packet, CONSUMER_ADDRESS)
             if interval:
                 sleep(interval)
 
 
 def main():
-    os.chdir(PACKETS_PATH)
     iterations = int(sys.argv[1])
     interval = float(sys.argv[2])
 
-    packets = []
-    for filename in os.listdir('.'):
-        with open(filename, mode='rb') as input_file:
-            packets.append(input_file.read())
-    Producer(interval, packets * iterations, UDPProtocol).run()
+    packets = open_corpus(PACKETS_PATH, DATA_FORMAT)
+    Producer(interval, packets, iterations, get_protocol_class()).run()
 
 
 if __name__ == '__main__':
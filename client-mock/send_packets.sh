@@ -1,8 +1,7 @@
 #!/bin/bash
 
-cd test_data/packets
+# sends every packet of the corpus of the given format once, e.g. msgpack;
+# the corpus is a single file, so it is read by send_packets.py
+cd "$(dirname "$0")"
 
-for filename in $(ls *.${1}); do
-    echo "${filename}"
-    cat "${filename}" > /dev/udp/127.0.0.1/51273
-done
+DATA_FORMAT="${1:-msgpack}" exec python send_packets.py 1 0
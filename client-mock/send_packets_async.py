@@ -1,9 +1,13 @@
 import asyncio
-import os
 from os import getenv
 
 from tqdm import tqdm
 
+from packet_corpus import open_corpus
+from reliability import (
+    DELIVERY_TIMEOUT, RELIABLE, RETRANSMIT_TIMEOUT, ReliableSender
+)
+
 
 CONSUMER_IP = getenv('CONSUMER_IP', '127.0.0.1')
 CONSUMER_PORT = int(getenv('CONSUMER_PORT', 51273))
@@ -14,6 +18,7 @@ if CONFIRMATION:
     CONFIRMATION = CONFIRMATION.encode()
 
 PACKETS_PATH = getenv('PACKETS_PATH', 'test_data/packets')
+DATA_FORMAT = getenv('DATA_FORMAT', 'msgpack')
 
 
 class UDPProtocol:
@@ -38,10 +43,65 @@ class UDPProtocol:
                                                   remote_addr=CONSUMER_ADDRESS)
         loop.run_until_complete(coroutine)
 
+    async def wait_for_window(self):
+        pass
+
+    async def wait_for_delivery(self):
+        await asyncio.sleep(10)
+
     def stop(self):
         self.transport.close()
 
 
+class ReliableUDPProtocol(UDPProtocol):
+
+    def __init__(self):
+        super().__init__()
+        self.sender = None
+        self.timer = None
+        self.acked = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.sender = ReliableSender(transport.sendto)
+        self.acked = asyncio.Event()
+        self._schedule_retransmission()
+
+    def datagram_received(self, packet, address):
+        self.sender.handle_ack(packet)
+        self.acked.set()
+
+    def send(self, packet, address):
+        self.sender.send(packet)
+
+    def _schedule_retransmission(self):
+        loop = asyncio.get_event_loop()
+        self.timer = loop.call_later(RETRANSMIT_TIMEOUT / 4,
+                                     self._retransmit)
+
+    def _retransmit(self):
+        self.sender.retransmit()
+        self.acked.set()
+        self._schedule_retransmission()
+
+    async def wait_for_window(self):
+        while not self.sender.can_send():
+            self.acked.clear()
+            await self.acked.wait()
+
+    async def wait_for_delivery(self):
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + DELIVERY_TIMEOUT
+        while not self.sender.done() and loop.time() < deadline:
+            self.acked.clear()
+            await self.acked.wait()
+        print(self.sender.report())
+
+    def stop(self):
+        self.timer.cancel()
+        super().stop()
+
+
 class Producer:
 
     def __init__(self, packets, protocol_class):
@@ -59,18 +119,14 @@ class Producer:
             self.loop.close()
 
     async def send_packets(self):
-        send = self.protocol.send
+        protocol = self.protocol
+        send = protocol.send
         for packet in tqdm(self.packets):
+            await protocol.wait_for_window()
             send(packet, CONSUMER_ADDRESS)
-        await asyncio.sleep(10)
+        await protocol.wait_for_delivery()
 
 
 if __name__ == '__main__':
-    os.chdir(PACKETS_PATH)
-
-    packets = []
-    for filename in os.listdir('.'):
-        if filename.endswith('.msgpack'):
-            with open(filename, mode='rb') as input_file:
-                packets.append(input_file.read())
-    Producer(packets, UDPProtocol).run()
+    Producer(open_corpus(PACKETS_PATH, DATA_FORMAT),
+             ReliableUDPProtocol if RELIABLE else UDPProtocol).run()
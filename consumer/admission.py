@@ -0,0 +1,212 @@
+import ipaddress
+from collections import OrderedDict
+from os import getenv
+from time import monotonic
+
+import metrics
+from binary_format import BINARY_HEADER, BINARY_MAGIC
+from protocols.reliability import DATA_HEADER, DATA_MAGIC, RELIABLE
+
+
+ADMISSION = getenv('ADMISSION') == '1'
+# sizes of the payloads, without the reliability header;
+# the minimum depends on the data format by default
+ADMISSION_MIN_SIZE = int(getenv('ADMISSION_MIN_SIZE', 0))
+ADMISSION_MAX_SIZE = int(getenv('ADMISSION_MAX_SIZE', 65535))
+ADMISSION_SNIFF = getenv('ADMISSION_SNIFF', '1') == '1'
+# comma separated networks, the longest matching prefix decides and
+# the denylist wins for equal ones; with an allowlist nothing else passes
+ADMISSION_ALLOW = getenv('ADMISSION_ALLOW', '').split(',')
+ADMISSION_DENY = getenv('ADMISSION_DENY', '').split(',')
+# packets per second of a single source address, 0 disables the limit
+ADMISSION_RATE = float(getenv('ADMISSION_RATE', 0))
+ADMISSION_BURST = float(getenv('ADMISSION_BURST', 0)) or ADMISSION_RATE
+# the least recently seen sources are forgotten beyond this count
+ADMISSION_SOURCES = int(getenv('ADMISSION_SOURCES', 65536))
+
+TOO_SMALL = 'too_small'
+TOO_LARGE = 'too_large'
+BAD_MAGIC = 'bad_magic'
+DENIED = 'denied'
+RATE_LIMITED = 'rate_limited'
+REASONS = TOO_SMALL, TOO_LARGE, BAD_MAGIC, DENIED, RATE_LIMITED
+
+# a json object may start with whitespace, a msgpack one is a map
+FIRST_BYTES = {
+    'json': frozenset(b'{ \t\n\r'),
+    'msgpack': frozenset((*range(0x80, 0x90), 0xde, 0xdf)),
+}
+MAGICS = {
+    'binary': BINARY_MAGIC,
+}
+MIN_SIZES = {
+    'json': len(b'{}'),
+    'msgpack': 1,
+    'binary': BINARY_HEADER.size,
+}
+
+
+class _Source:
+
+    def __init__(self, allowed, tokens, now):
+        self.allowed = allowed
+        self.tokens = tokens
+        self.last_time = now
+
+
+class PrefixTable:
+
+    # Networks are kept in a dict per prefix length, so a lookup takes
+    # a single masked dict access per length in use, longest first.
+
+    def __init__(self, allowlist=(), denylist=()):
+        self.has_allowlist = bool(allowlist)
+        self.prefixes = {4: {}, 6: {}}
+        # denials overwrite allowances of the same networks
+        for networks, allowed in ((allowlist, True), (denylist, False)):
+            for network in networks:
+                network = ipaddress.ip_network(network, strict=False)
+                self.prefixes[network.version].setdefault(
+                    int(network.netmask), {}
+                )[int(network.network_address)] = allowed
+        self.masks = {
+            version: sorted(prefixes.items(), reverse=True)
+            for version, prefixes in self.prefixes.items()
+        }
+
+    def is_allowed(self, host):
+        try:
+            address = ipaddress.ip_address(host)
+        except ValueError:
+            return not self.has_allowlist
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+
+        value = int(address)
+        for mask, networks in self.masks[address.version]:
+            allowed = networks.get(value & mask)
+            if allowed is not None:
+                return allowed
+        return not self.has_allowlist
+
+
+class AdmissionFilter:
+
+    # Cheap checks of the received packets before anything is decoded:
+    # payload size, the leading bytes of the data format, the source
+    # networks and a token bucket per source address. The decisions
+    # on the networks are cached along with the buckets in an LRU.
+    # Sources which are not IP addresses (unix sockets) are only
+    # checked for the size and the format.
+
+    def __init__(self, data_format, min_size=ADMISSION_MIN_SIZE,
+                 max_size=ADMISSION_MAX_SIZE, sniff=ADMISSION_SNIFF,
+                 allowlist=ADMISSION_ALLOW, denylist=ADMISSION_DENY,
+                 rate=ADMISSION_RATE, burst=ADMISSION_BURST,
+                 max_sources=ADMISSION_SOURCES):
+        self.min_size = max(min_size or MIN_SIZES.get(data_format, 1), 1)
+        self.max_size = max_size
+        self.magic = MAGICS.get(data_format) if sniff else None
+        self.first_bytes = FIRST_BYTES.get(data_format) if sniff else None
+        allowlist = [network.strip() for network in allowlist
+                     if network.strip()]
+        denylist = [network.strip() for network in denylist
+                    if network.strip()]
+        self.prefix_table = (PrefixTable(allowlist, denylist)
+                             if allowlist or denylist else None)
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_sources = max_sources
+        self.sources = OrderedDict()
+
+        self.rejected = dict.fromkeys(REASONS, 0)
+        self.reported_rejected = 0
+        for reason, counter in metrics.ADMISSION_REJECTED_PACKETS.items():
+            counter.set_function(lambda reason=reason: self.rejected[reason])
+
+    def admit(self, packet, address):
+        return self._admit(packet, address, monotonic())
+
+    def admit_batch(self, packets, addresses):
+        now = monotonic()
+        admit = self._admit
+        admitted = [index for index, (packet, address) in
+                    enumerate(zip(packets, addresses))
+                    if admit(packet, address, now)]
+        if len(admitted) == len(packets):
+            return packets, addresses
+        return ([packets[index] for index in admitted],
+                [addresses[index] for index in admitted])
+
+    def is_allowed(self, address):
+        # connections of the denied sources are not read at all
+        if type(address) is not tuple or self.prefix_table is None:
+            return True
+        if self.prefix_table.is_allowed(address[0]):
+            return True
+        self.rejected[DENIED] += 1
+        return False
+
+    def _admit(self, packet, address, now):
+        offset = 0
+        if RELIABLE and packet[:2] == DATA_MAGIC:
+            offset = DATA_HEADER.size
+
+        size = len(packet) - offset
+        if size < self.min_size:
+            return self._reject(TOO_SMALL)
+        if size > self.max_size:
+            return self._reject(TOO_LARGE)
+
+        if self.magic is not None:
+            if packet[offset:offset + len(self.magic)] != self.magic:
+                return self._reject(BAD_MAGIC)
+        elif (self.first_bytes is not None and
+                packet[offset] not in self.first_bytes):
+            return self._reject(BAD_MAGIC)
+
+        if type(address) is not tuple or not (self.prefix_table or
+                                              self.rate):
+            return True
+
+        reason = self._check_source(address[0], now)
+        if reason is not None:
+            return self._reject(reason)
+        return True
+
+    def _check_source(self, host, now):
+        sources = self.sources
+        source = sources.get(host)
+        if source is None:
+            allowed = (self.prefix_table is None or
+                       self.prefix_table.is_allowed(host))
+            source = sources[host] = _Source(allowed, self.burst, now)
+            if len(sources) > self.max_sources:
+                sources.popitem(last=False)
+        else:
+            sources.move_to_end(host)
+
+        if not source.allowed:
+            return DENIED
+        if not self.rate:
+            return None
+
+        source.tokens = min(
+            source.tokens + (now - source.last_time) * self.rate, self.burst
+        )
+        source.last_time = now
+        if source.tokens < 1:
+            return RATE_LIMITED
+        source.tokens -= 1
+        return None
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return False
+
+    def pop_rejected(self):
+        # the totals are exported as metrics, so only the difference
+        # since the previous call is returned
+        rejected = sum(self.rejected.values())
+        previous, self.reported_rejected = self.reported_rejected, rejected
+        return rejected - previous
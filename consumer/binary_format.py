@@ -0,0 +1,22 @@
+import struct
+
+
+# The compact binary packet format, the client mocks encode packets with
+# this module as well: a header followed by fixed size events, names are
+# replaced with their identifiers in a dictionary of a known version.
+BINARY_MAGIC = b'HLEB'
+BINARY_VERSION = 1
+# magic, format version, dictionary version, country id,
+# user UUID bytes and the count of the events following the header
+BINARY_HEADER = struct.Struct('<4sBIH16sI')
+# event id, duration
+BINARY_EVENT = struct.Struct('<Hd')
+
+
+def encode_binary_packet(dictionary_version, country_id, user, events):
+    # events are (event id, duration) pairs, the user is 16 UUID bytes
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION,
+                                dictionary_version, country_id, user,
+                                len(events))
+    return header + b''.join(BINARY_EVENT.pack(event_id, duration)
+                             for event_id, duration in events)
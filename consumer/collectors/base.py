@@ -1,11 +1,12 @@
 class CollectorMetaclass(type):
 
     def __new__(mcs, name, bases, class_dict):
-        if not class_dict.get('enabled'):
+        # the base class keeps its default implementations for subclasses
+        if bases and not class_dict.get('enabled'):
             def stub(*args, **kwargs):
                 pass
 
-            for method in ('collect_data', 'flush', 'stop'):
+            for method in ('collect_data', 'collect_batch', 'flush', 'stop'):
                 class_dict[method] = stub
 
         return super(CollectorMetaclass, mcs).__new__(
@@ -21,9 +22,17 @@ class BaseCollector(metaclass=CollectorMetaclass):
         self.consumer_id = consumer.consumer_id
         self.loop = consumer.loop
 
-    def collect_data(self, data):
+    def collect_data(self, data, weight=1):
         raise NotImplementedError
 
+    def collect_batch(self, batch, weights=None):
+        if weights is None:
+            for data in batch:
+                self.collect_data(data)
+        else:
+            for data, weight in zip(batch, weights):
+                self.collect_data(data, weight)
+
     def flush(self):
         raise NotImplementedError
 
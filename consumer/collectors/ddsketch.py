@@ -0,0 +1,42 @@
+from math import ceil, log
+from os import getenv
+
+import numpy as np
+
+
+# relative error of the quantiles, values out of the range are collapsed
+# into the edge bins, so the memory per sketch is fixed
+SKETCH_RELATIVE_ACCURACY = float(getenv('SKETCH_RELATIVE_ACCURACY', 0.02))
+SKETCH_MIN_VALUE = float(getenv('SKETCH_MIN_VALUE', 1e-3))
+SKETCH_MAX_VALUE = float(getenv('SKETCH_MAX_VALUE', 1e5))
+
+QUANTILES = 0.5, 0.9, 0.99
+
+GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+LOG_GAMMA = log(GAMMA)
+INDEX_OFFSET = ceil(log(SKETCH_MIN_VALUE) / LOG_GAMMA)
+SKETCH_BINS = ceil(log(SKETCH_MAX_VALUE) / LOG_GAMMA) - INDEX_OFFSET + 1
+
+
+def get_bins(values):
+    # logarithmic mapping of DDSketch: bin i holds (gamma^(i-1), gamma^i]
+    values = np.maximum(np.asarray(values, dtype=np.float64),
+                        SKETCH_MIN_VALUE)
+    indexes = np.ceil(np.log(values) / LOG_GAMMA) - INDEX_OFFSET
+    return np.clip(indexes, 0, SKETCH_BINS - 1).astype(np.intp)
+
+
+def get_value(index):
+    # the estimate is within the relative accuracy from any bin value
+    return 2 * GAMMA ** (index + INDEX_OFFSET) / (GAMMA + 1)
+
+
+def get_quantiles(bins, maximum, quantiles=QUANTILES):
+    cumulative = np.cumsum(bins)
+    total = cumulative[-1]
+    values = []
+    for quantile in quantiles:
+        rank = quantile * (total - 1) if total > 1 else 0
+        index = int(np.searchsorted(cumulative, rank, side='right'))
+        values.append(min(get_value(min(index, SKETCH_BINS - 1)), maximum))
+    return values
@@ -0,0 +1,102 @@
+from hashlib import blake2b
+from os import getenv
+
+import numpy as np
+
+
+# 2 ** precision one byte registers per sketch,
+# the standard error is about 1.04 / sqrt(2 ** precision)
+HLL_PRECISION = int(getenv('HLL_PRECISION', 12))
+# distinct users per (country, event) cell as well
+HLL_PER_EVENT = getenv('HLL_PER_EVENT') == '1'
+HLL_EVENT_PRECISION = int(getenv('HLL_EVENT_PRECISION', 10))
+
+UUID_LENGTH = 36
+# positions of the hex digits in the canonical UUID form
+UUID_DIGITS = [position for position in range(UUID_LENGTH)
+               if position not in (8, 13, 18, 23)]
+SHIFTS = np.arange(60, -1, -4, dtype=np.uint64)
+
+_MASK_32 = np.uint64(0xffffffff)
+
+
+def _fmix64(values):
+    # the finalizer of MurmurHash3, non-random UUID versions get spread too
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xff51afd7ed558ccd)
+    values = values ^ (values >> np.uint64(33))
+    values = values * np.uint64(0xc4ceb9fe1a85ec53)
+    return values ^ (values >> np.uint64(33))
+
+
+def hash_users(users):
+    # UUID strings are converted to 64 bit hashes without
+    # creating Python objects for every user
+    users = list(users)
+    hashes = np.empty(len(users), dtype=np.uint64)
+    valid = np.array([len(user) == UUID_LENGTH and user.isascii()
+                      for user in users], dtype=bool)
+
+    if valid.any():
+        text = ''.join(user for user, is_valid in zip(users, valid)
+                       if is_valid).encode()
+        digits = np.frombuffer(text, dtype=np.uint8).reshape(
+            -1, UUID_LENGTH
+        )[:, UUID_DIGITS].astype(np.uint64)
+        # '0'-'9' and 'a'-'f' of any case
+        nibbles = np.where(digits <= ord('9'), digits - ord('0'),
+                           (digits | 0x20) - (ord('a') - 10)) & 0xf
+        with np.errstate(over='ignore'):
+            high = np.bitwise_or.reduce(nibbles[:, :16] << SHIFTS, axis=1)
+            low = np.bitwise_or.reduce(nibbles[:, 16:] << SHIFTS, axis=1)
+            hashes[valid] = _fmix64(high ^ _fmix64(low))
+
+    for index in np.flatnonzero(~valid):
+        user = users[index]
+        if not isinstance(user, bytes):
+            user = str(user).encode()
+        hashes[index] = int.from_bytes(blake2b(user, digest_size=8).digest(),
+                                       'little')
+    return hashes
+
+
+def hash_uuid_bytes(data):
+    # 16 byte UUIDs one after another, the hashes are the same
+    # as the ones of their canonical strings
+    words = np.frombuffer(data, dtype='>u8').reshape(-1, 2)
+    with np.errstate(over='ignore'):
+        return _fmix64(words[:, 0] ^ _fmix64(words[:, 1]))
+
+
+def get_registers(hashes, precision):
+    # register indexes come from the top bits, ranks are the positions
+    # of the leftmost 1 bit in the rest of the hash
+    indexes = (hashes >> np.uint64(64 - precision)).astype(np.intp)
+    with np.errstate(over='ignore'):
+        rest = (hashes << np.uint64(precision)) | np.uint64(
+            1 << (precision - 1)
+        )
+    # the halves are converted to floats exactly
+    high = (rest >> np.uint64(32)).astype(np.float64)
+    low = (rest & _MASK_32).astype(np.float64)
+    ranks = np.where(high > 0,
+                     32 - np.floor(np.log2(np.maximum(high, 1))),
+                     64 - np.floor(np.log2(np.maximum(low, 1))))
+    return indexes, ranks.astype(np.uint8)
+
+
+def estimate(registers):
+    # estimates of the sketches along the last axis
+    size = registers.shape[-1]
+    if size >= 128:
+        alpha = 0.7213 / (1 + 1.079 / size)
+    else:
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}[size]
+
+    harmonic = np.sum(np.exp2(-registers.astype(np.float64)), axis=-1)
+    estimates = alpha * size * size / harmonic
+    zeros = np.count_nonzero(registers == 0, axis=-1)
+    # linear counting is more accurate for small cardinalities
+    small = (estimates <= 2.5 * size) & (zeros > 0)
+    linear = size * np.log(size / np.maximum(zeros, 1))
+    return np.where(small, linear, estimates)
@@ -1,52 +1,57 @@
-import asyncio
 import os
 from datetime import datetime
+from time import perf_counter
 
-from aiofiles.threadpool import wrap
+import metrics
+from serialization import get_field_stripper
+from writers import SegmentWriter
+from writers.codecs import get_codec_id
 
 from .base import BaseCollector
 
 
 RAW_DATA_PATH = os.getenv('RAW_DATA_PATH', 'raw_data')
+RAW_STRIP_FIELDS = [field for field in
+                    os.getenv('RAW_STRIP_FIELDS', '').split(',') if field]
+RAW_COMPRESSION = os.getenv('RAW_COMPRESSION', 'none')
+RAW_COMPRESSION_LEVEL = os.getenv('RAW_COMPRESSION_LEVEL')
 
 
 class RawDataCollector(BaseCollector):
 
-    output_file = None
+    writer = None
     enabled = os.getenv('SAVE_RAW_DATA') == '1'
 
-    def __init__(self, consumer):
+    def __init__(self, consumer, data_format):
         super().__init__(consumer)
         if self.enabled:
             self.path = os.path.join(RAW_DATA_PATH, consumer.consumer_id)
             os.mkdir(self.path)
+
+            transform = None
+            if RAW_STRIP_FIELDS:
+                transform = get_field_stripper(data_format, RAW_STRIP_FIELDS)
+            self.writer = SegmentWriter(
+                codec=get_codec_id(RAW_COMPRESSION),
+                compression_level=(int(RAW_COMPRESSION_LEVEL)
+                                   if RAW_COMPRESSION_LEVEL else None),
+                transform=transform,
+            )
             self._reset_output()
 
     def _reset_output(self):
-        previous_output_file = self.output_file
         output_path = os.path.join(self.path, datetime.utcnow().isoformat())
+        self.writer.rotate(output_path)
 
-        # using synchronous open to avoid race condition
-        self.output_file = wrap(open(output_path, mode='bw'), loop=self.loop)
-
-        if previous_output_file:
-            self.loop.create_task(self._close_output(previous_output_file))
-
-    async def _close_output(self, previous_output_file):
-        pending_tasks = [task for task in asyncio.all_tasks(self.loop)
-                         if task._coro.cr_code.co_name == 'save_raw_data']
-        if pending_tasks:
-            await asyncio.wait(pending_tasks)
-        await previous_output_file.close()
-
-    async def save_raw_data(self, data):
-        await self.output_file.write(data)
-
-    def collect_data(self, data):
-        self.loop.create_task(self.save_raw_data(data))
+    def collect_data(self, data, weight=1):
+        # the archive keeps what was actually received, weights only
+        # matter for the aggregated stats
+        self.writer.append(data)
 
     def flush(self):
+        start_time = perf_counter()
         self._reset_output()
+        metrics.RAW_FLUSH_SECONDS.observe(perf_counter() - start_time)
 
     def stop(self):
-        self.loop.run_until_complete(self._close_output(self.output_file))
+        self.writer.close()
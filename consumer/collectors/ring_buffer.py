@@ -0,0 +1,340 @@
+import logging
+import signal
+import threading
+from itertools import groupby
+from multiprocessing import Pipe, Process
+from multiprocessing.shared_memory import SharedMemory
+from os import getenv
+from time import perf_counter, sleep
+
+import metrics
+
+from .stats_table import StatsTable
+
+
+# slots of every parser ring, a packet takes a whole slot
+RING_SLOTS = int(getenv('RING_SLOTS', 512))
+RING_SLOT_SIZE = int(getenv('RING_SLOT_SIZE', 2 ** 16))
+RING_BATCH_SIZE = int(getenv('RING_BATCH_SIZE', 64))
+RING_POLL_INTERVAL = float(getenv('RING_POLL_INTERVAL', 0.001))
+# parsers are terminated if they have not stopped in time
+RING_STOP_TIMEOUT = float(getenv('RING_STOP_TIMEOUT', 10))
+
+# the counters are kept in separate cache lines,
+# each one is only written by its own side
+HEAD = 0
+TAIL = 8
+CONTROL_SIZE = 128
+DATA_ALIGNMENT = 64
+
+FLUSH = 'flush'
+STOP = 'stop'
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class SharedRing:
+
+    # A single producer, single consumer ring of fixed size slots in
+    # shared memory. The producer publishes a slot by advancing the head
+    # after the slot is written, the consumer frees it by advancing the
+    # tail, so neither side needs a lock.
+
+    def __init__(self, slots=RING_SLOTS, slot_size=RING_SLOT_SIZE,
+                 name=None):
+        self.slots = slots
+        self.slot_size = slot_size
+
+        starts_offset = CONTROL_SIZE
+        weights_offset = starts_offset + 8 * slots
+        lengths_offset = weights_offset + 8 * slots
+        data_offset = (-(-(lengths_offset + 4 * slots) // DATA_ALIGNMENT) *
+                       DATA_ALIGNMENT)
+        size = data_offset + slots * slot_size
+
+        if name is None:
+            self.memory = SharedMemory(create=True, size=size)
+        else:
+            self.memory = SharedMemory(name)
+        self.name = self.memory.name
+
+        buffer = self.memory.buf
+        self.counters = buffer[:CONTROL_SIZE].cast('Q')
+        self.starts = buffer[starts_offset:weights_offset].cast('q')
+        self.weights = buffer[weights_offset:lengths_offset].cast('d')
+        self.lengths = buffer[lengths_offset:lengths_offset +
+                              4 * slots].cast('I')
+        self.data = buffer[data_offset:size]
+
+    def get_backlog(self):
+        counters = self.counters
+        return counters[HEAD] - counters[TAIL]
+
+    def put(self, data, start, weight=1):
+        # returns False when the ring is full
+        head = self.counters[HEAD]
+        if head - self.counters[TAIL] >= self.slots:
+            return False
+
+        slot = head % self.slots
+        size = len(data)
+        offset = slot * self.slot_size
+        self.data[offset:offset + size] = data
+        self.lengths[slot] = size
+        self.starts[slot] = start
+        self.weights[slot] = weight
+        self.counters[HEAD] = head + 1
+        return True
+
+    def read(self, count):
+        # yields (start, weight, packet view) of the oldest slots,
+        # they stay owned by the consumer until they are released
+        tail = self.counters[TAIL]
+        for sequence in range(tail, tail + count):
+            slot = sequence % self.slots
+            offset = slot * self.slot_size
+            yield (self.starts[slot], self.weights[slot],
+                   self.data[offset:offset + self.lengths[slot]])
+
+    def release(self, count):
+        self.counters[TAIL] += count
+
+    def close(self):
+        for view in (self.counters, self.starts, self.weights, self.lengths,
+                     self.data):
+            view.release()
+        self.memory.close()
+
+    def unlink(self):
+        self.memory.unlink()
+
+
+class _RingParser:
+
+    def __init__(self, ring, deserialize):
+        self.ring = ring
+        self.deserialize = deserialize
+        self.tables = {}
+        self.timings = [0, 0, 0, 0]
+        self.errors = 0
+
+    def process(self, limit=RING_BATCH_SIZE):
+        # returns the number of the processed packets
+        count = min(self.ring.get_backlog(), limit)
+        if not count:
+            return 0
+
+        # every batch is aggregated per window in one go
+        start_time = perf_counter()
+        deserialize = self.deserialize
+        packets = []
+        for start, weight, data in self.ring.read(count):
+            try:
+                packets.append((start, weight, deserialize(data)))
+            except Exception:
+                # a malformed packet must not take the parser down
+                self.errors += 1
+        decode_time = perf_counter()
+        self.ring.release(count)
+
+        events = 0
+        for start, group in groupby(packets, lambda packet: packet[0]):
+            group = list(group)
+            weights = [weight for _, weight, _ in group]
+            if all(weight == 1 for weight in weights):
+                weights = None
+            table = self.tables.get(start)
+            if table is None:
+                table = self.tables[start] = StatsTable()
+            events += self._add_packets(
+                table, [packet for _, _, packet in group], weights
+            )
+
+        timings = self.timings
+        timings[0] += count
+        timings[1] += decode_time - start_time
+        timings[2] += events
+        timings[3] += perf_counter() - decode_time
+        return count
+
+    def _add_packets(self, table, packets, weights):
+        try:
+            return table.add_packets(packets, weights)
+        except Exception:
+            pass
+
+        # packets are checked before the arrays are updated,
+        # so the batch is added again without the broken ones
+        events = 0
+        for index, packet in enumerate(packets):
+            try:
+                events += table.add_packets(
+                    [packet], None if weights is None else [weights[index]]
+                )
+            except Exception:
+                self.errors += 1
+        return events
+
+    def pop_results(self):
+        results = self.tables, self.timings, self.errors
+        self.tables = {}
+        self.timings = [0, 0, 0, 0]
+        self.errors = 0
+        return results
+
+
+def _run_parser(ring_name, slots, slot_size, connection, deserialize):
+    # the consumer process decides when to stop,
+    # the rings have to be drained first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    ring = SharedRing(slots, slot_size, ring_name)
+    parser = _RingParser(ring, deserialize)
+    try:
+        while True:
+            if parser.process():
+                if not connection.poll():
+                    continue
+            elif not connection.poll(RING_POLL_INTERVAL):
+                continue
+
+            try:
+                command = connection.recv()
+            except EOFError:
+                # the consumer process is gone
+                break
+            if command == STOP:
+                break
+            # the consumer keeps putting packets meanwhile, only those
+            # put before the flush are waited for
+            pending = ring.get_backlog()
+            while pending:
+                processed = parser.process(min(pending, RING_BATCH_SIZE))
+                if not processed:
+                    break
+                pending -= processed
+            connection.send(parser.pop_results())
+    finally:
+        ring.close()
+
+
+class RingParserPool:
+
+    # Packets are copied once into shared memory rings and parsed by
+    # processes reading them in place, nothing is pickled on the way.
+    # Each process owns a ring, packets are spread round-robin.
+
+    def __init__(self, deserialize, processes, slots=RING_SLOTS,
+                 slot_size=RING_SLOT_SIZE):
+        self.deserialize = deserialize
+        self.slot_size = slot_size
+        self.rings = [SharedRing(slots, slot_size) for _ in range(processes)]
+        self.connections = [None] * processes
+        self.processes = [None] * processes
+        # results are collected in another thread than
+        # the one putting packets, both may restart parsers
+        self.lock = threading.RLock()
+        for index in range(processes):
+            self._start_parser(index)
+        self.next_ring = 0
+
+        metrics.RING_OCCUPANCY.set_function(self.get_occupancy)
+
+    def _start_parser(self, index):
+        ring = self.rings[index]
+        connection, child_connection = Pipe()
+        process = Process(
+            target=_run_parser, daemon=True,
+            args=(ring.name, ring.slots, ring.slot_size, child_connection,
+                  self.deserialize)
+        )
+        process.start()
+        # only the parser keeps its end, so its exit is seen as EOF
+        child_connection.close()
+        self.connections[index] = connection
+        self.processes[index] = process
+
+    def _restart_exited(self):
+        # a new parser continues from the tail of the ring,
+        # the results of the exited one are lost
+        with self.lock:
+            for index, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                process.join()
+                logger.error('Stats parser %s has exited with code %s, '
+                             'it is restarted', process.pid, process.exitcode)
+                self.connections[index].close()
+                self._start_parser(index)
+
+    def get_occupancy(self):
+        backlog = sum(ring.get_backlog() for ring in self.rings)
+        return backlog / sum(ring.slots for ring in self.rings)
+
+    def put(self, data, start, weight=1):
+        # returns False for packets larger than a slot
+        if len(data) > self.slot_size:
+            return False
+
+        rings = self.rings
+        while True:
+            for _ in range(len(rings)):
+                ring = rings[self.next_ring]
+                self.next_ring = (self.next_ring + 1) % len(rings)
+                if ring.put(data, start, weight):
+                    return True
+            self._wait_for_slots()
+
+    def _wait_for_slots(self):
+        # blocking the loop on purpose: the kernel buffer takes
+        # the pressure instead of the memory of the consumer
+        start_time = perf_counter()
+        self._restart_exited()
+        sleep(RING_POLL_INTERVAL)
+        metrics.RING_STALL_SECONDS.inc(perf_counter() - start_time)
+
+    def collect(self):
+        # returns (tables by window start, timings, errors) of every parser,
+        # blocks until they are received, so it is run off the loop
+        results = []
+        with self.lock:
+            requested = []
+            for connection in self.connections:
+                try:
+                    connection.send(FLUSH)
+                except OSError:
+                    continue
+                requested.append(connection)
+            for connection in requested:
+                try:
+                    results.append(connection.recv())
+                except (EOFError, OSError):
+                    pass
+            self._restart_exited()
+        return results
+
+    def stop(self):
+        # the shared memory is unlinked even if the parsers are gone
+        try:
+            for connection in self.connections:
+                try:
+                    connection.send(STOP)
+                except OSError:
+                    pass
+            for process in self.processes:
+                process.join(RING_STOP_TIMEOUT)
+                if process.is_alive():
+                    logger.error('Stats parser %s has not stopped in %s '
+                                 'seconds', process.pid, RING_STOP_TIMEOUT)
+                    process.terminate()
+                    process.join()
+        finally:
+            for connection in self.connections:
+                connection.close()
+            for ring in self.rings:
+                ring.unlink()
+            for ring in self.rings:
+                ring.close()
@@ -1,83 +1,338 @@
+import asyncio
 import logging
-import warnings
-from collections import Counter, defaultdict
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 from os import getenv
-from time import time
+from time import perf_counter, time
 
-from .base import BaseCollector
+import metrics
+from writers import InfluxDBWriter
 
-warnings.filterwarnings('ignore', module='aioinflux.compat')
-from aioinflux import InfluxDBClient  # noqa: E402
+from .base import BaseCollector
+from .ring_buffer import RingParserPool
+from .stats_table import StatsTable
+from .windows import WindowedStats
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-INFLUXDB_HOST = getenv('INFLUXDB_HOST', '127.0.0.1')
-INFLUXDB_PORT = int(getenv('INFLUXDB_PORT', 8086))
-INFLUXDB_DB = getenv('INFLUXDB_DB', 'highload-demo')
+STATS_PROCESSES = int(getenv('STATS_PROCESSES', 0))
+STATS_BATCH_SIZE = int(getenv('STATS_BATCH_SIZE', 32))
+STATS_MAX_IN_FLIGHT = int(getenv('STATS_MAX_IN_FLIGHT', 2 * STATS_PROCESSES))
+# STATS_PROCESSES parsers read packets from shared memory rings
+# instead of getting pickled batches
+STATS_RING = getenv('STATS_RING') == '1'
+
+_worker_deserialize = None
+
+
+def _init_worker(deserialize):
+    global _worker_deserialize
+    _worker_deserialize = deserialize
+
+    # the consumer process decides when to stop,
+    # results of the pending batches have to be merged first
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def aggregate_packets(packets, weights=None):
+    # timings are measured in the worker and accounted by the consumer
+    start_time = perf_counter()
+    deserialized = [_worker_deserialize(packet) for packet in packets]
+    decode_time = perf_counter()
+    table = StatsTable()
+    events = table.add_packets(deserialized, weights)
+    return (table, len(packets), decode_time - start_time, events,
+            perf_counter() - decode_time)
+
+
+def _account(packets, decode_time, events, aggregate_time):
+    metrics.DECODED_PACKETS.inc(packets)
+    metrics.DECODE_SECONDS.inc(decode_time)
+    metrics.AGGREGATED_EVENTS.inc(events)
+    metrics.AGGREGATE_SECONDS.inc(aggregate_time)
 
 
 class StatsCollector(BaseCollector):
 
-    count_stats = None
-    duration_stats = None
+    windows = None
+    executor = None
+    ring_pool = None
     enabled = getenv('COLLECT_STATS') == '1'
 
     def __init__(self, consumer, deserialize):
         super().__init__(consumer)
         if self.enabled:
             self.deserialize = deserialize
-            self._reset_stats()
-            self.influxdb_client = InfluxDBClient(host=INFLUXDB_HOST,
-                                                  db=INFLUXDB_DB,
-                                                  loop=self.loop)
-
-    def _reset_stats(self):
-        self.count_stats = defaultdict(Counter)
-        self.duration_stats = defaultdict(Counter)
-
-    def collect_data(self, data):
-        data = self.deserialize(data)
-        country = data['country']
-
-        count_stats = self.count_stats[country]
-        duration_stats = self.duration_stats[country]
-
-        for event in data['events']:
-            event_type = event['type']
-            count_stats[event_type] += 1
-            duration_stats[event_type] += event['duration']
-
-    def _get_stats(self):
-        timestamp = datetime.utcnow()
-        for country, country_count_stats in self.count_stats.items():
-            country_duration_stats = self.duration_stats[country]
-            for event_type, count in country_count_stats.items():
-                entry = {
-                    'time': timestamp,
-                    'measurement': 'events',
-                    'tags': {
-                        'consumer': self.consumer_id,
-                        'country': country,
-                        'event': event_type,
-                    },
-                    'fields': {
-                        'avg_time': country_duration_stats[event_type] / count,
-                        'count': count,
-                    },
-                }
-                yield entry
-
-    def flush(self):
+            # packets are assigned to windows by their arrival time,
+            # the clock is replaced to replay archived data
+            self.clock = time
+            self.windows = WindowedStats()
+            self.closed_tables = []
+            # points of the closed windows are built and serialized
+            # in order by a single thread, the loop only swaps tables
+            self.flush_executor = ThreadPoolExecutor(
+                1, thread_name_prefix='stats-flush'
+            )
+            # flushes and shipping of their points
+            self.tasks = set()
+            self.flush_task = None
+            if STATS_RING:
+                self.ring_pool = RingParserPool(deserialize,
+                                                max(STATS_PROCESSES, 1))
+            elif STATS_PROCESSES:
+                self.executor = ProcessPoolExecutor(
+                    STATS_PROCESSES,
+                    initializer=_init_worker, initargs=(deserialize,)
+                )
+                self.pending_packets = []
+                self.pending_weights = []
+                self.pending_start = None
+                self.in_flight = deque()
+            self.influxdb_writer = InfluxDBWriter(self.loop)
+
+    def _get_table(self):
+        start = self.windows.get_start(self.clock())
+        return self.windows.get_table(start, self._emit)
+
+    def collect_data(self, data, weight=1):
+        if self.ring_pool:
+            start = self.windows.get_start(self.clock())
+            if self.ring_pool.put(data, start, weight):
+                return
+        elif self.executor:
+            self._offload_data(data, weight)
+            return
+
+        start_time = perf_counter()
+        packet = self.deserialize(data)
+        decode_time = perf_counter()
+        events = self._get_table().add_packets(
+            (packet,), None if weight == 1 else (weight,)
+        )
+        _account(1, decode_time - start_time, events,
+                 perf_counter() - decode_time)
+
+    def collect_batch(self, batch, weights=None):
+        if self.ring_pool:
+            self._put_ring_batch(batch, weights)
+        elif self.executor:
+            if weights is None:
+                for data in batch:
+                    self._offload_data(data)
+            else:
+                for data, weight in zip(batch, weights):
+                    self._offload_data(data, weight)
+        else:
+            start_time = perf_counter()
+            deserialize = self.deserialize
+            packets = [deserialize(data) for data in batch]
+            decode_time = perf_counter()
+            events = self._get_table().add_packets(packets, weights)
+            _account(len(packets), decode_time - start_time, events,
+                     perf_counter() - decode_time)
+
+    def _put_ring_batch(self, batch, weights):
+        start = self.windows.get_start(self.clock())
+        put = self.ring_pool.put
+        if weights is None:
+            weights = [1] * len(batch)
+        for data, weight in zip(batch, weights):
+            if not put(data, start, weight):
+                # larger than a slot, aggregated right here
+                self.collect_data(data, weight)
+
+    def _offload_data(self, data, weight=1):
+        # a batch never spans several windows
+        start = self.windows.get_start(self.clock())
+        if start != self.pending_start:
+            if self.pending_packets:
+                self._submit_pending_packets()
+            self.pending_start = start
+
+        # packets may refer to reusable receive buffers
+        self.pending_packets.append(bytes(data))
+        self.pending_weights.append(weight)
+        if len(self.pending_packets) >= STATS_BATCH_SIZE:
+            self._submit_pending_packets()
+
+    def _submit_pending_packets(self):
+        in_flight = self.in_flight
+        while in_flight and in_flight[0][0].done():
+            self._merge_result(*in_flight.popleft())
+
+        if len(in_flight) >= max(STATS_MAX_IN_FLIGHT, 1):
+            # blocking the loop on purpose: the kernel buffer takes
+            # the pressure instead of the memory of the consumer
+            self._merge_result(*in_flight.popleft())
+
+        weights = self.pending_weights
+        if all(weight == 1 for weight in weights):
+            weights = None
+        future = self.executor.submit(aggregate_packets,
+                                      self.pending_packets, weights)
+        in_flight.append((future, self.pending_start))
+        self.pending_packets = []
+        self.pending_weights = []
+
+    def _merge_result(self, future, start):
+        try:
+            table, *timings = future.result()
+        except Exception:
+            logger.exception('Stats aggregation has failed')
+            return
+
+        self.merge_table(start, table)
+        _account(*timings)
+
+    async def _merge_ring_results(self):
+        # the parsers are waited for off the loop, their tables are
+        # merged on it, so the open windows have a single writer
+        try:
+            results = await self.loop.run_in_executor(None,
+                                                      self.ring_pool.collect)
+        except Exception:
+            logger.exception('Stats parsing has failed')
+            return
+
+        for tables, timings, errors in results:
+            for start, table in tables.items():
+                self.merge_table(start, table)
+            _account(*timings)
+            if errors:
+                metrics.UNDECODABLE_PACKETS.inc(errors)
+                logger.warning('%s packets could not be parsed', errors)
+
+    def merge_table(self, start, table):
+        if self.windows.is_closed(start):
+            logger.warning('Stats of the closed window of %s were merged '
+                           'into a reopened one', start)
+        self.windows.get_table(start, self._emit).merge(table)
+
+    async def _merge_in_flight(self):
+        if self.pending_packets:
+            self._submit_pending_packets()
+        # batches submitted meanwhile are merged by the next flush
+        in_flight, self.in_flight = self.in_flight, deque()
+        for future, start in in_flight:
+            await asyncio.wait([asyncio.wrap_future(future)])
+            self._merge_result(future, start)
+
+    def _emit(self, level, label, start, table):
+        # the first level keeps the original measurement names
+        suffix = f'_{label}' if level else ''
+        timestamp = datetime.utcfromtimestamp(start)
+        self.closed_tables.append((table, timestamp, suffix))
+
+    def _serialize(self, closed_tables):
+        # runs in the flush thread, the closed tables
+        # are not used by the loop until they are recycled
+        start_time = perf_counter()
+        entries = []
+        for table, timestamp, suffix in closed_tables:
+            entries.extend(self._get_stats(table, timestamp, suffix))
+            self.windows.recycle(table)
+        bodies = self.influxdb_writer.serialize(entries)
+        return bodies, len(entries), perf_counter() - start_time
+
+    async def _ship(self, closed_tables):
+        try:
+            bodies, points, duration = await self.loop.run_in_executor(
+                self.flush_executor, self._serialize, closed_tables
+            )
+        except Exception:
+            logger.exception('Stats serialization has failed')
+            return
+
+        metrics.STATS_SERIALIZE_SECONDS.observe(duration)
+        logger.info(f'{points} stat points of {len(closed_tables)} windows '
+                    f'were serialized in {duration:.03f} seconds')
+        if bodies:
+            await self.influxdb_writer.write_bodies(bodies)
+
+    def _get_stats(self, table, timestamp, suffix=''):
+        for (country, event_type, count, duration, maximum, quantiles,
+             users) in table.items():
+            p50, p90, p99 = quantiles
+            entry = {
+                'time': timestamp,
+                'measurement': 'events' + suffix,
+                'tags': {
+                    'consumer': self.consumer_id,
+                    'country': country,
+                    'event': event_type,
+                },
+                'fields': {
+                    'avg_time': duration / count,
+                    'count': round(count),
+                    'p50': p50,
+                    'p90': p90,
+                    'p99': p99,
+                    'max': maximum,
+                },
+            }
+            if users is not None:
+                entry['fields']['users'] = round(users)
+            yield entry
+
+        for country, users in table.users_items():
+            yield {
+                'time': timestamp,
+                'measurement': 'users' + suffix,
+                'tags': {
+                    'consumer': self.consumer_id,
+                    'country': country,
+                },
+                'fields': {
+                    'distinct': round(users),
+                },
+            }
+
+    def _start_task(self, coroutine):
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def flush(self, final=False):
+        # only the windows closed by now are written, the final flush
+        # closes all of them; flushes are completed in order
+        self.flush_task = self._start_task(
+            self._flush(self.flush_task, self.clock(), final)
+        )
+
+    async def _flush(self, previous_task, timestamp, final):
+        if previous_task is not None:
+            await asyncio.wait([previous_task])
+
         start_time = time()
-        for entry in self._get_stats():
-            self.loop.create_task(self.influxdb_client.write(entry))
-        self._reset_stats()
+        try:
+            if self.ring_pool:
+                await self._merge_ring_results()
+            elif self.executor:
+                await self._merge_in_flight()
+            self.windows.close(timestamp, self._emit, final)
+        except Exception:
+            logger.exception('Stats flushing has failed')
+        closed_tables, self.closed_tables = self.closed_tables, []
+        if closed_tables:
+            self._start_task(self._ship(closed_tables))
         duration = time() - start_time
-        logger.info(f'Stat flushing scheduled in {duration:.03f} seconds')
+        metrics.STATS_FLUSH_SECONDS.observe(duration)
+        logger.info(f'{len(closed_tables)} stat windows were swapped out '
+                    f'in {duration:.03f} seconds')
 
     def stop(self):
-        self.loop.run_until_complete(self.influxdb_client.close())
+        # flushes may start shipping tasks
+        while self.tasks:
+            self.loop.run_until_complete(asyncio.wait(set(self.tasks)))
+        if self.ring_pool:
+            self.ring_pool.stop()
+        elif self.executor:
+            self.executor.shutdown()
+        self.flush_executor.shutdown()
+        self.loop.run_until_complete(self.influxdb_writer.close())
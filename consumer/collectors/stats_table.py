@@ -0,0 +1,329 @@
+from itertools import repeat
+
+import numpy as np
+
+from serialization import BinaryPacket
+
+from . import ddsketch, hyperloglog
+
+
+INITIAL_CAPACITY = 64
+# arrays indexed by (country, event) cells
+CELL_ARRAYS = 'counts', 'durations', 'maxima', 'sketches'
+# mostly empty for a batch of packets, only non-zero values are pickled
+SPARSE_ARRAYS = 'sketches', 'users', 'event_users'
+
+
+class Interner(dict):
+
+    # maps names to small persistent integer identifiers,
+    # lookups of known names stay within the C dict implementation
+
+    def __init__(self):
+        super().__init__()
+        self.names = []
+
+    def __missing__(self, name):
+        identifier = self[name] = len(self.names)
+        self.names.append(name)
+        return identifier
+
+
+def _add_at(array, indexes, values=None):
+    # np.add.at is many times faster with flat indexes
+    # and values of the type of the array
+    if values is None:
+        values = np.ones(len(indexes), dtype=array.dtype)
+    np.add.at(array.reshape(-1), indexes,
+              values.astype(array.dtype, copy=False))
+
+
+def _to_sparse(array):
+    values = array.ravel()
+    indexes = np.flatnonzero(values)
+    if array.size <= 2 ** 32:
+        indexes = indexes.astype(np.uint32)
+    return array.shape, indexes, values[indexes]
+
+
+def _from_sparse(shape, indexes, values):
+    array = np.zeros(shape, dtype=values.dtype)
+    array.reshape(-1)[indexes] = values
+    return array
+
+
+class StatsTable:
+
+    def __init__(self):
+        self.countries = Interner()
+        self.events = Interner()
+        shape = INITIAL_CAPACITY, INITIAL_CAPACITY
+        # counts are estimates once sampled packets are weighted
+        self.counts = np.zeros(shape, dtype=np.float64)
+        self.durations = np.zeros(shape, dtype=np.float64)
+        self.maxima = np.zeros(shape, dtype=np.float64)
+        # a fixed size DDSketch of durations per cell
+        self.sketches = np.zeros(shape + (ddsketch.SKETCH_BINS,),
+                                 dtype=np.float32)
+        # HyperLogLog registers of distinct users per country
+        # and optionally per cell
+        self.users = np.zeros((INITIAL_CAPACITY,
+                               2 ** hyperloglog.HLL_PRECISION),
+                              dtype=np.uint8)
+        self.event_users = None
+        self.cell_arrays = CELL_ARRAYS
+        if hyperloglog.HLL_PER_EVENT:
+            self.event_users = np.zeros(
+                shape + (2 ** hyperloglog.HLL_EVENT_PRECISION,),
+                dtype=np.uint8
+            )
+            self.cell_arrays += 'event_users',
+        # translations of the identifiers of binary packets by the version
+        # of their dictionary, -1 stands for names not interned yet
+        self.translations = {}
+
+    def __getstate__(self):
+        # tables of the stats processes are pickled without the spare capacity
+        state = self.__dict__.copy()
+        rows = max(len(self.countries.names), 1)
+        columns = max(len(self.events.names), 1)
+        for name in self.cell_arrays:
+            state[name] = state[name][:rows, :columns].copy()
+        state['users'] = self.users[:rows].copy()
+        for name in SPARSE_ARRAYS:
+            if state[name] is not None:
+                state[name] = _to_sparse(state[name])
+        return state
+
+    def __setstate__(self, state):
+        for name in SPARSE_ARRAYS:
+            if state[name] is not None:
+                state[name] = _from_sparse(*state[name])
+        self.__dict__.update(state)
+
+    def _reserve(self):
+        rows, columns = self.counts.shape
+        required_rows = len(self.countries.names)
+        required_columns = len(self.events.names)
+        if required_rows <= rows and required_columns <= columns:
+            return
+
+        while rows < required_rows:
+            rows *= 2
+        while columns < required_columns:
+            columns *= 2
+
+        for name in self.cell_arrays:
+            array = getattr(self, name)
+            grown = np.zeros((rows, columns) + array.shape[2:],
+                             dtype=array.dtype)
+            grown[:array.shape[0], :array.shape[1]] = array
+            setattr(self, name, grown)
+
+        users = np.zeros((rows,) + self.users.shape[1:], dtype=np.uint8)
+        users[:self.users.shape[0]] = self.users
+        self.users = users
+
+    def add_packets(self, packets, weights=None):
+        if packets and isinstance(packets[0], BinaryPacket):
+            return self._add_binary_packets(packets, weights)
+
+        countries = self.countries
+        events = self.events
+
+        country_ids = []
+        event_ids = []
+        durations = []
+        event_weights = [] if weights is not None else None
+        users = []
+        user_country_ids = []
+        events_counts = []
+        has_users = []
+        for index, data in enumerate(packets):
+            packet_events = data['events']
+            country_id = countries[data['country']]
+            country_ids.extend(repeat(country_id, len(packet_events)))
+            event_ids.extend([events[event['type']]
+                              for event in packet_events])
+            durations.extend([event['duration'] for event in packet_events])
+            if event_weights is not None:
+                event_weights.extend(repeat(weights[index],
+                                            len(packet_events)))
+
+            user = data.get('user')
+            events_counts.append(len(packet_events))
+            has_users.append(user is not None)
+            if user is not None:
+                users.append(user)
+                user_country_ids.append(country_id)
+
+        if not (country_ids or users):
+            return 0
+
+        self._reserve()
+        if users:
+            self._add_users(hyperloglog.hash_users(users), user_country_ids,
+                            event_ids, events_counts, has_users)
+        if not country_ids:
+            return 0
+
+        return self._add_events(
+            np.array(country_ids, dtype=np.intp),
+            np.array(event_ids, dtype=np.intp),
+            np.array(durations, dtype=np.float64),
+            None if event_weights is None
+            else np.array(event_weights, dtype=np.float64)
+        )
+
+    def _add_binary_packets(self, packets, weights=None):
+        # events stay in arrays all the way, only packets are iterated
+        dictionary = packets[0].dictionary
+        translation = self.translations.get(dictionary.version)
+        if translation is None:
+            translation = self.translations[dictionary.version] = (
+                np.full(len(dictionary.countries), -1, dtype=np.intp),
+                np.full(len(dictionary.events), -1, dtype=np.intp),
+            )
+        country_map, event_map = translation
+
+        events = np.concatenate([packet.events for packet in packets])
+        events_counts = np.array([len(packet.events) for packet in packets],
+                                 dtype=np.intp)
+        packet_country_ids = self._translate(
+            np.array([packet.country for packet in packets], dtype=np.intp),
+            country_map, dictionary.countries, self.countries
+        )
+        event_ids = self._translate(events['event'].astype(np.intp),
+                                    event_map, dictionary.events, self.events)
+
+        self._reserve()
+        country_ids = np.repeat(packet_country_ids, events_counts)
+        self._add_users(
+            hyperloglog.hash_uuid_bytes(b''.join(packet.user
+                                                 for packet in packets)),
+            packet_country_ids, event_ids, events_counts,
+            np.ones(len(packets), dtype=bool)
+        )
+        if not len(events):
+            return 0
+
+        event_weights = None
+        if weights is not None:
+            event_weights = np.repeat(np.array(weights, dtype=np.float64),
+                                      events_counts)
+        return self._add_events(country_ids, event_ids, events['duration'],
+                                event_weights)
+
+    @staticmethod
+    def _translate(ids, mapping, names, interner):
+        translated = mapping[ids]
+        missing = translated < 0
+        if missing.any():
+            for identifier in np.unique(ids[missing]):
+                mapping[identifier] = interner[names[identifier]]
+            translated = mapping[ids]
+        return translated
+
+    def _add_events(self, country_ids, event_ids, durations,
+                    event_weights=None):
+        columns = self.counts.shape[1]
+        cells = country_ids * columns + event_ids
+        durations = np.ascontiguousarray(durations)
+        bins = cells * ddsketch.SKETCH_BINS + ddsketch.get_bins(durations)
+        np.maximum.at(self.maxima.reshape(-1), cells, durations)
+        if event_weights is not None:
+            # every sampled packet stands for 1 / sampling rate packets
+            durations = durations * event_weights
+        _add_at(self.counts, cells, event_weights)
+        _add_at(self.durations, cells, durations)
+        _add_at(self.sketches, bins, event_weights)
+        return len(country_ids)
+
+    def _add_users(self, hashes, country_ids, event_ids, events_counts,
+                   has_users):
+        # distinct users are not scaled by the weights of sampled packets
+        indexes, ranks = hyperloglog.get_registers(
+            hashes, hyperloglog.HLL_PRECISION
+        )
+        np.maximum.at(self.users, (country_ids, indexes), ranks)
+
+        if self.event_users is None:
+            return
+
+        events_counts = np.array(events_counts, dtype=np.intp)
+        has_users = np.array(has_users, dtype=bool)
+        # events of the packets without users are skipped
+        selected = np.repeat(has_users, events_counts)
+        counts = events_counts[has_users]
+        indexes, ranks = hyperloglog.get_registers(
+            hashes, hyperloglog.HLL_EVENT_PRECISION
+        )
+        cells = (np.repeat(country_ids, counts),
+                 np.array(event_ids, dtype=np.intp)[selected],
+                 np.repeat(indexes, counts))
+        np.maximum.at(self.event_users, cells, np.repeat(ranks, counts))
+
+    def merge(self, other):
+        # identifiers of the other table are translated into ours
+        country_ids = [self.countries[name] for name in other.countries.names]
+        event_ids = [self.events[name] for name in other.events.names]
+        if not country_ids:
+            return
+
+        self._reserve()
+        rows, columns = len(country_ids), len(event_ids)
+        self.users[country_ids] = np.maximum(self.users[country_ids],
+                                             other.users[:rows])
+        if not event_ids:
+            return
+
+        cells = np.ix_(country_ids, event_ids)
+        self.counts[cells] += other.counts[:rows, :columns]
+        self.durations[cells] += other.durations[:rows, :columns]
+        self.maxima[cells] = np.maximum(self.maxima[cells],
+                                        other.maxima[:rows, :columns])
+        self.sketches[cells] += other.sketches[:rows, :columns]
+        if self.event_users is not None:
+            self.event_users[cells] = np.maximum(
+                self.event_users[cells], other.event_users[:rows, :columns]
+            )
+
+    def reset(self):
+        # identifiers and allocated arrays are kept between intervals
+        for name in self.cell_arrays:
+            getattr(self, name).fill(0)
+        self.users.fill(0)
+
+    def items(self):
+        rows = len(self.countries.names)
+        columns = len(self.events.names)
+        counts = self.counts[:rows, :columns]
+        durations = self.durations[:rows, :columns]
+
+        maxima = self.maxima
+        sketches = self.sketches
+        event_users = None
+        if self.event_users is not None:
+            event_users = hyperloglog.estimate(
+                self.event_users[:rows, :columns]
+            )
+
+        country_names = self.countries.names
+        event_names = self.events.names
+        for country_id, event_id in zip(*np.nonzero(counts)):
+            maximum = float(maxima[country_id, event_id])
+            yield (country_names[country_id], event_names[event_id],
+                   float(counts[country_id, event_id]),
+                   float(durations[country_id, event_id]), maximum,
+                   ddsketch.get_quantiles(sketches[country_id, event_id],
+                                          maximum),
+                   None if event_users is None
+                   else float(event_users[country_id, event_id]))
+
+    def users_items(self):
+        rows = len(self.countries.names)
+        users = self.users[:rows]
+        estimates = hyperloglog.estimate(users)
+        country_names = self.countries.names
+        for country_id in np.flatnonzero(users.any(axis=1)):
+            yield country_names[country_id], float(estimates[country_id])
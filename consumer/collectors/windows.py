@@ -0,0 +1,124 @@
+import logging
+from collections import deque
+from math import ceil
+from os import getenv
+
+from .stats_table import StatsTable
+
+
+# tumbling windows aligned to the epoch, every next size is rolled up
+# from the previous one, so it has to be a multiple of it
+STATS_WINDOWS = [int(size) for size in
+                 getenv('STATS_WINDOWS', '10,60,3600').split(',') if size]
+# windows are closed this many seconds after their end
+STATS_GRACE = float(getenv('STATS_GRACE', 2))
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def format_size(size):
+    if size % 3600 == 0:
+        return f'{size // 3600}h'
+    if size % 60 == 0:
+        return f'{size // 60}m'
+    return f'{size}s'
+
+
+class WindowLevel:
+
+    # a ring of preallocated tables, one per open window
+
+    def __init__(self, size, grace):
+        self.size = size
+        self.label = format_size(size)
+        slots = ceil(grace / size) + 2
+        self.tables = [StatsTable() for _ in range(slots)]
+        self.starts = [None] * slots
+
+    def get_slot(self, start):
+        return start // self.size % len(self.tables)
+
+    def open_starts(self):
+        return sorted(start for start in self.starts if start is not None)
+
+
+class WindowedStats:
+
+    def __init__(self, sizes=STATS_WINDOWS, grace=STATS_GRACE):
+        for size, next_size in zip(sizes, sizes[1:]):
+            if next_size % size:
+                raise ValueError(f'{next_size} seconds window can not be '
+                                 f'rolled up from {size} seconds windows')
+
+        self.grace = grace
+        self.levels = [WindowLevel(size, grace) for size in sizes]
+        self.last_closed_start = None
+        # closed tables are replaced with spare ones and come back
+        # once their stats are written, possibly from another thread
+        self.spare_tables = deque()
+
+    def get_start(self, timestamp):
+        size = self.levels[0].size
+        return int(timestamp // size * size)
+
+    def get_table(self, start, emit):
+        # tables of the first level are filled with the packets
+        return self._get_table(0, start, emit)
+
+    def is_closed(self, start):
+        # windows are closed in order, so anything up to
+        # the last closed one has been written already
+        return (self.last_closed_start is not None and
+                start <= self.last_closed_start)
+
+    def _get_table(self, level_index, start, emit):
+        level = self.levels[level_index]
+        slot = level.get_slot(start)
+        current_start = level.starts[slot]
+        if current_start != start:
+            if current_start is not None:
+                # the ring is too small for the flush interval,
+                # the previous window is closed before its time
+                logger.warning('%s window of %s has been closed early',
+                               level.label, current_start)
+                self._close(level_index, slot, emit)
+            level.starts[slot] = start
+        return level.tables[slot]
+
+    def close(self, timestamp, emit, final=False):
+        # levels are closed from the finest one, so rollups
+        # have all their windows merged before they are closed
+        for level_index, level in enumerate(self.levels):
+            for start in level.open_starts():
+                if final or start + level.size + self.grace <= timestamp:
+                    self._close(level_index, level.get_slot(start), emit)
+
+    def _close(self, level_index, slot, emit):
+        # the rollup is merged on the loop right away, so open windows
+        # are never written by other threads; emit takes over the closed
+        # table until it is recycled
+        level = self.levels[level_index]
+        start = level.starts[slot]
+        table = level.tables[slot]
+        if not level_index and (self.last_closed_start is None or
+                                start > self.last_closed_start):
+            self.last_closed_start = start
+
+        if level_index + 1 < len(self.levels):
+            next_size = self.levels[level_index + 1].size
+            next_start = start // next_size * next_size
+            self._get_table(level_index + 1, next_start, emit).merge(table)
+        emit(level_index, level.label, start, table)
+
+        level.starts[slot] = None
+        try:
+            level.tables[slot] = self.spare_tables.popleft()
+        except IndexError:
+            level.tables[slot] = StatsTable()
+
+    def recycle(self, table):
+        # identifiers and allocated arrays are kept
+        table.reset()
+        self.spare_tables.append(table)
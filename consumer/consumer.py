@@ -1,46 +1,80 @@
 import asyncio
 import logging
 import os
+import signal
+import socket
+import zlib
 from time import time
 from uuid import uuid4
-from functools import partial
 
-import msgpack
-import ujson
-
-from protocols import UDPProtocol
+import metrics
+from admission import ADMISSION, AdmissionFilter
+from protocols import (
+    BatchUDPProtocol, TCPProtocol, UDPProtocol, UnixDatagramProtocol,
+    UnixStreamProtocol
+)
 from collectors import RawDataCollector, StatsCollector
+from ingest import INGEST_QUEUE_SIZE, IngestQueue
+from serialization import get_deserializer
+from supervisor import Supervisor, get_worker_metrics_port
 
 
-STORE_INTERVAL = 10
+STORE_INTERVAL = float(os.getenv('STORE_INTERVAL', 10))
+# flushes of the workers are spread over this fraction of STORE_INTERVAL,
+# 0 keeps every worker flushing relative to its own start
+FLUSH_JITTER = float(os.getenv('FLUSH_JITTER', 0))
 DATA_FORMAT = os.getenv('DATA_FORMAT', 'msgpack')
+SELECTIVE_DECODE = os.getenv('SELECTIVE_DECODE') == '1'
+PROTOCOL = os.getenv('PROTOCOL', 'udp')
+PROTOCOLS = {
+    'udp': UDPProtocol,
+    'udp-batch': BatchUDPProtocol,
+    'tcp': TCPProtocol,
+    'unix': UnixStreamProtocol,
+    'unix-dgram': UnixDatagramProtocol,
+}
+# a unix socket path can not be shared by several workers
+SINGLE_WORKER_PROTOCOLS = 'unix', 'unix-dgram'
+WORKERS = int(os.getenv('WORKERS', 1))
 
 
 class Consumer:
 
-    def __init__(self, protocol_class):
+    def __init__(self, protocol_class, report_rate=None,
+                 metrics_port=metrics.METRICS_PORT, worker_index=0):
         self.logger = self.configure_logging()
+        self.report_rate = report_rate
+        self.metrics_port = metrics_port
+        self.flush_offset = get_flush_offset(worker_index)
+        self.metrics_server = None
+        self.loop_lag_task = None
 
         self.loop = asyncio.get_event_loop()
         self.protocol = protocol_class(self)
 
         self._stop = False
+        self._stop_requested = False
         self.collecting_task = None
         self.sleeping_task = None
         self.consumer_id = str(uuid4())
 
-        self.raw_data_collector = RawDataCollector(self)
+        self.raw_data_collector = RawDataCollector(self, DATA_FORMAT)
 
-        if DATA_FORMAT == 'msgpack':
-            deserialize = partial(msgpack.loads, raw=False)
-        elif DATA_FORMAT == 'json':
-            deserialize = ujson.loads
-        else:
-            raise ValueError(f'{DATA_FORMAT} format is not supported')
+        deserialize = get_deserializer(DATA_FORMAT, SELECTIVE_DECODE)
         self.stats_collector = StatsCollector(self, deserialize)
 
+        # the protocols check packets before passing them on
+        self.admission_filter = None
+        if ADMISSION:
+            self.admission_filter = AdmissionFilter(DATA_FORMAT)
+
+        self.ingest_queue = None
+        if INGEST_QUEUE_SIZE:
+            self.ingest_queue = IngestQueue(self)
+
         self.consumed_count = 0
         self.last_flush_time = time()
+        self.kernel_drops = None
 
         self.logger.info('EventConsumer has been started: %s, pid: %s',
                          self.consumer_id, os.getpid())
@@ -54,17 +88,34 @@ class Consumer:
 
     def run(self):
         self.protocol.start()
+        if self.metrics_port:
+            self.metrics_server = metrics.start_server(self.loop,
+                                                       self.metrics_port)
+        self.loop_lag_task = self.loop.create_task(metrics.measure_loop_lag())
         self.loop.create_task(self.collect_stats_and_data())
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.request_stop)
 
         try:
             self.loop.run_forever()
         except KeyboardInterrupt:
-            self.stop()
+            pass
+        self.stop()
+
+    def request_stop(self):
+        # the same signal may come both from the terminal
+        # and from the supervisor, so only the first one counts
+        if not self._stop_requested:
+            self._stop_requested = True
+            self.loop.stop()
 
     def stop(self):
         self._stop = True
         self.protocol.stop()
         self.sleeping_task.cancel()
+        self.loop_lag_task.cancel()
+        if self.metrics_server:
+            self.metrics_server.close()
         loop = self.loop
 
         def run_pending_tasks():
@@ -73,7 +124,9 @@ class Consumer:
                 loop.run_until_complete(asyncio.wait(pending_tasks))
 
         run_pending_tasks()
-        self.stats_collector.flush()
+        if self.ingest_queue:
+            self.ingest_queue.drain()
+        self.stats_collector.flush(final=True)
         self.raw_data_collector.stop()
 
         run_pending_tasks()
@@ -85,7 +138,7 @@ class Consumer:
             collectors = self.raw_data_collector, self.stats_collector
 
             self.sleeping_task = self.loop.create_task(
-                asyncio.sleep(STORE_INTERVAL)
+                asyncio.sleep(self.get_flush_delay())
             )
             try:
                 await self.sleeping_task
@@ -109,15 +162,101 @@ class Consumer:
             self.logger.info(
                 f'{self.consumed_count} packets were consumed in '
                 f'{duration:.03f} seconds at {rate:.02f} average pps'
+                f'{self._format_admission_counters()}'
+                f'{self._format_ingest_counters()}'
+                f'{self._format_kernel_drops()}'
             )
+            if self.report_rate:
+                self.report_rate(rate)
             self.consumed_count = 0
             self.last_flush_time = current_time
 
+    def get_flush_delay(self):
+        if not FLUSH_JITTER:
+            return STORE_INTERVAL
+        # flushes are aligned to the interval and shifted by the offset
+        return STORE_INTERVAL - (time() - self.flush_offset) % STORE_INTERVAL
+
+    def _format_admission_counters(self):
+        if not self.admission_filter:
+            return ''
+        return f', {self.admission_filter.pop_rejected()} rejected'
+
+    def _format_ingest_counters(self):
+        if not self.ingest_queue:
+            return ''
+
+        accepted, dropped, sampled = self.ingest_queue.pop_counters()
+        return (f', ingest: {accepted} accepted, {dropped} dropped, '
+                f'{sampled} sampled out')
+
+    def _format_kernel_drops(self):
+        kernel_drops = self.protocol.get_kernel_drops()
+        if kernel_drops is None:
+            return ''
+
+        previous_kernel_drops = self.kernel_drops
+        self.kernel_drops = kernel_drops
+        if previous_kernel_drops is None:
+            return f', {kernel_drops} dropped by kernel since start'
+        return f', {kernel_drops - previous_kernel_drops} dropped by kernel'
+
     def consume_packet(self, packet):
+        metrics.RECEIVED_PACKETS.inc()
+        metrics.RECEIVED_BYTES.inc(len(packet))
+        if self.ingest_queue:
+            self.ingest_queue.put(packet)
+            return
+
         self.raw_data_collector.collect_data(packet)
         self.stats_collector.collect_data(packet)
         self.consumed_count += 1
 
+    def consume_batch(self, packets):
+        metrics.RECEIVED_PACKETS.inc(len(packets))
+        metrics.RECEIVED_BYTES.inc(sum(map(len, packets)))
+        if self.ingest_queue:
+            self.ingest_queue.put_batch(packets)
+            return
+
+        self.process_batch(packets)
+
+    def process_batch(self, packets, weights=None):
+        self.raw_data_collector.collect_batch(packets)
+        self.stats_collector.collect_batch(packets, weights)
+        self.consumed_count += len(packets)
+
+
+def get_flush_offset(worker_index):
+    # the same for a worker across restarts; the workers of a host
+    # are spread evenly and the hosts are shifted against each other
+    host_shift = zlib.crc32(socket.gethostname().encode()) / 2 ** 32
+    share = (host_shift + worker_index / WORKERS) % 1
+    return share * FLUSH_JITTER * STORE_INTERVAL
+
+
+def get_protocol_class():
+    try:
+        protocol_class = PROTOCOLS[PROTOCOL]
+    except KeyError:
+        raise ValueError(f'{PROTOCOL} protocol is not supported')
+    if WORKERS > 1 and PROTOCOL in SINGLE_WORKER_PROTOCOLS:
+        raise ValueError(f'{PROTOCOL} protocol is served by a single worker')
+    return protocol_class
+
+
+def run_worker(worker_index, report_rate):
+    metrics_port = (get_worker_metrics_port(worker_index)
+                    if metrics.METRICS_PORT else 0)
+    Consumer(get_protocol_class(), report_rate, metrics_port,
+             worker_index).run()
+
 
 if __name__ == '__main__':
-    Consumer(UDPProtocol).run()
+    # fails before any worker is spawned
+    protocol_class = get_protocol_class()
+    if WORKERS > 1:
+        Consumer.configure_logging()
+        Supervisor(WORKERS, run_worker, STORE_INTERVAL).run()
+    else:
+        Consumer(protocol_class).run()
@@ -0,0 +1,155 @@
+import logging
+import os
+import random
+from collections import deque
+from time import perf_counter
+
+import metrics
+
+
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 0))
+INGEST_POLICY = os.getenv('INGEST_POLICY', 'drop-newest')
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 64))
+# seconds of processing per loop iteration, the socket is read in between;
+# it has to be shorter than the receive buffer takes to fill up, otherwise
+# the overload is dropped by the kernel instead of the policy
+INGEST_DRAIN_BUDGET = float(os.getenv('INGEST_DRAIN_BUDGET', 0.002))
+# datagrams the protocols read per loop iteration into the queue
+INGEST_RECEIVE_BATCH = int(os.getenv('INGEST_RECEIVE_BATCH', 1024))
+# sampling starts when the queue gets fuller than this fraction
+INGEST_SAMPLING_THRESHOLD = float(os.getenv('INGEST_SAMPLING_THRESHOLD', 0.5))
+INGEST_MIN_SAMPLING_RATE = float(os.getenv('INGEST_MIN_SAMPLING_RATE', 0.01))
+
+DROP_NEWEST = 'drop-newest'
+DROP_OLDEST = 'drop-oldest'
+SAMPLE = 'sample'
+POLICIES = DROP_NEWEST, DROP_OLDEST, SAMPLE
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class IngestQueue:
+
+    # decouples receiving from collecting: datagrams are queued by the
+    # protocol and processed in batches by loop callbacks, so the socket
+    # keeps being drained and the overload policy decides what is lost
+
+    def __init__(self, consumer, size=INGEST_QUEUE_SIZE,
+                 policy=INGEST_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f'{policy} ingest policy is not supported')
+
+        self.consumer = consumer
+        self.loop = consumer.loop
+        self.size = size
+        self.policy = policy
+        self.sampling_threshold = int(size * INGEST_SAMPLING_THRESHOLD)
+
+        self.packets = deque()
+        self.weights = deque()
+        self.drain_scheduled = False
+        # moving average of the processing time of a packet
+        self.packet_seconds = 0
+
+        self.accepted_count = 0
+        self.dropped_count = 0
+        self.sampled_count = 0
+        self.reported_counters = 0, 0, 0
+
+        metrics.INGEST_ACCEPTED_PACKETS.set_function(
+            lambda: self.accepted_count
+        )
+        metrics.INGEST_DROPPED_PACKETS.set_function(
+            lambda: self.dropped_count
+        )
+        metrics.INGEST_SAMPLED_PACKETS.set_function(
+            lambda: self.sampled_count
+        )
+        metrics.INGEST_QUEUE_LENGTH.set_function(lambda: len(self.packets))
+
+    def put(self, packet):
+        packets = self.packets
+        weight = 1
+        if len(packets) >= self.size:
+            self.dropped_count += 1
+            if self.policy != DROP_OLDEST:
+                return
+            packets.popleft()
+            self.weights.popleft()
+        elif self.policy == SAMPLE:
+            sampling_rate = self.get_sampling_rate()
+            if sampling_rate < 1:
+                if random.random() >= sampling_rate:
+                    self.sampled_count += 1
+                    return
+                weight = 1 / sampling_rate
+
+        # packets may refer to reusable receive buffers
+        packets.append(bytes(packet))
+        self.weights.append(weight)
+        self.accepted_count += 1
+
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            self.loop.call_soon(self._drain)
+
+    def put_batch(self, packets):
+        for packet in packets:
+            self.put(packet)
+
+    def get_sampling_rate(self):
+        # linearly decreases from 1 at the threshold down to
+        # the minimal rate when the queue is full
+        excess = len(self.packets) - self.sampling_threshold
+        if excess <= 0:
+            return 1
+        free = max(self.size - self.sampling_threshold, 1)
+        return max(1 - excess / free, INGEST_MIN_SAMPLING_RATE)
+
+    def _drain(self):
+        # a single batch per loop iteration, the socket is polled in between,
+        # sized to fit the budget
+        self.drain_scheduled = False
+        if not self.packets:
+            return
+        count = INGEST_BATCH_SIZE
+        if self.packet_seconds:
+            count = max(min(int(INGEST_DRAIN_BUDGET / self.packet_seconds),
+                            count), 1)
+        count = min(count, len(self.packets))
+
+        start_time = perf_counter()
+        self._process(count)
+        packet_seconds = (perf_counter() - start_time) / count
+        if self.packet_seconds:
+            packet_seconds = 0.8 * self.packet_seconds + 0.2 * packet_seconds
+        self.packet_seconds = packet_seconds
+
+        if self.packets:
+            self.drain_scheduled = True
+            self.loop.call_soon(self._drain)
+
+    def _process(self, count):
+        packets = self.packets
+        weights = self.weights
+        count = min(count, len(packets))
+        batch = [packets.popleft() for _ in range(count)]
+        batch_weights = [weights.popleft() for _ in range(count)]
+        try:
+            self.consumer.process_batch(batch, batch_weights)
+        except Exception:
+            logger.exception('Processing of %s packets has failed', count)
+
+    def drain(self):
+        while self.packets:
+            self._process(INGEST_BATCH_SIZE)
+
+    def pop_counters(self):
+        # the totals are exported as metrics, so only the difference
+        # since the previous call is returned
+        counters = self.accepted_count, self.dropped_count, self.sampled_count
+        reported, self.reported_counters = self.reported_counters, counters
+        return tuple(count - previous
+                     for count, previous in zip(counters, reported))
@@ -0,0 +1,311 @@
+import asyncio
+import logging
+import os
+from bisect import bisect_left
+from time import perf_counter
+
+
+METRICS_ENABLED = os.getenv('METRICS', '1') == '1'
+METRICS_IP = os.getenv('METRICS_IP', '127.0.0.1')
+# 0 disables the endpoint, instruments are updated anyway
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.25))
+
+# seconds, from a fraction of a millisecond to a stalled loop
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+RESPONSE_TEMPLATE = ('HTTP/1.1 {status}\r\n'
+                     'Content-Type: text/plain; version=0.0.4\r\n'
+                     'Content-Length: {length}\r\n'
+                     'Connection: close\r\n\r\n')
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{value}"' for name, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    kind = 'counter'
+
+    def __init__(self, labels=None):
+        self.labels = labels
+        self.value = 0
+        self.function = None
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set_function(self, function):
+        # the value is read at scrape time from a total kept elsewhere,
+        # nothing has to be updated on the hot path
+        self.function = function
+
+    def samples(self, name):
+        value = self.function() if self.function else self.value
+        yield name + _format_labels(self.labels), value
+
+
+class Gauge(Counter):
+
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+
+    kind = 'histogram'
+
+    def __init__(self, labels=None, buckets=DEFAULT_BUCKETS):
+        self.labels = labels
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name):
+        labels = self.labels or {}
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            bucket_labels = dict(labels, le=_format_value(float(bound)))
+            yield name + '_bucket' + _format_labels(bucket_labels), cumulative
+        yield name + '_sum' + _format_labels(labels), self.sum
+        yield name + '_count' + _format_labels(labels), self.count
+
+
+class _NullMetric:
+
+    # replaces the instruments when metrics are disabled
+
+    kind = None
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def set_function(self, function):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+NULL_METRIC = _NullMetric()
+
+# name -> (kind, help, metrics)
+_families = {}
+# gauges of fractions, which are averaged over the workers
+_averaged = set()
+
+
+def _register(metric_class, name, help_text, labels=None, **kwargs):
+    if not METRICS_ENABLED:
+        return NULL_METRIC
+
+    metric = metric_class(labels, **kwargs)
+    _, _, metrics = _families.setdefault(
+        name, (metric_class.kind, help_text, [])
+    )
+    metrics.append(metric)
+    return metric
+
+
+def counter(name, help_text, labels=None):
+    return _register(Counter, name, help_text, labels)
+
+
+def gauge(name, help_text, labels=None, average=False):
+    # the supervisor sums up levels of the workers and averages ratios
+    if average:
+        _averaged.add(name)
+    return _register(Gauge, name, help_text, labels)
+
+
+def histogram(name, help_text, labels=None, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, help_text, labels, buckets=buckets)
+
+
+def render():
+    lines = []
+    for name, (kind, help_text, metrics) in _families.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for metric in metrics:
+            for sample, value in metric.samples(name):
+                lines.append(f'{sample} {_format_value(value)}')
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def aggregate(expositions):
+    # samples of the same series are summed up: counters and histograms
+    # become totals, gauges are levels of separate processes, except
+    # the ratios, which are averaged
+    lines = {}
+    counts = {}
+    for exposition in expositions:
+        for line in exposition.splitlines():
+            if not line:
+                continue
+            if line.startswith('#'):
+                lines.setdefault(line, None)
+                continue
+            sample, _, value = line.rpartition(' ')
+            lines[sample] = lines.get(sample, 0) + float(value)
+            counts[sample] = counts.get(sample, 0) + 1
+
+    output = []
+    for line, value in lines.items():
+        if value is None:
+            output.append(line)
+        else:
+            if line.partition('{')[0] in _averaged:
+                value /= counts[line]
+            if value.is_integer():
+                value = int(value)
+            output.append(f'{line} {_format_value(value)}')
+    output.append('')
+    return '\n'.join(output)
+
+
+RECEIVED_PACKETS = counter('consumer_received_packets_total',
+                           'Datagrams handed over by the protocol')
+RECEIVED_BYTES = counter('consumer_received_bytes_total',
+                         'Payload bytes handed over by the protocol')
+DECODED_PACKETS = counter('consumer_decoded_packets_total',
+                          'Packets deserialized for the stats')
+DECODE_SECONDS = counter('consumer_decode_seconds_total',
+                         'Time spent deserializing packets')
+AGGREGATED_EVENTS = counter('consumer_aggregated_events_total',
+                            'Events added to the stats table')
+AGGREGATE_SECONDS = counter('consumer_aggregate_seconds_total',
+                            'Time spent adding events to the stats table')
+RAW_WRITTEN_RECORDS = counter('consumer_raw_written_records_total',
+                              'Raw records handed over to the disk')
+RAW_WRITTEN_BYTES = counter('consumer_raw_written_bytes_total',
+                            'Raw data bytes written to segment files')
+RAW_DROPPED_PACKETS = counter('consumer_raw_dropped_packets_total',
+                              'Raw packets dropped because all the buffers '
+                              'were busy')
+RAW_WRITE_SECONDS = histogram('consumer_raw_write_seconds',
+                              'Duration of a single raw data writev call')
+RAW_BACKLOG = gauge('consumer_raw_backlog_buffers',
+                    'Raw data buffers submitted to the writer thread')
+INFLUXDB_POINTS_WRITTEN = counter('consumer_influxdb_points_written_total',
+                                  'Points accepted by InfluxDB')
+INFLUXDB_POINTS_LOST = counter('consumer_influxdb_points_lost_total',
+                               'Points given up after all the retries')
+INFLUXDB_RETRIES = counter('consumer_influxdb_retries_total',
+                           'Retried InfluxDB write requests')
+INFLUXDB_REQUEST_SECONDS = histogram('consumer_influxdb_request_seconds',
+                                     'Duration of an InfluxDB write request')
+STATS_FLUSH_SECONDS = histogram('consumer_flush_seconds',
+                                'Duration of a collector flush',
+                                {'collector': 'stats'})
+STATS_SERIALIZE_SECONDS = histogram('consumer_stats_serialize_seconds',
+                                    'Time spent building and serializing '
+                                    'stat points off the loop')
+RAW_FLUSH_SECONDS = histogram('consumer_flush_seconds',
+                              'Duration of a collector flush',
+                              {'collector': 'raw'})
+INGEST_ACCEPTED_PACKETS = counter('consumer_ingest_packets_total',
+                                  'Packets by the ingest queue decision',
+                                  {'result': 'accepted'})
+INGEST_DROPPED_PACKETS = counter('consumer_ingest_packets_total',
+                                 'Packets by the ingest queue decision',
+                                 {'result': 'dropped'})
+INGEST_SAMPLED_PACKETS = counter('consumer_ingest_packets_total',
+                                 'Packets by the ingest queue decision',
+                                 {'result': 'sampled_out'})
+INGEST_QUEUE_LENGTH = gauge('consumer_ingest_queue_packets',
+                            'Packets waiting in the ingest queue')
+ADMISSION_REJECTED_PACKETS = {
+    reason: counter('consumer_admission_rejected_packets_total',
+                    'Packets rejected before decoding', {'reason': reason})
+    for reason in ('too_small', 'too_large', 'bad_magic', 'denied',
+                   'rate_limited')
+}
+SPILLED_POINTS = counter('consumer_spilled_points_total',
+                         'Points written to the spill queue')
+DRAINED_POINTS = counter('consumer_drained_points_total',
+                         'Points written to InfluxDB from the spill queue')
+SPILL_DROPPED_BYTES = counter('consumer_spill_dropped_bytes_total',
+                              'Spilled bytes dropped because of the limit')
+SPILL_BYTES = gauge('consumer_spill_bytes',
+                    'Spilled bytes waiting to be drained')
+RELIABLE_ACKS = counter('consumer_reliable_acks_total',
+                        'Coalesced acknowledgements sent')
+RELIABLE_DUPLICATES = counter('consumer_reliable_duplicates_total',
+                              'Retransmitted packets received again')
+RELIABLE_OUT_OF_WINDOW = counter('consumer_reliable_out_of_window_total',
+                                 'Packets dropped beyond the receive window')
+RING_OCCUPANCY = gauge('consumer_stats_ring_occupancy',
+                       'Fraction of the ring slots waiting for the parsers',
+                       average=True)
+UNDECODABLE_PACKETS = counter('consumer_undecodable_packets_total',
+                              'Packets the stats parsers have skipped')
+RING_STALL_SECONDS = counter('consumer_stats_ring_stall_seconds_total',
+                             'Time spent waiting for free ring slots')
+LOOP_LAG_SECONDS = histogram('consumer_loop_lag_seconds',
+                             'Delay of loop callbacks behind their schedule')
+
+
+async def measure_loop_lag(interval=LOOP_LAG_INTERVAL):
+    while True:
+        start_time = perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(perf_counter() - start_time - interval,
+                                     0))
+
+
+async def handle_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+
+        target = request_line.split(b' ')[1] if request_line else b''
+        if target.partition(b'?')[0] == b'/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b''
+        writer.write(RESPONSE_TEMPLATE.format(status=status,
+                                              length=len(body)).encode())
+        writer.write(body)
+        await writer.drain()
+    except (ConnectionError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+def start_server(loop, port=METRICS_PORT, host=METRICS_IP):
+    server = loop.run_until_complete(
+        asyncio.start_server(handle_request, host, port)
+    )
+    logger.info('Metrics are served on http://%s:%s/metrics', host, port)
+    return server
@@ -1,4 +1,9 @@
+from .batch_udp_protocol import BatchUDPProtocol
+from .stream_protocol import (
+    TCPProtocol, UnixDatagramProtocol, UnixStreamProtocol
+)
 from .udp_protocol import UDPProtocol
 
 
-__all__ = ['UDPProtocol']
+__all__ = ['BatchUDPProtocol', 'TCPProtocol', 'UDPProtocol',
+           'UnixDatagramProtocol', 'UnixStreamProtocol']
@@ -0,0 +1,155 @@
+import socket
+import struct
+import sys
+from os import getenv
+
+from .socket_stats import (
+    configure_receive_buffer, get_kernel_drops, get_socket_inode
+)
+from ingest import INGEST_RECEIVE_BATCH
+from .reliability import RELIABLE, AckTracker
+from .udp_protocol import CONFIRMATION, LISTEN_ADDRESS, MAX_DATAGRAM_SIZE
+
+
+RECEIVE_BATCH_SIZE = int(getenv('RECEIVE_BATCH_SIZE', 64))
+
+# socket.UDP_GRO is not exposed by the standard library yet
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+USE_GRO = sys.platform == 'linux' and getenv('UDP_GRO', '1') == '1'
+GRO_CMSG_SIZE = socket.CMSG_SPACE(struct.calcsize('i'))
+
+
+class BatchUDPProtocol:
+
+    # Packets are passed to the consumer as memoryviews of preallocated
+    # buffers, so they are only valid until consume_batch returns.
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.socket = None
+        self.socket_inode = None
+        self.ack_tracker = None
+        self.gro = False
+        self.views = [memoryview(bytearray(MAX_DATAGRAM_SIZE))
+                      for _ in range(RECEIVE_BATCH_SIZE)]
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        configure_receive_buffer(sock)
+        if USE_GRO:
+            try:
+                sock.setsockopt(socket.SOL_UDP, UDP_GRO, 1)
+            except OSError:
+                pass
+            else:
+                self.gro = True
+        sock.bind(LISTEN_ADDRESS)
+        sock.setblocking(False)
+
+        self.socket = sock
+        self.socket_inode = get_socket_inode(sock)
+        if RELIABLE:
+            self.ack_tracker = AckTracker(self.consumer.loop, self._send_ack)
+        self.consumer.loop.add_reader(sock.fileno(), self._read_ready)
+
+    def _read_ready(self):
+        batches = 1
+        if self.consumer.ingest_queue:
+            # the queue drains fewer packets per loop iteration
+            batches = max(INGEST_RECEIVE_BATCH // RECEIVE_BATCH_SIZE, 1)
+        for _ in range(batches):
+            if not self._read_batch():
+                break
+
+    def _read_batch(self):
+        if self.gro:
+            packets, addresses = self._receive_gro()
+        else:
+            packets, addresses = self._receive()
+        if not packets:
+            return False
+
+        admission_filter = self.consumer.admission_filter
+        if admission_filter:
+            # rejected packets are neither acknowledged nor confirmed
+            packets, addresses = admission_filter.admit_batch(packets,
+                                                              addresses)
+
+        if self.ack_tracker:
+            # duplicates are not confirmed again, as by UDPProtocol
+            receive = self.ack_tracker.receive
+            received = [(payload, address) for payload, address in
+                        zip(map(receive, packets, addresses), addresses)
+                        if payload is not None]
+            packets = [payload for payload, _ in received]
+            addresses = [address for _, address in received]
+
+        if not packets:
+            return True
+
+        self.consumer.consume_batch(packets)
+
+        if CONFIRMATION:
+            sendto = self.socket.sendto
+            for address in addresses:
+                try:
+                    sendto(CONFIRMATION, address)
+                except OSError:
+                    pass
+        return True
+
+    def _receive(self):
+        recvfrom_into = self.socket.recvfrom_into
+        packets = []
+        addresses = []
+        for view in self.views:
+            try:
+                nbytes, address = recvfrom_into(view)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionRefusedError:
+                continue
+            packets.append(view[:nbytes])
+            addresses.append(address)
+        return packets, addresses
+
+    def _receive_gro(self):
+        recvmsg_into = self.socket.recvmsg_into
+        packets = []
+        addresses = []
+        for view in self.views:
+            try:
+                nbytes, ancdata, _, address = recvmsg_into([view],
+                                                           GRO_CMSG_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionRefusedError:
+                continue
+
+            segment_size = nbytes
+            for level, cmsg_type, data in ancdata:
+                if level == socket.SOL_UDP and cmsg_type == UDP_GRO:
+                    segment_size = struct.unpack('i', data)[0]
+
+            # the kernel may coalesce several datagrams of the same flow
+            for offset in range(0, nbytes, segment_size):
+                packets.append(view[offset:min(offset + segment_size,
+                                               nbytes)])
+                addresses.append(address)
+        return packets, addresses
+
+    def _send_ack(self, ack, address):
+        try:
+            self.socket.sendto(ack, address)
+        except OSError:
+            pass
+
+    def get_kernel_drops(self):
+        return get_kernel_drops(self.socket_inode)
+
+    def stop(self):
+        if self.ack_tracker:
+            self.ack_tracker.stop()
+        self.consumer.loop.remove_reader(self.socket.fileno())
+        self.socket.close()
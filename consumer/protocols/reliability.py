@@ -0,0 +1,150 @@
+import struct
+from os import getenv
+from time import monotonic
+
+import metrics
+
+
+RELIABLE = getenv('RELIABLE') == '1'
+ACK_INTERVAL = float(getenv('ACK_INTERVAL', 0.02))
+# an ack is sent right away after this many packets of a stream
+ACK_EVERY = int(getenv('ACK_EVERY', 256))
+# packets further than this from the cumulative ack are dropped,
+# the sender retransmits them later
+RELIABLE_WINDOW = int(getenv('RELIABLE_WINDOW', 4096))
+STREAM_TIMEOUT = float(getenv('STREAM_TIMEOUT', 60))
+
+DATA_MAGIC = b'HR'
+ACK_MAGIC = b'HA'
+RELIABLE_VERSION = 1
+# magic, version, stream id, sequence number and the lowest sequence
+# number the sender still waits an ack for
+DATA_HEADER = struct.Struct('<2sBxIII')
+# magic, version, stream id, next expected sequence number
+# and a bitmap of the received packets following it
+ACK_HEADER = struct.Struct('<2sBxIIQ')
+SACK_BITS = 64
+# sequence numbers wrap around, they are compared with
+# the serial number arithmetic of RFC 1982
+SEQUENCE_MODULO = 2 ** 32
+
+
+def get_distance(start, end):
+    # how far the end is ahead of the start, negative when it is behind
+    return (end - start + SEQUENCE_MODULO // 2) % SEQUENCE_MODULO - (
+        SEQUENCE_MODULO // 2
+    )
+
+
+class _Stream:
+
+    def __init__(self, base):
+        self.expected = base
+        # sequence numbers received beyond the expected one
+        self.received = set()
+        self.unacked = 0
+        self.last_seen = monotonic()
+
+
+class AckTracker:
+
+    # Tracks the delivery of sequenced datagrams per sender stream and
+    # coalesces acknowledgements: a cumulative ack with a selective ack
+    # bitmap per stream is sent on a short timer instead of per packet.
+
+    def __init__(self, loop, send):
+        self.loop = loop
+        self.send = send
+        self.streams = {}
+        self.dirty = {}
+        self.timer = None
+        self.last_cleanup = monotonic()
+
+    def receive(self, packet, address):
+        # returns the payload or None when the packet is a duplicate
+        if packet[:2] != DATA_MAGIC or len(packet) < DATA_HEADER.size:
+            # unsequenced packets are not acknowledged
+            return packet
+        _, version, stream_id, sequence, base = DATA_HEADER.unpack_from(
+            packet
+        )
+        if version != RELIABLE_VERSION:
+            return packet
+
+        key = address, stream_id
+        stream = self.streams.get(key)
+        if stream is None:
+            stream = self.streams[key] = _Stream(base)
+        stream.last_seen = monotonic()
+
+        if get_distance(stream.expected, base) > 0:
+            # the sender has given up on the older packets
+            stream.received = {received for received in stream.received
+                               if get_distance(base, received) >= 0}
+            stream.expected = base
+            self._advance(stream)
+
+        self._mark_dirty(key, stream)
+        distance = get_distance(stream.expected, sequence)
+        if distance < 0 or sequence in stream.received:
+            # the ack was lost, the packet is acknowledged again
+            metrics.RELIABLE_DUPLICATES.inc()
+            return None
+        if distance >= RELIABLE_WINDOW:
+            metrics.RELIABLE_OUT_OF_WINDOW.inc()
+            return None
+
+        if not distance:
+            stream.expected = (sequence + 1) % SEQUENCE_MODULO
+            self._advance(stream)
+        else:
+            stream.received.add(sequence)
+        return memoryview(packet)[DATA_HEADER.size:]
+
+    @staticmethod
+    def _advance(stream):
+        received = stream.received
+        while stream.expected in received:
+            received.remove(stream.expected)
+            stream.expected = (stream.expected + 1) % SEQUENCE_MODULO
+
+    def _mark_dirty(self, key, stream):
+        self.dirty[key] = stream
+        stream.unacked += 1
+        if stream.unacked >= ACK_EVERY:
+            self._send_ack(key, stream)
+            del self.dirty[key]
+        elif self.timer is None and self.dirty:
+            self.timer = self.loop.call_later(ACK_INTERVAL, self.flush)
+
+    def _send_ack(self, key, stream):
+        address, stream_id = key
+        expected = stream.expected
+        bitmap = 0
+        for received in stream.received:
+            offset = get_distance(expected, received) - 1
+            if offset < SACK_BITS:
+                bitmap |= 1 << offset
+        self.send(ACK_HEADER.pack(ACK_MAGIC, RELIABLE_VERSION, stream_id,
+                                  expected, bitmap), address)
+        stream.unacked = 0
+        metrics.RELIABLE_ACKS.inc()
+
+    def flush(self):
+        self.timer = None
+        dirty, self.dirty = self.dirty, {}
+        for key, stream in dirty.items():
+            self._send_ack(key, stream)
+
+        current_time = monotonic()
+        if current_time - self.last_cleanup >= STREAM_TIMEOUT:
+            self.last_cleanup = current_time
+            self.streams = {
+                key: stream for key, stream in self.streams.items()
+                if current_time - stream.last_seen < STREAM_TIMEOUT
+            }
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.flush()
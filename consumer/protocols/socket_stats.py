@@ -0,0 +1,39 @@
+import os
+import socket
+import sys
+from os import getenv
+
+
+RECEIVE_BUFFER_SIZE = int(getenv('RECEIVE_BUFFER_SIZE', 0))
+
+PROC_NET_UDP = ('/proc/net/udp', '/proc/net/udp6')
+
+
+def configure_receive_buffer(sock):
+    if RECEIVE_BUFFER_SIZE:
+        # the kernel caps the value with net.core.rmem_max
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                        RECEIVE_BUFFER_SIZE)
+
+
+def get_socket_inode(sock):
+    if sys.platform != 'linux':
+        return None
+    return str(os.fstat(sock.fileno()).st_ino)
+
+
+def get_kernel_drops(inode):
+    if inode is None:
+        return None
+
+    for path in PROC_NET_UDP:
+        try:
+            with open(path) as proc_file:
+                next(proc_file)  # header
+                for line in proc_file:
+                    columns = line.split()
+                    if columns[9] == inode:
+                        return int(columns[-1])
+        except OSError:
+            continue
+    return None
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+import socket
+import struct
+from os import getenv
+
+from .udp_protocol import LISTEN_IP, LISTEN_PORT, UDPProtocol
+
+
+LISTEN_PATH = getenv('LISTEN_PATH', '/tmp/highload-demo.sock')
+STREAM_BUFFER_SIZE = int(getenv('STREAM_BUFFER_SIZE', 2 ** 20))
+MAX_FRAME_SIZE = int(getenv('MAX_FRAME_SIZE', 16 * 2 ** 20))
+# reading of the streams is paused when the ingest queue gets fuller
+# than the high fraction and resumed below the low one
+STREAM_HIGH_WATER = float(getenv('STREAM_HIGH_WATER', 0.9))
+STREAM_LOW_WATER = float(getenv('STREAM_LOW_WATER', 0.5))
+
+# every frame is prefixed with the length of its payload
+FRAME_HEADER = struct.Struct('<I')
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def remove_stale_socket(path, socket_type):
+    # a socket file left by a stopped consumer refuses connections
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket_type) as sock:
+        try:
+            sock.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+        else:
+            raise OSError(f'{path} is used by another process')
+
+
+class _FramedConnection(asyncio.BufferedProtocol):
+
+    # Frames are read into a reusable buffer and passed to the consumer
+    # as memoryviews of it, so they are only valid until consume_batch
+    # returns. Only the incomplete tail is moved to the buffer start.
+
+    def __init__(self, server):
+        self.server = server
+        self.consumer = server.consumer
+        self.transport = None
+        self.peer = None
+        self.buffer = bytearray(STREAM_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.end = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        admission_filter = self.consumer.admission_filter
+        if admission_filter and not admission_filter.is_allowed(self.peer):
+            transport.abort()
+            return
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        self.server.paused.discard(self)
+
+    def get_buffer(self, sizehint):
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        self.end += nbytes
+        view = self.view
+        end = self.end
+        header_size = FRAME_HEADER.size
+        unpack_from = FRAME_HEADER.unpack_from
+
+        frames = []
+        start = 0
+        while end - start >= header_size:
+            length, = unpack_from(view, start)
+            frame_end = start + header_size + length
+            if frame_end > end:
+                break
+            frames.append(view[start + header_size:frame_end])
+            start = frame_end
+
+        admission_filter = self.consumer.admission_filter
+        if frames and admission_filter:
+            admit = admission_filter.admit
+            frames = [frame for frame in frames if admit(frame, self.peer)]
+        if frames:
+            self.consumer.consume_batch(frames)
+
+        if start:
+            view[:end - start] = view[start:end]
+            self.end = end - start
+
+        required = self.end
+        if self.end >= header_size:
+            length, = unpack_from(view)
+            if length > MAX_FRAME_SIZE:
+                logger.error('%s bytes frame exceeds the limit of %s bytes, '
+                             'the connection is closed', length,
+                             MAX_FRAME_SIZE)
+                self.transport.abort()
+                self.end = 0
+                return
+            required = header_size + length
+        if required > len(self.buffer):
+            self._resize(required)
+        elif (len(self.buffer) > STREAM_BUFFER_SIZE and
+                required <= STREAM_BUFFER_SIZE):
+            # the large frames have been consumed, the memory is released
+            self._resize(STREAM_BUFFER_SIZE)
+
+        if self.server.is_overloaded():
+            self.server.pause(self)
+
+    def _resize(self, size):
+        # frames larger than the buffer get one of their own size,
+        # the consumed ones are not referenced anymore
+        buffer = bytearray(size)
+        buffer[:self.end] = self.view[:self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    def eof_received(self):
+        if self.end:
+            logger.warning('%s bytes of an incomplete frame are lost',
+                           self.end)
+        return False
+
+
+class _StreamServer:
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.server = None
+        self.connections = set()
+        self.paused = set()
+
+    def _create_server(self, loop):
+        raise NotImplementedError
+
+    def start(self):
+        loop = self.consumer.loop
+        self.server = loop.run_until_complete(self._create_server(loop))
+
+    def is_overloaded(self):
+        # without the ingest queue packets are processed synchronously,
+        # so the loop does not read while the consumer is busy
+        ingest_queue = self.consumer.ingest_queue
+        return (ingest_queue is not None and
+                len(ingest_queue.packets) >= ingest_queue.size *
+                STREAM_HIGH_WATER)
+
+    def pause(self, connection):
+        if not self.paused:
+            self.consumer.loop.call_soon(self._resume_drained)
+        connection.transport.pause_reading()
+        self.paused.add(connection)
+
+    def _resume_drained(self):
+        if not self.paused:
+            return
+        # the ingest queue drains a batch per loop iteration
+        ingest_queue = self.consumer.ingest_queue
+        if len(ingest_queue.packets) > ingest_queue.size * STREAM_LOW_WATER:
+            self.consumer.loop.call_soon(self._resume_drained)
+            return
+
+        paused, self.paused = self.paused, set()
+        for connection in paused:
+            connection.transport.resume_reading()
+
+    def get_kernel_drops(self):
+        # streams are not lossy
+        return None
+
+    def stop(self):
+        self.server.close()
+        for connection in list(self.connections):
+            connection.transport.close()
+
+
+class TCPProtocol(_StreamServer):
+
+    def _create_server(self, loop):
+        return loop.create_server(lambda: _FramedConnection(self),
+                                  LISTEN_IP, LISTEN_PORT, reuse_port=True)
+
+
+class UnixStreamProtocol(_StreamServer):
+
+    def _create_server(self, loop):
+        remove_stale_socket(LISTEN_PATH, socket.SOCK_STREAM)
+        return loop.create_unix_server(lambda: _FramedConnection(self),
+                                       LISTEN_PATH)
+
+    def stop(self):
+        super().stop()
+        try:
+            os.unlink(LISTEN_PATH)
+        except FileNotFoundError:
+            pass
+
+
+class UnixDatagramProtocol(UDPProtocol):
+
+    # Confirmations and acks are only sent to clients
+    # which have bound their sockets to a path.
+
+    def start(self):
+        remove_stale_socket(LISTEN_PATH, socket.SOCK_DGRAM)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(LISTEN_PATH)
+        self._create_endpoint(sock)
+
+    def get_kernel_drops(self):
+        # /proc/net/udp does not cover unix sockets
+        return None
+
+    def stop(self):
+        super().stop()
+        try:
+            os.unlink(LISTEN_PATH)
+        except FileNotFoundError:
+            pass
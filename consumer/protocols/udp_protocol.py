@@ -1,9 +1,17 @@
+import socket
 from os import getenv
 
+from ingest import INGEST_RECEIVE_BATCH
+from .reliability import RELIABLE, AckTracker
+from .socket_stats import (
+    configure_receive_buffer, get_kernel_drops, get_socket_inode
+)
+
 
 LISTEN_IP = getenv('LISTEN_IP', '0.0.0.0')
 LISTEN_PORT = int(getenv('LISTEN_PORT', 51273))
 LISTEN_ADDRESS = LISTEN_IP, LISTEN_PORT
+MAX_DATAGRAM_SIZE = 65535
 
 CONFIRMATION = getenv('CONFIRMATION')
 if CONFIRMATION:
@@ -15,25 +23,71 @@ class UDPProtocol:
     def __init__(self, consumer):
         self.consumer = consumer
         self.transport = None
+        self.socket = None
+        self.socket_inode = None
+        self.ack_tracker = None
 
     def connection_made(self, transport):
         self.transport = transport
+        if RELIABLE:
+            self.ack_tracker = AckTracker(self.consumer.loop,
+                                          transport.sendto)
+        sock = transport.get_extra_info('socket')
+        configure_receive_buffer(sock)
+        self.socket_inode = get_socket_inode(sock)
 
     def connection_lost(self, exc):
         pass
 
     def datagram_received(self, packet, address):
-        # WARNING: some kind of filtering should be there for the real app
+        self._receive(packet, address)
+        if self.consumer.ingest_queue:
+            self._receive_pending()
+
+    def _receive_pending(self):
+        # the transport reads a single datagram per loop iteration
+        # while the ingest queue drains a batch of them
+        recvfrom = self.socket.recvfrom
+        for _ in range(INGEST_RECEIVE_BATCH):
+            try:
+                packet, address = recvfrom(MAX_DATAGRAM_SIZE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue
+            self._receive(packet, address)
+
+    def _receive(self, packet, address):
+        admission_filter = self.consumer.admission_filter
+        if admission_filter and not admission_filter.admit(packet, address):
+            return
+        if self.ack_tracker:
+            packet = self.ack_tracker.receive(packet, address)
+            if packet is None:
+                return
         self.consumer.consume_packet(packet)
 
         if CONFIRMATION:
             self.transport.sendto(CONFIRMATION, address)
 
     def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(LISTEN_ADDRESS)
+        self._create_endpoint(sock)
+
+    def _create_endpoint(self, sock):
+        # the socket of the transport can not be read directly
+        self.socket = sock
         loop = self.consumer.loop
-        coroutine = loop.create_datagram_endpoint(lambda: self, LISTEN_ADDRESS,
-                                                  reuse_port=True)
-        loop.run_until_complete(coroutine)
+        loop.run_until_complete(
+            loop.create_datagram_endpoint(lambda: self, sock=sock)
+        )
+
+    def get_kernel_drops(self):
+        return get_kernel_drops(self.socket_inode)
 
     def stop(self):
+        if self.ack_tracker:
+            self.ack_tracker.stop()
         self.transport.close()
@@ -0,0 +1,269 @@
+import argparse
+import asyncio
+import logging
+import os
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from itertools import islice, repeat
+from time import time
+
+# replaying makes sense only with collecting stats
+os.environ.setdefault('COLLECT_STATS', '1')
+
+from collectors import StatsCollector  # noqa: E402
+from collectors.stats_table import StatsTable  # noqa: E402
+from collectors.windows import STATS_WINDOWS  # noqa: E402
+from serialization import get_deserializer  # noqa: E402
+from writers.segment_reader import SegmentError, SegmentReader  # noqa: E402
+from writers.segment_writer import INDEX_SUFFIX  # noqa: E402
+
+
+REPLAY_BATCH_SIZE = int(os.getenv('REPLAY_BATCH_SIZE', 256))
+DATA_FORMAT = os.getenv('DATA_FORMAT', 'msgpack')
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class ReplayConsumer:
+
+    # provides collectors with the same attributes as Consumer does
+
+    def __init__(self, consumer_id):
+        self.consumer_id = consumer_id
+        self.loop = asyncio.new_event_loop()
+
+
+def create_stats_collector(consumer):
+    return StatsCollector(consumer, get_deserializer(DATA_FORMAT))
+
+
+def find_segments(path):
+    if os.path.isfile(path):
+        return [path]
+
+    segments = []
+    for directory, _, filenames in os.walk(path):
+        for filename in filenames:
+            if not (filename.endswith(INDEX_SUFFIX) or
+                    filename.endswith('.tmp')):
+                segments.append(os.path.join(directory, filename))
+    return sorted(segments)
+
+
+def get_consumer_id(segment_path):
+    return os.path.basename(os.path.dirname(os.path.abspath(segment_path)))
+
+
+def replay_segment(path, collector, start_time=None, end_time=None):
+    with SegmentReader(path) as reader:
+        if not overlaps(reader, start_time, end_time):
+            return 0
+
+        count = 0
+        window_size = collector.windows.levels[0].size
+        for window_start, window_end in get_windows(reader, window_size,
+                                                    start_time, end_time):
+            # packets are assigned to windows by the time of the data
+            clock_time = window_start / 10 ** 9
+            collector.clock = lambda: clock_time
+            count += replay_records(reader.records(window_start, window_end),
+                                    collector)
+            collector.flush()
+            run_pending_tasks(collector.loop)
+    return count
+
+
+def aggregate_segment(path, start_time=None, end_time=None):
+    # runs in the worker processes: only the tables of the first level
+    # windows are built, the parent merges the tables of the segments
+    # sharing a window, so every window is emitted just once
+    consumer_id = get_consumer_id(path)
+    window_size = STATS_WINDOWS[0]
+    deserialize = get_deserializer(DATA_FORMAT)
+    tables = {}
+    count = 0
+    try:
+        with SegmentReader(path) as reader:
+            if not overlaps(reader, start_time, end_time):
+                return consumer_id, tables, count
+
+            for window_start, window_end in get_windows(reader, window_size,
+                                                        start_time, end_time):
+                start = window_start // 10 ** 9 // window_size * window_size
+                table = tables.setdefault(start, StatsTable())
+                records = reader.records(window_start, window_end)
+                while True:
+                    batch = list(islice(records, REPLAY_BATCH_SIZE))
+                    if not batch:
+                        break
+                    table.add_packets([deserialize(data) for data in batch])
+                    count += len(batch)
+    except SegmentError as error:
+        logger.warning('Segment has been skipped: %s', error)
+    return consumer_id, tables, count
+
+
+def overlaps(reader, start_time=None, end_time=None):
+    first, last = reader.time_range
+    return first is None or not (
+        (end_time is not None and first > end_time) or
+        (start_time is not None and last < start_time)
+    )
+
+
+def get_windows(reader, window_size, start_time=None, end_time=None):
+    # ranges of record times of the non-empty windows of the first level
+    timestamps = reader.timestamps
+    if not timestamps:
+        opened_at = reader.time_range[0]
+        yield opened_at, opened_at
+        return
+
+    window = window_size * 10 ** 9
+    position = bisect_left(timestamps, start_time or 0)
+    end = (bisect_right(timestamps, end_time) if end_time is not None
+           else len(timestamps))
+    while position < end:
+        window_start = timestamps[position] // window * window
+        window_end = window_start + window - 1
+        yield (max(window_start, start_time or 0),
+               window_end if end_time is None else min(window_end, end_time))
+        position = bisect_right(timestamps, window_end, position)
+
+
+def replay_records(records, collector):
+    # no references to the records may outlive the reader
+    count = 0
+    while True:
+        batch = list(islice(records, REPLAY_BATCH_SIZE))
+        if not batch:
+            break
+        collector.collect_batch(batch)
+        count += len(batch)
+    return count
+
+
+def run_pending_tasks(loop):
+    pending_tasks = asyncio.all_tasks(loop)
+    if pending_tasks:
+        loop.run_until_complete(asyncio.wait(pending_tasks))
+
+
+def merge_tables(collector, tables):
+    # tables of the windows of a segment, in the order of the data
+    for start, table in sorted(tables.items()):
+        collector.clock = lambda: start
+        collector.merge_table(start, table)
+        collector.flush()
+        run_pending_tasks(collector.loop)
+
+
+def _get_collector(collectors, consumer_id, create_collector):
+    collector = collectors.get(consumer_id)
+    if collector is None:
+        collector = create_collector(ReplayConsumer(consumer_id))
+        collectors[consumer_id] = collector
+    return collector
+
+
+def _stop_collectors(collectors):
+    for collector in collectors.values():
+        collector.flush(final=True)
+        collector.stop()
+        collector.loop.close()
+
+
+def replay_segments(paths, create_collector=create_stats_collector,
+                    start_time=None, end_time=None):
+    count = 0
+    collectors = {}
+    try:
+        for path in paths:
+            collector = _get_collector(collectors, get_consumer_id(path),
+                                       create_collector)
+            try:
+                count += replay_segment(path, collector, start_time, end_time)
+            except SegmentError as error:
+                logger.warning('Segment has been skipped: %s', error)
+    finally:
+        _stop_collectors(collectors)
+    return count
+
+
+def _init_worker():
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s')
+
+
+def replay(path, start_time=None, end_time=None, processes=1,
+           create_collector=create_stats_collector):
+    paths = find_segments(path)
+    if processes <= 1:
+        return replay_segments(paths, create_collector, start_time, end_time)
+
+    count = 0
+    collectors = {}
+    try:
+        # the workers aggregate the segments the way StatsCollector does,
+        # other collectors would only get its tables merged into them
+        for consumer_id in dict.fromkeys(map(get_consumer_id, paths)):
+            collector = _get_collector(collectors, consumer_id,
+                                       create_collector)
+            if type(collector) is not StatsCollector:
+                raise ValueError(f'{type(collector).__name__} can not be '
+                                 f'replayed in parallel processes')
+
+        with ProcessPoolExecutor(processes,
+                                 initializer=_init_worker) as executor:
+            # results come in the order of the segments,
+            # so windows are closed in order as well
+            for consumer_id, tables, segment_count in executor.map(
+                aggregate_segment, paths, repeat(start_time),
+                repeat(end_time)
+            ):
+                merge_tables(_get_collector(collectors, consumer_id,
+                                            create_collector), tables)
+                count += segment_count
+    finally:
+        _stop_collectors(collectors)
+    return count
+
+
+def parse_time(value):
+    # naive times are treated as UTC like the segment names
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp() * 10 ** 9)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replays raw data segments through StatsCollector.'
+    )
+    parser.add_argument('path',
+                        help='raw data directory, consumer directory '
+                             'or a single segment')
+    parser.add_argument('--from', dest='start_time', type=parse_time,
+                        help='skip packets received before this UTC time')
+    parser.add_argument('--to', dest='end_time', type=parse_time,
+                        help='skip packets received after this UTC time')
+    parser.add_argument('--processes', '-p', type=int, default=1,
+                        help='replay segments in parallel processes, '
+                             'which aggregate packets the way StatsCollector '
+                             'does; other collectors passed to replay() '
+                             'are only supported with 1 process')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s')
+    start_time = time()
+    count = replay(args.path, args.start_time, args.end_time, args.processes)
+    duration = time() - start_time
+    logger.info(f'{count} packets were replayed in {duration:.03f} seconds '
+                f'at {count / duration:.02f} average pps')
+
+
+if __name__ == '__main__':
+    main()
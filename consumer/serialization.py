@@ -0,0 +1,306 @@
+import json
+import os
+import re
+import threading
+from collections import namedtuple
+from functools import partial
+
+import msgpack
+import numpy as np
+import ujson
+
+from binary_format import (
+    BINARY_EVENT, BINARY_HEADER, BINARY_MAGIC, BINARY_VERSION
+)
+
+
+PROJECTED_FIELDS = frozenset(('country', 'user', 'events'))
+
+# names the identifiers of binary packets refer to, the dictionary
+# is written by the test data generator along with the packets
+BINARY_DICTIONARY_PATH = os.getenv('BINARY_DICTIONARY_PATH')
+# events of binary packets are read in place
+BINARY_EVENT_DTYPE = np.dtype([('event', '<u2'), ('duration', '<f8')])
+
+deserialize_msgpack = partial(msgpack.loads, raw=False)
+
+
+def deserialize_json(data):
+    # ujson does not accept memoryviews of receive buffers
+    return ujson.loads(bytes(data))
+
+
+def _new_unpacker():
+    return msgpack.Unpacker(raw=False)
+
+
+# reused between packets to keep its internal buffer allocated;
+# an unpacker keeps the state of its stream, so every thread has its own
+_unpackers = threading.local()
+
+
+def _get_unpacker():
+    unpacker = getattr(_unpackers, 'unpacker', None)
+    if unpacker is None:
+        unpacker = _unpackers.unpacker = _new_unpacker()
+    return unpacker
+
+
+def selective_deserialize_msgpack(data):
+    unpacker = _get_unpacker()
+    start = unpacker.tell()
+    unpacker.feed(data)
+
+    result = {}
+    try:
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key in PROJECTED_FIELDS:
+                result[key] = unpacker.unpack()
+            else:
+                unpacker.skip()
+    except Exception:
+        _unpackers.unpacker = _new_unpacker()
+        raise
+
+    if unpacker.tell() - start != len(data):
+        # trailing bytes would corrupt the next packet
+        _unpackers.unpacker = _new_unpacker()
+    return result
+
+
+class BinaryDictionary:
+
+    # The version is a checksum of the names, so packets encoded
+    # with another dictionary are rejected instead of being misread.
+
+    def __init__(self, version, countries, events):
+        self.version = version
+        self.countries = countries
+        self.events = events
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as dictionary_file:
+            data = json.load(dictionary_file)
+        return cls(data['version'], data['countries'], data['events'])
+
+
+# events is a structured array of the event ids and durations
+BinaryPacket = namedtuple('BinaryPacket', 'dictionary country user events')
+
+_binary_dictionary = None
+
+
+def get_binary_dictionary():
+    global _binary_dictionary
+    if _binary_dictionary is None:
+        if not BINARY_DICTIONARY_PATH:
+            raise ValueError('BINARY_DICTIONARY_PATH has to be set '
+                             'to decode binary packets')
+        _binary_dictionary = BinaryDictionary.load(BINARY_DICTIONARY_PATH)
+    return _binary_dictionary
+
+
+def deserialize_binary(data):
+    (magic, version, dictionary_version, country, user,
+     count) = BINARY_HEADER.unpack_from(data)
+    if magic != BINARY_MAGIC:
+        raise ValueError('Binary packet is expected')
+    if version != BINARY_VERSION:
+        raise ValueError(f'Binary format version {version} '
+                         f'is not supported')
+
+    dictionary = get_binary_dictionary()
+    if dictionary_version != dictionary.version:
+        raise ValueError(f'Dictionary {dictionary_version:08x} is unknown, '
+                         f'{dictionary.version:08x} is loaded')
+    if len(data) != BINARY_HEADER.size + count * BINARY_EVENT.size:
+        raise ValueError(f'Binary packet of {count} events has '
+                         f'{len(data)} bytes')
+
+    # copied, the data may be a reusable receive buffer
+    events = np.frombuffer(data, BINARY_EVENT_DTYPE, count,
+                           BINARY_HEADER.size).copy()
+    if country >= len(dictionary.countries) or (
+            count and events['event'].max() >= len(dictionary.events)):
+        raise ValueError('Binary packet refers to unknown names')
+    return BinaryPacket(dictionary, country, user, events)
+
+
+_JSON_WHITESPACE = rb'[ \t\n\r]*'
+
+JSON_OBJECT_START = re.compile(_JSON_WHITESPACE + rb'\{')
+JSON_KEY = re.compile(_JSON_WHITESPACE + rb'"')
+JSON_COLON = re.compile(_JSON_WHITESPACE + rb':' + _JSON_WHITESPACE)
+JSON_SEPARATOR = re.compile(_JSON_WHITESPACE + rb'([,}])')
+JSON_SCALAR = re.compile(rb'[^,}\] \t\n\r]+')
+JSON_BRACKETS = re.compile(rb'["{}\[\]]')
+
+BACKSLASH = ord('\\')
+QUOTE = ord('"')
+OPENING_BRACKETS = frozenset(b'{[')
+CLOSING_BRACKETS = {ord('['): b']', ord('{'): b'}'}
+
+PROJECTED_JSON_KEYS = frozenset(f'"{field}"'.encode()
+                                for field in PROJECTED_FIELDS)
+
+
+def _skip_json_string(data, position):
+    # memchr based search is much faster than any regex for long strings
+    end = position
+    while True:
+        end = data.find(b'"', end + 1)
+        if end < 0:
+            raise ValueError(f'Unterminated JSON string at {position}')
+        backslashes = 0
+        while data[end - backslashes - 1] == BACKSLASH:
+            backslashes += 1
+        if not backslashes % 2:
+            return end + 1
+
+
+def _skip_json_container(data, position):
+    depth = 0
+    search = JSON_BRACKETS.search
+    while True:
+        match = search(data, position)
+        if match is None:
+            raise ValueError(f'Unterminated JSON container at {position}')
+        position = match.start()
+        char = data[position]
+        if char == QUOTE:
+            position = _skip_json_string(data, position)
+            continue
+
+        depth += 1 if char in OPENING_BRACKETS else -1
+        position += 1
+        if not depth:
+            return position
+
+
+def _skip_json_value(data, position):
+    if position >= len(data):
+        raise ValueError('Unexpected end of JSON data')
+
+    first = data[position]
+    if first == QUOTE:
+        return _skip_json_string(data, position)
+    if first in OPENING_BRACKETS:
+        return _skip_json_container(data, position)
+
+    match = JSON_SCALAR.match(data, position)
+    if match is None:
+        raise ValueError(f'Invalid JSON value at {position}')
+    return match.end()
+
+
+def _load_json_value(data, position):
+    if position >= len(data):
+        raise ValueError('Unexpected end of JSON data')
+
+    closing_bracket = CLOSING_BRACKETS.get(data[position])
+    if closing_bracket is None:
+        end = _skip_json_value(data, position)
+        return ujson.loads(data[position:end]), end
+
+    # Scanning flat containers like events token by token in Python
+    # is slower than trying to decode up to every closing bracket,
+    # which usually is the right one at the first attempt.
+    end = position
+    while True:
+        end = data.find(closing_bracket, end + 1)
+        if end < 0:
+            raise ValueError(f'Unterminated JSON container at {position}')
+        try:
+            return ujson.loads(data[position:end + 1]), end + 1
+        except ValueError:
+            continue
+
+
+def selective_deserialize_json(data):
+    data = bytes(data)
+    match = JSON_OBJECT_START.match(data)
+    if match is None:
+        raise ValueError('JSON object is expected')
+    position = match.end()
+
+    result = {}
+    while True:
+        match = JSON_KEY.match(data, position)
+        if match is None:
+            if data[position:].strip() == b'}':
+                return result  # empty object
+            raise ValueError(f'Invalid JSON key at {position}')
+
+        key_start = match.end() - 1
+        key_end = _skip_json_string(data, key_start)
+        key = data[key_start:key_end]
+
+        match = JSON_COLON.match(data, key_end)
+        if match is None:
+            raise ValueError(f'Invalid JSON key at {key_start}')
+        position = match.end()
+
+        if key in PROJECTED_JSON_KEYS:
+            result[key[1:-1].decode()], position = _load_json_value(
+                data, position
+            )
+        else:
+            position = _skip_json_value(data, position)
+
+        match = JSON_SEPARATOR.match(data, position)
+        if match is None:
+            raise ValueError(f'Invalid JSON separator at {position}')
+        if match.group(1) == b'}':
+            return result
+        position = match.end()
+
+
+DESERIALIZERS = {
+    'msgpack': deserialize_msgpack,
+    'json': deserialize_json,
+    'binary': deserialize_binary,
+}
+
+# binary packets have nothing to skip
+SELECTIVE_DESERIALIZERS = {
+    'msgpack': selective_deserialize_msgpack,
+    'json': selective_deserialize_json,
+    'binary': deserialize_binary,
+}
+
+
+SERIALIZERS = {
+    'msgpack': msgpack.dumps,
+    'json': lambda packet: ujson.dumps(packet).encode(),
+}
+
+
+def get_deserializer(data_format, selective=False):
+    deserializers = SELECTIVE_DESERIALIZERS if selective else DESERIALIZERS
+    try:
+        deserialize = deserializers[data_format]
+    except KeyError:
+        raise ValueError(f'{data_format} format is not supported')
+    if deserialize is deserialize_binary:
+        # a missing dictionary fails the start instead of every packet
+        get_binary_dictionary()
+    return deserialize
+
+
+def get_field_stripper(data_format, fields):
+    if data_format not in SERIALIZERS:
+        raise ValueError(f'Fields can not be stripped from {data_format} '
+                         f'packets')
+    deserialize = get_deserializer(data_format)
+    serialize = SERIALIZERS[data_format]
+    fields = tuple(fields)
+
+    def strip_fields(data):
+        packet = deserialize(data)
+        for field in fields:
+            packet.pop(field, None)
+        return serialize(packet)
+
+    return strip_fields
@@ -0,0 +1,192 @@
+import logging
+import os
+import signal
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import RawArray
+from time import monotonic, sleep
+from urllib.error import URLError
+from urllib.request import urlopen
+
+import metrics
+
+
+RESTART_DELAY = float(os.getenv('WORKER_RESTART_DELAY', 1))
+POLL_INTERVAL = 0.5
+METRICS_SCRAPE_TIMEOUT = float(os.getenv('METRICS_SCRAPE_TIMEOUT', 1))
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def get_worker_metrics_port(worker_index):
+    # the supervisor serves the aggregated metrics on the configured port
+    return metrics.METRICS_PORT + 1 + worker_index
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.partition('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        body = metrics.aggregate(self._scrape()).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _scrape(self):
+        for worker_index in range(self.server.workers):
+            port = get_worker_metrics_port(worker_index)
+            url = f'http://{metrics.METRICS_IP}:{port}/metrics'
+            try:
+                with urlopen(url, timeout=METRICS_SCRAPE_TIMEOUT) as response:
+                    yield response.read().decode()
+            except (URLError, OSError) as error:
+                # the worker may be restarting right now
+                logger.warning('Metrics of worker %s are unavailable: %s',
+                               worker_index, error)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Supervisor:
+
+    def __init__(self, workers, run_worker, report_interval):
+        self.workers = workers
+        self.run_worker = run_worker
+        self.report_interval = report_interval
+
+        # every worker reports its latest average pps into its own slot
+        self.rates = RawArray('d', workers)
+        self.pids = {}
+        self._stop = False
+        self._stop_signal = signal.SIGTERM
+        self.metrics_server = None
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+
+        logger.info('Supervisor has been started: %s workers, pid: %s',
+                    self.workers, os.getpid())
+
+        for worker_index in range(self.workers):
+            self._spawn(worker_index)
+
+        if metrics.METRICS_PORT:
+            self._start_metrics_server()
+
+        last_report_time = monotonic()
+        while not self._stop:
+            sleep(POLL_INTERVAL)
+            self._reap()
+
+            current_time = monotonic()
+            if current_time - last_report_time >= self.report_interval:
+                self._report_rates()
+                last_report_time = current_time
+
+        self._shutdown()
+
+    def _start_metrics_server(self):
+        address = metrics.METRICS_IP, metrics.METRICS_PORT
+        self.metrics_server = ThreadingHTTPServer(address, MetricsHandler)
+        self.metrics_server.workers = self.workers
+        threading.Thread(target=self.metrics_server.serve_forever,
+                         daemon=True, name='metrics-server').start()
+        logger.info('Aggregated metrics are served on '
+                    'http://%s:%s/metrics', *address)
+
+    def _spawn(self, worker_index):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = worker_index
+            return
+
+        # child process: default signal disposition, the worker
+        # installs its own handlers on the event loop
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        exit_code = 0
+        try:
+            self.run_worker(worker_index, self._rate_reporter(worker_index))
+        except BaseException:
+            logger.exception('Worker %s has failed', worker_index)
+            exit_code = 1
+        finally:
+            logging.shutdown()
+            os._exit(exit_code)
+
+    def _rate_reporter(self, worker_index):
+        rates = self.rates
+
+        def report_rate(rate):
+            rates[worker_index] = rate
+
+        return report_rate
+
+    def _reap(self):
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+
+            worker_index = self.pids.pop(pid)
+            self.rates[worker_index] = 0
+            if self._stop:
+                continue
+
+            logger.warning('Worker %s (pid %s) has exited with code %s, '
+                           'restarting', worker_index, pid,
+                           os.waitstatus_to_exitcode(status))
+            sleep(RESTART_DELAY)
+            # a stop signal may have come during the delay
+            if self._stop:
+                return
+            self._spawn(worker_index)
+
+    def _report_rates(self):
+        rates = list(self.rates)
+        per_worker = ', '.join(f'#{index}: {rate:.02f}'
+                               for index, rate in enumerate(rates))
+        logger.info(f'{sum(rates):.02f} average pps in total '
+                    f'({per_worker})')
+
+    def _handle_signal(self, signum, frame):
+        self._stop = True
+        self._stop_signal = signum
+        self._signal_workers()
+
+    def _signal_workers(self):
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, self._stop_signal)
+            except ProcessLookupError:
+                pass
+
+    def _shutdown(self):
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        # workers spawned right before the stop signal have missed it,
+        # the others ignore a repeated one
+        self._signal_workers()
+        while self.pids:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            worker_index = self.pids.pop(pid, None)
+            logger.info('Worker %s (pid %s) has been stopped',
+                        worker_index, pid)
+        logger.info('Supervisor has been stopped')
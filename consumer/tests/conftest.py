@@ -0,0 +1,8 @@
+import os
+import sys
+
+
+# the consumer modules import each other as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# collectors are replaced with stubs unless enabled when they are imported
+os.environ.setdefault('COLLECT_STATS', '1')
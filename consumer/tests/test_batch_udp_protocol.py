@@ -0,0 +1,64 @@
+from protocols import batch_udp_protocol
+from protocols.batch_udp_protocol import BatchUDPProtocol
+from protocols.reliability import (
+    DATA_HEADER, DATA_MAGIC, RELIABLE_VERSION, AckTracker
+)
+
+
+class FakeLoop:
+
+    def call_later(self, delay, callback):
+        return None
+
+
+class FakeSocket:
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+
+class FakeFilter:
+
+    def admit_batch(self, packets, addresses):
+        admitted = [(packet, address) for packet, address in
+                    zip(packets, addresses) if bytes(packet) != b'junk']
+        return ([packet for packet, _ in admitted],
+                [address for _, address in admitted])
+
+
+class FakeConsumer:
+
+    def __init__(self):
+        self.loop = FakeLoop()
+        self.admission_filter = FakeFilter()
+        self.ingest_queue = None
+        self.batches = []
+
+    def consume_batch(self, packets):
+        self.batches.append([bytes(packet) for packet in packets])
+
+
+def sequenced(sequence, payload):
+    return DATA_HEADER.pack(DATA_MAGIC, RELIABLE_VERSION, 1, sequence,
+                            0) + payload
+
+
+def test_only_accepted_packets_are_confirmed(monkeypatch):
+    monkeypatch.setattr(batch_udp_protocol, 'CONFIRMATION', b'ok')
+    consumer = FakeConsumer()
+    protocol = BatchUDPProtocol(consumer)
+    protocol.socket = FakeSocket()
+    protocol.ack_tracker = AckTracker(consumer.loop, lambda ack, address: None)
+
+    packets = [sequenced(0, b'first'), b'junk', sequenced(0, b'first'),
+               sequenced(1, b'second')]
+    sender = '10.0.0.1', 1
+    addresses = [sender, ('10.0.0.2', 2), sender, sender]
+    monkeypatch.setattr(protocol, '_receive', lambda: (packets, addresses))
+    protocol._read_ready()
+
+    assert consumer.batches == [[b'first', b'second']]
+    assert protocol.socket.sent == [(b'ok', sender)] * 2
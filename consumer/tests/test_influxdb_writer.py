@@ -0,0 +1,57 @@
+import asyncio
+
+import aiohttp
+
+from writers import influxdb_writer
+from writers.influxdb_writer import InfluxDBWriter
+
+
+class FakeClient:
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.written = []
+
+    async def write(self, body):
+        if self.failures.get(body):
+            self.failures[body] -= 1
+            raise aiohttp.ClientError('unavailable')
+        self.written.append(body)
+
+    async def close(self):
+        pass
+
+
+def test_backoff_does_not_hold_a_connection(monkeypatch):
+    monkeypatch.setattr(influxdb_writer, 'INFLUXDB_RETRY_DELAY', 0.05)
+    loop = asyncio.new_event_loop()
+    writer = InfluxDBWriter(loop)
+    writer.client = FakeClient({'first': 1})
+    writer.session_created = True
+    writer.semaphore = asyncio.Semaphore(1)
+
+    async def write_both():
+        return await asyncio.gather(writer._write_body('first'),
+                                    writer._write_body('second'))
+
+    results = loop.run_until_complete(write_both())
+    loop.run_until_complete(writer.close())
+    loop.close()
+
+    assert results == [True, True]
+    # the second request is written while the first one is backing off
+    assert writer.client.written == ['second', 'first']
+
+
+def test_failed_requests_are_retried_later(monkeypatch):
+    monkeypatch.setattr(influxdb_writer, 'INFLUXDB_RETRY_DELAY', 0)
+    monkeypatch.setattr(influxdb_writer, 'INFLUXDB_RETRIES', 2)
+    loop = asyncio.new_event_loop()
+    writer = InfluxDBWriter(loop)
+    writer.client = FakeClient({'body': 3})
+    writer.session_created = True
+
+    assert loop.run_until_complete(writer._write_body('body')) is None
+    assert not writer.sink_available
+    loop.run_until_complete(writer.close())
+    loop.close()
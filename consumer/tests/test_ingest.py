@@ -0,0 +1,117 @@
+import asyncio
+import socket
+
+import pytest
+
+import ingest
+from ingest import DROP_NEWEST, DROP_OLDEST, SAMPLE, IngestQueue
+from protocols import batch_udp_protocol, udp_protocol
+from protocols.batch_udp_protocol import BatchUDPProtocol
+from protocols.udp_protocol import UDPProtocol
+
+
+class FakeLoop:
+
+    def __init__(self):
+        self.callbacks = []
+
+    def call_soon(self, callback):
+        self.callbacks.append(callback)
+
+
+class FakeConsumer:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.ingest_queue = None
+        self.admission_filter = None
+        self.processed = []
+
+    def process_batch(self, packets, weights=None):
+        self.processed.extend(packets)
+
+    def consume_packet(self, packet):
+        self.ingest_queue.put(packet)
+
+    def consume_batch(self, packets):
+        self.ingest_queue.put_batch(packets)
+
+
+def fill(policy, count, size=10):
+    consumer = FakeConsumer(FakeLoop())
+    queue = IngestQueue(consumer, size, policy)
+    queue.put_batch([str(index).encode() for index in range(count)])
+    return queue
+
+
+def test_drop_newest_keeps_the_first_packets():
+    queue = fill(DROP_NEWEST, 15)
+    assert (queue.accepted_count, queue.dropped_count,
+            queue.sampled_count) == (10, 5, 0)
+    assert list(queue.packets) == [str(index).encode()
+                                   for index in range(10)]
+    assert queue.pop_counters() == (10, 5, 0)
+    assert queue.pop_counters() == (0, 0, 0)
+
+
+def test_drop_oldest_keeps_the_last_packets():
+    queue = fill(DROP_OLDEST, 15)
+    assert (queue.accepted_count, queue.dropped_count,
+            queue.sampled_count) == (15, 5, 0)
+    assert list(queue.packets) == [str(index).encode()
+                                   for index in range(5, 15)]
+    assert list(queue.weights) == [1] * 10
+
+
+def test_sampled_packets_carry_inverse_probability(monkeypatch):
+    # every packet passes the sampling, the weights follow the fullness
+    monkeypatch.setattr(ingest.random, 'random', lambda: 0)
+    queue = fill(SAMPLE, 15)
+    assert (queue.accepted_count, queue.dropped_count,
+            queue.sampled_count) == (10, 5, 0)
+    assert list(queue.weights) == pytest.approx(
+        [1] * 6 + [1 / 0.8, 1 / 0.6, 1 / 0.4, 1 / 0.2]
+    )
+
+
+def test_sampling_drops_packets_above_threshold(monkeypatch):
+    monkeypatch.setattr(ingest.random, 'random', lambda: 0.99)
+    queue = fill(SAMPLE, 15)
+    assert (queue.accepted_count, queue.dropped_count,
+            queue.sampled_count) == (6, 0, 9)
+
+
+@pytest.mark.parametrize('protocol_class, module', [
+    (UDPProtocol, udp_protocol),
+    (BatchUDPProtocol, batch_udp_protocol),
+])
+def test_overload_is_shed_by_the_queue(protocol_class, module,
+                                       monkeypatch):
+    monkeypatch.setattr(module, 'LISTEN_ADDRESS', ('127.0.0.1', 0))
+    loop = asyncio.new_event_loop()
+    consumer = FakeConsumer(loop)
+    consumer.ingest_queue = IngestQueue(consumer, 50, DROP_NEWEST)
+    protocol = protocol_class(consumer)
+    protocol.start()
+    address = protocol.socket.getsockname()
+
+    # the datagrams are waiting in the socket before the loop runs
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sender:
+        for index in range(200):
+            sender.sendto(b'%d' % index, address)
+    loop.run_until_complete(asyncio.sleep(0.1))
+    protocol.stop()
+    loop.close()
+
+    queue = consumer.ingest_queue
+    assert (queue.accepted_count, queue.dropped_count) == (50, 150)
+    assert consumer.processed == [b'%d' % index for index in range(50)]
+
+
+def test_drained_batch_fits_the_budget(monkeypatch):
+    monkeypatch.setattr(ingest, 'INGEST_DRAIN_BUDGET', 0.002)
+    queue = fill(DROP_NEWEST, 10)
+    queue.packet_seconds = 0.001
+    queue._drain()
+    assert len(queue.consumer.processed) == 2
+    assert queue.loop.callbacks[-1] == queue._drain
@@ -0,0 +1,23 @@
+import metrics
+
+
+def test_workers_are_aggregated():
+    expositions = [
+        '# TYPE consumer_received_packets_total counter\n'
+        'consumer_received_packets_total 10\n'
+        '# TYPE consumer_spill_bytes gauge\n'
+        'consumer_spill_bytes 100\n'
+        '# TYPE consumer_stats_ring_occupancy gauge\n'
+        'consumer_stats_ring_occupancy 0.5\n',
+        '# TYPE consumer_received_packets_total counter\n'
+        'consumer_received_packets_total 5\n'
+        '# TYPE consumer_spill_bytes gauge\n'
+        'consumer_spill_bytes 20\n'
+        '# TYPE consumer_stats_ring_occupancy gauge\n'
+        'consumer_stats_ring_occupancy 0.25\n',
+    ]
+    lines = metrics.aggregate(expositions).splitlines()
+    assert 'consumer_received_packets_total 15' in lines
+    assert 'consumer_spill_bytes 120' in lines
+    # a fraction stays a fraction whatever the number of workers
+    assert 'consumer_stats_ring_occupancy 0.375' in lines
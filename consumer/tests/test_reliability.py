@@ -0,0 +1,64 @@
+from protocols.reliability import (
+    ACK_HEADER, DATA_HEADER, DATA_MAGIC, RELIABLE_VERSION, SEQUENCE_MODULO,
+    AckTracker, get_distance
+)
+
+
+ADDRESS = '127.0.0.1', 10000
+STREAM_ID = 7
+
+
+class FakeLoop:
+
+    def call_later(self, delay, callback):
+        return None
+
+
+def make_packet(sequence, base):
+    return DATA_HEADER.pack(DATA_MAGIC, RELIABLE_VERSION, STREAM_ID,
+                            sequence, base) + b'payload'
+
+
+def receive(tracker, sequence, base):
+    payload = tracker.receive(make_packet(sequence, base), ADDRESS)
+    return None if payload is None else bytes(payload)
+
+
+def test_distance_wraps_around():
+    assert get_distance(SEQUENCE_MODULO - 1, 0) == 1
+    assert get_distance(0, SEQUENCE_MODULO - 1) == -1
+    assert get_distance(SEQUENCE_MODULO - 10, 5) == 15
+    assert get_distance(5, 5) == 0
+
+
+def test_sequence_numbers_wrap_around():
+    acks = []
+    tracker = AckTracker(FakeLoop(), lambda ack, address: acks.append(ack))
+    first = SEQUENCE_MODULO - 2
+
+    assert receive(tracker, first, first) == b'payload'
+    # received out of order across the rollover
+    assert receive(tracker, 1, first + 1) == b'payload'
+    assert receive(tracker, first + 1, first + 1) == b'payload'
+    # the older packets are duplicates, not packets far ahead
+    assert receive(tracker, first, first) is None
+    assert receive(tracker, first + 1, first + 1) is None
+
+    tracker.flush()
+    _, _, _, expected, bitmap = ACK_HEADER.unpack(acks[-1])
+    # 0 is missing, 1 is acknowledged selectively
+    assert (expected, bitmap) == (0, 0b1)
+
+    assert receive(tracker, 0, 0) == b'payload'
+    tracker.flush()
+    _, _, _, expected, bitmap = ACK_HEADER.unpack(acks[-1])
+    assert (expected, bitmap) == (2, 0)
+
+
+def test_base_moves_the_stream_across_the_rollover():
+    tracker = AckTracker(FakeLoop(), lambda ack, address: None)
+    receive(tracker, SEQUENCE_MODULO - 1, SEQUENCE_MODULO - 1)
+    # the sender has given up on the packets up to 3
+    assert receive(tracker, 3, 3) == b'payload'
+    stream, = tracker.streams.values()
+    assert stream.expected == 4
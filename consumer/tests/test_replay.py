@@ -0,0 +1,122 @@
+import os
+from collections import Counter
+
+import msgpack
+import pytest
+
+import replay
+from collectors import StatsCollector
+from serialization import get_deserializer
+from writers import segment_writer
+from writers.segment_writer import SegmentWriter
+
+
+# an hour boundary, so the 1h window is shared by all the segments as well
+BASE_TIME = 1_767_225_600
+
+
+class FakeWriter:
+
+    def __init__(self):
+        self.points = []
+
+    @staticmethod
+    def serialize(entries):
+        return entries
+
+    async def write_bodies(self, bodies):
+        self.points.extend(bodies)
+
+    async def close(self):
+        pass
+
+
+def write_segments(directory, monkeypatch):
+    # packets of a segment every second, segments end
+    # and start in the middle of windows
+    consumer_directory = os.path.join(directory, 'consumer')
+    os.mkdir(consumer_directory)
+    writer = SegmentWriter()
+    for first, last in ((0, 15), (15, 25), (25, 75)):
+        seconds = iter(range(first, last))
+        monkeypatch.setattr(segment_writer, 'time_ns',
+                            lambda: (BASE_TIME + next(seconds)) * 10 ** 9)
+        writer.rotate(os.path.join(consumer_directory,
+                                   f'2026-01-01T00:00:{first:02d}'))
+        for second in range(first, last):
+            writer.append(msgpack.packb({
+                'country': f'country {second % 2}',
+                'user': f'user {second}',
+                'events': [{'type': 'event', 'duration': float(second)}],
+            }))
+    writer.close()
+
+
+def run_replay(directory, processes):
+    writers = []
+
+    def create_collector(consumer):
+        collector = StatsCollector(consumer, get_deserializer('msgpack'))
+        collector.influxdb_writer = FakeWriter()
+        writers.append(collector.influxdb_writer)
+        return collector
+
+    count = replay.replay(directory, processes=processes,
+                          create_collector=create_collector)
+    return count, [point for writer in writers for point in writer.points]
+
+
+def get_key(point):
+    return (point['measurement'], point['time'],
+            tuple(sorted(point['tags'].items())))
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_every_window_is_emitted_once(tmp_path, monkeypatch, processes):
+    write_segments(str(tmp_path), monkeypatch)
+    count, points = run_replay(str(tmp_path), processes)
+    assert count == 75
+
+    keys = Counter(get_key(point) for point in points)
+    assert max(keys.values()) == 1
+    counts = Counter()
+    for point in points:
+        if point['measurement'].startswith('events'):
+            counts[point['measurement']] += point['fields']['count']
+    assert counts == {'events': 75, 'events_1m': 75, 'events_1h': 75}
+    # 10s windows of the second 0 up to the second 70 per country
+    assert sum(measurement == 'events'
+               for measurement, _, _ in keys) == 2 * 8
+
+
+def test_parallel_replay_emits_the_same_points(tmp_path, monkeypatch):
+    write_segments(str(tmp_path), monkeypatch)
+    _, serial_points = run_replay(str(tmp_path), 1)
+    _, parallel_points = run_replay(str(tmp_path), 3)
+
+    serial = {get_key(point): point['fields'] for point in serial_points}
+    parallel = {get_key(point): point['fields'] for point in parallel_points}
+    assert parallel.keys() == serial.keys()
+    for key, fields in serial.items():
+        assert parallel[key] == pytest.approx(fields)
+
+
+class FirstPacketCollector(StatsCollector):
+
+    def collect_batch(self, batch, weights=None):
+        super().collect_batch(batch[:1], weights)
+
+
+def test_parallel_replay_refuses_other_collectors(tmp_path, monkeypatch):
+    write_segments(str(tmp_path), monkeypatch)
+
+    def create_collector(consumer):
+        collector = FirstPacketCollector(consumer, get_deserializer('msgpack'))
+        collector.influxdb_writer = FakeWriter()
+        return collector
+
+    with pytest.raises(ValueError, match='FirstPacketCollector'):
+        replay.replay(str(tmp_path), processes=3,
+                      create_collector=create_collector)
+    assert replay.replay(str(tmp_path), processes=1,
+                         create_collector=create_collector) == 75
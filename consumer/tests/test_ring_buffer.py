@@ -0,0 +1,95 @@
+import os
+import signal
+from collections import Counter
+from multiprocessing.shared_memory import SharedMemory
+
+import msgpack
+import pytest
+
+from collectors.ring_buffer import RingParserPool, SharedRing, _RingParser
+from serialization import get_deserializer
+
+
+deserialize = get_deserializer('msgpack')
+
+PACKET = msgpack.packb({'country': 'country', 'user': 'user',
+                        'events': [{'type': 'event', 'duration': 1.0}]})
+
+
+def get_counts(results):
+    counts = Counter()
+    for tables, _, _ in results:
+        for table in tables.values():
+            for country, event, count, *_ in table.items():
+                counts[country, event] += count
+    return counts
+
+
+def test_malformed_packets_are_counted_and_skipped():
+    ring = SharedRing(8, 1024)
+    try:
+        parser = _RingParser(ring, deserialize)
+        ring.put(PACKET, 0)
+        ring.put(b'\xc1 is never used by msgpack', 0)
+        ring.put(msgpack.packb({'user': 'no country'}), 0)
+        ring.put(PACKET, 0)
+        assert parser.process()
+
+        results = parser.pop_results()
+        assert results[2] == 2
+        assert get_counts([results]) == {('country', 'event'): 2}
+        assert ring.get_backlog() == 0
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_processing_is_limited():
+    ring = SharedRing(8, 1024)
+    try:
+        parser = _RingParser(ring, deserialize)
+        for _ in range(5):
+            ring.put(PACKET, 0)
+        # packets put after a flush are left to the next one
+        assert parser.process(3) == 3
+        assert ring.get_backlog() == 2
+        assert parser.process() == 2
+        assert parser.process() == 0
+    finally:
+        ring.close()
+        ring.unlink()
+
+
+def test_exited_parser_is_restarted():
+    pool = RingParserPool(deserialize, 2, slots=8, slot_size=1024)
+    names = [ring.name for ring in pool.rings]
+    try:
+        process = pool.processes[0]
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
+
+        # the results of the killed parser are lost, nothing hangs
+        assert get_counts(pool.collect()) == {}
+        assert pool.processes[0] is not process
+        assert pool.processes[0].is_alive()
+
+        for _ in range(4):
+            assert pool.put(PACKET, 0)
+        assert get_counts(pool.collect()) == {('country', 'event'): 4}
+    finally:
+        pool.stop()
+
+    for name in names:
+        with pytest.raises(FileNotFoundError):
+            SharedMemory(name)
+
+
+def test_stop_tolerates_exited_parsers():
+    pool = RingParserPool(deserialize, 1, slots=8, slot_size=1024)
+    name = pool.rings[0].name
+    os.kill(pool.processes[0].pid, signal.SIGKILL)
+    pool.processes[0].join()
+
+    pool.stop()
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name)
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+from writers import segment_writer
+from writers.codecs import CODEC_NONE, CODEC_ZLIB
+from writers.segment_reader import SegmentError, SegmentReader
+from writers.segment_writer import INDEX_SUFFIX, SegmentWriter
+
+
+RECORDS = [f'record {index}'.encode() * (index + 1) for index in range(20)]
+
+
+def write_segment(path, monkeypatch, codec=CODEC_NONE, records=RECORDS):
+    # a record every second, the buffer is rotated halfway
+    # so compressed segments get several blocks
+    seconds = iter(range(len(records)))
+    monkeypatch.setattr(segment_writer, 'time_ns',
+                        lambda: next(seconds) * 10 ** 9)
+    writer = SegmentWriter(codec)
+    writer.open(path)
+    for index, record in enumerate(records):
+        if index == len(records) // 2:
+            writer._submit_buffer()
+        writer.append(record)
+    writer.close()
+
+
+@pytest.mark.parametrize('codec', [CODEC_NONE, CODEC_ZLIB])
+def test_records_roundtrip(tmp_path, monkeypatch, codec):
+    path = str(tmp_path / 'segment')
+    write_segment(path, monkeypatch, codec)
+    assert os.path.exists(path + INDEX_SUFFIX)
+
+    with SegmentReader(path) as reader:
+        assert len(reader) == len(RECORDS)
+        assert reader.time_range == (0, (len(RECORDS) - 1) * 10 ** 9)
+        assert [bytes(record) for record in reader.records(verify=True)] == (
+            RECORDS
+        )
+        selected = [bytes(record) for record in
+                    reader.records(5 * 10 ** 9, 14 * 10 ** 9)]
+        assert selected == RECORDS[5:15]
+
+
+@pytest.mark.parametrize('codec', [CODEC_NONE, CODEC_ZLIB])
+def test_segment_of_a_crashed_consumer_is_scanned(tmp_path, monkeypatch,
+                                                  codec):
+    path = str(tmp_path / '2026-01-01T00:00:00')
+    write_segment(path, monkeypatch, codec)
+    os.unlink(path + INDEX_SUFFIX)
+    # the last record or block has been written partially
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as segment_file:
+        segment_file.truncate(size - 3)
+
+    with SegmentReader(path) as reader:
+        records = [bytes(record) for record in reader.records(verify=True)]
+        # without timestamps the segment is placed at its opening time
+        assert reader.time_range == (1_767_225_600 * 10 ** 9,) * 2
+    if codec == CODEC_NONE:
+        assert records == RECORDS[:-1]
+    else:
+        assert records == RECORDS[:len(RECORDS) // 2]
+
+
+def test_invalid_segments_are_refused(tmp_path, monkeypatch):
+    empty_path = str(tmp_path / 'empty')
+    open(empty_path, 'wb').close()
+    with pytest.raises(SegmentError, match='not a complete segment'):
+        SegmentReader(empty_path)
+
+    foreign_path = str(tmp_path / 'foreign')
+    with open(foreign_path, 'wb') as foreign_file:
+        foreign_file.write(b'not a segment at all')
+    with pytest.raises(SegmentError, match='not a raw data segment'):
+        SegmentReader(foreign_path)
+
+    path = str(tmp_path / 'segment')
+    write_segment(path, monkeypatch)
+    with open(path + INDEX_SUFFIX, 'r+b') as index_file:
+        index_file.write(b'XXXX')
+    with pytest.raises(SegmentError, match='index is corrupted'):
+        SegmentReader(path)
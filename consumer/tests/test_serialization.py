@@ -0,0 +1,110 @@
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import uuid
+
+import msgpack
+import pytest
+
+import serialization
+from binary_format import encode_binary_packet
+from serialization import (
+    PROJECTED_FIELDS, BinaryDictionary, deserialize_binary,
+    get_deserializer, selective_deserialize_json,
+    selective_deserialize_msgpack
+)
+
+
+def make_packet(index):
+    return msgpack.dumps({
+        'garbage': '0' * (index % 7) * 1000,
+        'country': f'country {index}',
+        'user': f'user {index}',
+        'events': [{'type': 'event', 'duration': index / 10}] * (index % 5),
+    })
+
+
+def expected(index):
+    packet = msgpack.loads(make_packet(index))
+    del packet['garbage']
+    return packet
+
+
+def test_selective_msgpack_skips_unused_fields():
+    assert selective_deserialize_msgpack(make_packet(3)) == expected(3)
+
+
+def test_selective_msgpack_recovers_after_malformed_packet():
+    with pytest.raises(Exception):
+        selective_deserialize_msgpack(b'\x83\xa7country')
+    assert selective_deserialize_msgpack(make_packet(4)) == expected(4)
+
+
+def test_selective_msgpack_is_thread_safe():
+    # threads are switched between the calls to the unpacker
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    packets = [make_packet(index) for index in range(10000)]
+    try:
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(selective_deserialize_msgpack,
+                                        packets))
+    finally:
+        sys.setswitchinterval(switch_interval)
+    assert results == [expected(index) for index in range(10000)]
+
+
+JSON_PACKETS = {
+    'escaped strings': rb"""{"garbage": "\"}]\\", "country": "a \"b\" \\",
+        "user": "\\\\", "events": [{"type": "]}\"\\", "duration": 1.5}]}""",
+    'nested unused fields': b"""{"meta": {"country": "no", "events": [1,
+        {"user": "}]"}, [[], {}]]}, "list": [{"events": []}, "[", null],
+        "country": "c", "user": "u", "tail": {"a": {"b": [true, false]}},
+        "events": [{"type": "e", "duration": 2, "extra": {"x": [1]}}]}""",
+    'whitespace': b"""\r\n\t { \t"country"\n:\r "c" ,\n\n"events" :[ {
+        "type" : "e" ,"duration":-1.5e-3 } ] ,"user"\t:\t"u"  ,
+        "garbage" : [ 1 , 2 ] }\n """,
+    'reordered keys': b"""{"events": [], "garbage": 1, "user": null,
+        "country": "c"}""",
+}
+
+
+@pytest.mark.parametrize('data', JSON_PACKETS.values(), ids=JSON_PACKETS)
+def test_selective_json_matches_json_loads(data):
+    packet = json.loads(data)
+    expected = {key: value for key, value in packet.items()
+                if key in PROJECTED_FIELDS}
+    assert selective_deserialize_json(data) == expected
+    assert selective_deserialize_json(memoryview(data)) == expected
+
+
+@pytest.mark.parametrize('data', [
+    b'[]', b'{"country": "c"', b'{"country" "c"}', b'{"garbage": "}',
+    b'{"country": "c" "user": "u"}',
+])
+def test_selective_json_refuses_malformed_packets(data):
+    with pytest.raises(ValueError):
+        selective_deserialize_json(data)
+
+
+def test_binary_packets_of_the_shared_format_are_decoded(monkeypatch):
+    dictionary = BinaryDictionary(7, ['country'], ['first', 'second'])
+    monkeypatch.setattr(serialization, '_binary_dictionary', dictionary)
+    user = uuid.uuid4().bytes
+
+    packet = deserialize_binary(
+        encode_binary_packet(7, 0, user, [(1, 2.5), (0, 0.5)])
+    )
+    assert (packet.country, packet.user) == (0, user)
+    assert packet.events.tolist() == [(1, 2.5), (0, 0.5)]
+
+    with pytest.raises(ValueError):
+        deserialize_binary(encode_binary_packet(8, 0, user, []))
+
+
+def test_binary_dictionary_path_is_required(monkeypatch):
+    monkeypatch.setattr(serialization, '_binary_dictionary', None)
+    monkeypatch.setattr(serialization, 'BINARY_DICTIONARY_PATH', None)
+    with pytest.raises(ValueError, match='BINARY_DICTIONARY_PATH'):
+        get_deserializer('binary')
@@ -0,0 +1,59 @@
+import os
+
+from writers.spill_queue import OFFSET_SUFFIX, SPILL_SUFFIX, SpillQueue
+
+
+def drain(queue):
+    bodies = []
+    while True:
+        entry = queue.peek()
+        if entry is None:
+            return bodies
+        segment, body, points = entry
+        bodies.append((body, points))
+        queue.ack(segment, body)
+
+
+def test_acknowledged_records_are_not_drained_again(tmp_path):
+    queue = SpillQueue(str(tmp_path))
+    for index in range(3):
+        queue.put(b'body %d' % index, index + 1)
+    segment, body, _ = queue.peek()
+    queue.ack(segment, body)
+    queue.close()
+
+    # the offset sidecar survives the restart of the consumer
+    filename, = [
+        name for name in os.listdir(tmp_path) if name.endswith(SPILL_SUFFIX)
+    ]
+    assert os.path.exists(tmp_path / (filename + OFFSET_SUFFIX))
+
+    adopted = SpillQueue(str(tmp_path))
+    assert drain(adopted) == [(b'body 1', 2), (b'body 2', 3)]
+    assert not adopted
+    # drained segments are removed together with their sidecars
+    assert os.listdir(tmp_path) == []
+    adopted.close()
+
+
+def test_segments_of_running_queues_are_not_adopted(tmp_path):
+    running = SpillQueue(str(tmp_path))
+    running.put(b'body', 1)
+
+    other = SpillQueue(str(tmp_path))
+    assert other.peek() is None
+    other.close()
+    running.close()
+
+
+def test_corrupted_tail_is_skipped(tmp_path):
+    queue = SpillQueue(str(tmp_path))
+    queue.put(b'complete', 1)
+    queue.put(b'truncated', 2)
+    path = queue.writing.path
+    queue.close()
+    os.truncate(path, os.path.getsize(path) - 1)
+
+    adopted = SpillQueue(str(tmp_path))
+    assert drain(adopted) == [(b'complete', 1)]
+    adopted.close()
@@ -0,0 +1,60 @@
+import threading
+
+from collectors import StatsCollector
+from collectors.stats_table import StatsTable
+from replay import ReplayConsumer, run_pending_tasks
+from serialization import get_deserializer
+
+
+class FakeWriter:
+
+    def __init__(self):
+        self.points = []
+
+    @staticmethod
+    def serialize(entries):
+        return entries
+
+    async def write_bodies(self, bodies):
+        self.points.extend(bodies)
+
+    async def close(self):
+        pass
+
+
+class BlockedPool:
+
+    # returns the results of the parsers only once the loop has run
+
+    def __init__(self, table):
+        self.table = table
+        self.released = threading.Event()
+
+    def collect(self):
+        assert self.released.wait(5)
+        return [({0: self.table}, [1, 0, 1, 0], 0)]
+
+    def stop(self):
+        pass
+
+
+def test_flush_does_not_block_the_loop():
+    table = StatsTable()
+    table.add_packets([{'country': 'country', 'user': 'user',
+                        'events': [{'type': 'event', 'duration': 1.0}]}])
+    collector = StatsCollector(ReplayConsumer('consumer'),
+                               get_deserializer('msgpack'))
+    collector.influxdb_writer = writer = FakeWriter()
+    collector.ring_pool = pool = BlockedPool(table)
+    collector.clock = lambda: 0
+
+    collector.flush(final=True)
+    collector.loop.call_soon(pool.released.set)
+    run_pending_tasks(collector.loop)
+    collector.stop()
+    collector.loop.close()
+
+    counts = {point['measurement']: point['fields']['count']
+              for point in writer.points
+              if point['measurement'].startswith('events')}
+    assert counts == {'events': 1, 'events_1m': 1, 'events_1h': 1}
@@ -0,0 +1,92 @@
+import pickle
+import random
+import uuid
+
+import numpy as np
+import pytest
+
+from collectors import ddsketch
+from collectors.stats_table import StatsTable
+
+
+COUNTRIES = [f'country {index}' for index in range(5)]
+EVENTS = [f'event {index}' for index in range(7)]
+
+
+def make_packets(count, seed=0):
+    generator = random.Random(seed)
+    return [{
+        'country': generator.choice(COUNTRIES),
+        'user': str(uuid.UUID(int=generator.getrandbits(128))),
+        'events': [{'type': generator.choice(EVENTS),
+                    'duration': generator.uniform(0.01, 300)}
+                   for _ in range(generator.randint(0, 20))],
+    } for _ in range(count)]
+
+
+def as_dict(table):
+    return {(country, event): (count, duration, maximum, quantiles)
+            for (country, event, count, duration, maximum, quantiles,
+                 _) in table.items()}
+
+
+def test_pickled_table_keeps_the_stats():
+    table = StatsTable()
+    table.add_packets(make_packets(32))
+    restored = pickle.loads(pickle.dumps(table))
+
+    assert as_dict(restored) == as_dict(table)
+    assert list(restored.users_items()) == list(table.users_items())
+    # sketches and registers are shipped sparse
+    assert len(pickle.dumps(table)) < table.sketches[:5, :7].nbytes
+
+
+def test_merged_tables_equal_a_single_one():
+    packets = make_packets(300)
+    single = StatsTable()
+    single.add_packets(packets)
+
+    merged = StatsTable()
+    for start in range(0, 300, 32):
+        part = StatsTable()
+        part.add_packets(packets[start:start + 32])
+        merged.merge(pickle.loads(pickle.dumps(part)))
+
+    expected = as_dict(single)
+    actual = as_dict(merged)
+    assert actual.keys() == expected.keys()
+    for cell, (count, duration, maximum, quantiles) in expected.items():
+        assert actual[cell][0] == count
+        assert actual[cell][1] == pytest.approx(duration)
+        assert actual[cell][2] == maximum
+        assert actual[cell][3] == quantiles
+    assert list(merged.users_items()) == list(single.users_items())
+
+
+def test_sketch_quantiles_are_within_the_relative_accuracy():
+    values = np.random.default_rng(0).lognormal(1, 2, 100_000)
+    values = np.clip(values, ddsketch.SKETCH_MIN_VALUE,
+                     ddsketch.SKETCH_MAX_VALUE)
+    bins = np.bincount(ddsketch.get_bins(values),
+                       minlength=ddsketch.SKETCH_BINS)
+    estimates = ddsketch.get_quantiles(bins, values.max())
+    exact = np.quantile(values, ddsketch.QUANTILES, method='lower')
+    for estimate, value in zip(estimates, exact):
+        assert abs(estimate - value) <= (
+            ddsketch.SKETCH_RELATIVE_ACCURACY * value * 1.01
+        )
+
+
+def test_distinct_users_are_estimated_after_merges():
+    users = [str(uuid.UUID(int=index)) for index in range(20_000)]
+    packets = [{'country': 'country', 'user': user, 'events': []}
+               for user in users]
+    merged = StatsTable()
+    # every user is seen by two of the parts
+    for start in range(0, 20_000, 1000):
+        part = StatsTable()
+        part.add_packets(packets[start:start + 2000])
+        merged.merge(part)
+
+    (_, estimate), = merged.users_items()
+    assert estimate == pytest.approx(20_000, rel=0.05)
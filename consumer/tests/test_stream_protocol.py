@@ -0,0 +1,62 @@
+from protocols import stream_protocol
+from protocols.stream_protocol import FRAME_HEADER, _FramedConnection
+
+
+class FakeConsumer:
+
+    def __init__(self):
+        self.admission_filter = None
+        self.frames = []
+
+    def consume_batch(self, frames):
+        self.frames.extend(bytes(frame) for frame in frames)
+
+
+class FakeServer:
+
+    def __init__(self):
+        self.consumer = FakeConsumer()
+
+    def is_overloaded(self):
+        return False
+
+
+def feed(connection, data):
+    # the transport fills the buffers the protocol provides
+    while data:
+        buffer = connection.get_buffer(-1)
+        size = min(len(buffer), len(data))
+        buffer[:size] = data[:size]
+        connection.buffer_updated(size)
+        data = data[size:]
+
+
+def frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+def test_buffer_shrinks_after_a_large_frame(monkeypatch):
+    monkeypatch.setattr(stream_protocol, 'STREAM_BUFFER_SIZE', 64)
+    connection = _FramedConnection(FakeServer())
+    large = b'x' * 1000
+
+    feed(connection, frame(b'small') + frame(large)[:500])
+    assert len(connection.buffer) == FRAME_HEADER.size + len(large)
+
+    feed(connection, frame(large)[500:] + frame(b'next')[:3])
+    assert len(connection.buffer) == 64
+    feed(connection, frame(b'next')[3:])
+    assert connection.server.consumer.frames == [b'small', large, b'next']
+    assert connection.end == 0
+
+
+def test_buffer_is_kept_for_consecutive_large_frames(monkeypatch):
+    monkeypatch.setattr(stream_protocol, 'STREAM_BUFFER_SIZE', 64)
+    connection = _FramedConnection(FakeServer())
+    large = b'x' * 1000
+
+    feed(connection, frame(large) + frame(large)[:10])
+    assert len(connection.buffer) == FRAME_HEADER.size + len(large)
+    feed(connection, frame(large)[10:])
+    assert connection.server.consumer.frames == [large, large]
+    assert len(connection.buffer) == 64
@@ -0,0 +1,22 @@
+import os
+
+import supervisor
+from supervisor import Supervisor
+
+
+def exit_at_once(worker_index, report_rate):
+    os._exit(3)
+
+
+def test_no_restart_after_stop_during_delay(monkeypatch):
+    workers = Supervisor(1, exit_at_once, report_interval=60)
+    workers._spawn(0)
+    os.waitid(os.P_ALL, 0, os.WEXITED | os.WNOWAIT)
+
+    # the stop signal comes while the supervisor waits to restart
+    monkeypatch.setattr(supervisor, 'sleep',
+                        lambda delay: setattr(workers, '_stop', True))
+    workers._reap()
+
+    assert workers.pids == {}
+    workers._shutdown()
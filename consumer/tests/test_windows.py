@@ -0,0 +1,68 @@
+from collections import Counter
+
+from collectors.windows import WindowedStats
+
+
+def make_packet(country, event):
+    return {'country': country, 'user': f'{country} user',
+            'events': [{'type': event, 'duration': 1.0}]}
+
+
+def test_rollups_add_up_to_the_windows():
+    windows = WindowedStats([10, 60, 3600], grace=2)
+    emitted = []
+
+    def emit(level, label, start, table):
+        emitted.append((label, start, Counter(
+            {(country, event): count
+             for country, event, count, *_ in table.items()}
+        )))
+        windows.recycle(table)
+
+    expected = Counter()
+    # two hours of packets, a window is closed every 5 seconds
+    for timestamp in range(7200, 14400, 5):
+        cell = f'country {timestamp % 3}', f'event {timestamp % 4}'
+        windows.get_table(windows.get_start(timestamp), emit).add_packets(
+            [make_packet(*cell)]
+        )
+        expected[cell] += 1
+        windows.close(timestamp, emit)
+    windows.close(14400, emit, final=True)
+
+    totals = {}
+    for label, start, counts in emitted:
+        totals.setdefault(label, Counter()).update(counts)
+    assert totals == {'10s': expected, '1m': expected, '1h': expected}
+
+    starts = Counter((label, start) for label, start, _ in emitted)
+    assert max(starts.values()) == 1
+    assert sum(label == '1h' for label, _ in starts) == 2
+    assert sum(label == '1m' for label, _ in starts) == 120
+
+
+def test_recycled_tables_come_back_empty():
+    windows = WindowedStats([10], grace=0)
+    table = windows.get_table(0, None)
+    table.add_packets([make_packet('country', 'event')])
+    windows.close(10, lambda *args: windows.recycle(args[3]))
+
+    # the slot of the next window but one gets the same table back
+    assert windows.get_table(20, None) is table
+    assert list(table.items()) == []
+    assert list(table.users_items()) == []
+
+
+def test_rollups_are_merged_when_windows_close():
+    windows = WindowedStats([10, 60], grace=0)
+    emitted = []
+    windows.get_table(0, None).add_packets([make_packet('country', 'event')])
+    windows.close(10, lambda *args: emitted.append(args))
+
+    # the closed table is still owned by the emitter,
+    # the open rollup has its packets already
+    (_, label, start, table), = emitted
+    assert (label, start) == ('10s', 0)
+    rollup = windows._get_table(1, 0, None)
+    assert [count for _, _, count, *_ in rollup.items()] == [1]
+    assert [count for _, _, count, *_ in table.items()] == [1]
@@ -0,0 +1,5 @@
+from .influxdb_writer import InfluxDBWriter
+from .segment_writer import SegmentWriter
+
+
+__all__ = ['InfluxDBWriter', 'SegmentWriter']
@@ -0,0 +1,66 @@
+import lzma
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODEC_LZ4 = 3
+CODEC_ZSTD = 4
+
+CODEC_IDS = {
+    'none': CODEC_NONE,
+    'zlib': CODEC_ZLIB,
+    'lzma': CODEC_LZMA,
+    'lz4': CODEC_LZ4,
+    'zstd': CODEC_ZSTD,
+}
+
+
+def get_compressor(codec, level=None):
+    if codec == CODEC_ZLIB:
+        level = 6 if level is None else level
+        return lambda data: zlib.compress(data, level)
+    if codec == CODEC_LZMA:
+        level = 1 if level is None else level
+        return lambda data: lzma.compress(data, preset=level)
+    if codec == CODEC_LZ4 and lz4:
+        level = 0 if level is None else level
+        return lambda data: lz4.frame.compress(data, compression_level=level)
+    if codec == CODEC_ZSTD and zstandard:
+        return zstandard.ZstdCompressor(level=3 if level is None
+                                        else level).compress
+    raise ValueError(f'Codec {codec} is not available')
+
+
+def get_decompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress
+    if codec == CODEC_LZMA:
+        return lzma.decompress
+    if codec == CODEC_LZ4 and lz4:
+        return lz4.frame.decompress
+    if codec == CODEC_ZSTD and zstandard:
+        return zstandard.ZstdDecompressor().decompress
+    raise ValueError(f'Codec {codec} is not available')
+
+
+def get_codec_id(name):
+    try:
+        codec = CODEC_IDS[name]
+    except KeyError:
+        raise ValueError(f'{name} compression is not supported')
+    if codec != CODEC_NONE:
+        # fails early when an optional library is not installed
+        get_compressor(codec)
+    return codec
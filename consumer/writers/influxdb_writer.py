@@ -0,0 +1,230 @@
+import asyncio
+import logging
+import warnings
+from os import getenv
+from time import monotonic
+
+import aiohttp
+
+import metrics
+
+from .spill_queue import SpillQueue
+
+warnings.filterwarnings('ignore', module='aioinflux.compat')
+from aioinflux import InfluxDBClient, InfluxDBWriteError  # noqa: E402
+from aioinflux.serialization import serialize  # noqa: E402
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+INFLUXDB_HOST = getenv('INFLUXDB_HOST', '127.0.0.1')
+INFLUXDB_PORT = int(getenv('INFLUXDB_PORT', 8086))
+INFLUXDB_DB = getenv('INFLUXDB_DB', 'highload-demo')
+
+INFLUXDB_BATCH_SIZE = int(getenv('INFLUXDB_BATCH_SIZE', 5000))
+INFLUXDB_MAX_IN_FLIGHT = int(getenv('INFLUXDB_MAX_IN_FLIGHT', 4))
+INFLUXDB_TIMEOUT = float(getenv('INFLUXDB_TIMEOUT', 10))
+INFLUXDB_RETRIES = int(getenv('INFLUXDB_RETRIES', 3))
+INFLUXDB_RETRY_DELAY = float(getenv('INFLUXDB_RETRY_DELAY', 0.5))
+# requests waiting for a free connection, the rest is spilled
+INFLUXDB_MAX_QUEUED = int(getenv('INFLUXDB_MAX_QUEUED',
+                                 4 * INFLUXDB_MAX_IN_FLIGHT))
+
+INFLUXDB_SPILL = getenv('INFLUXDB_SPILL') == '1'
+SPILL_DRAIN_RATE = float(getenv('SPILL_DRAIN_RATE', 20000))
+SPILL_RETRY_DELAY = float(getenv('SPILL_RETRY_DELAY', 1))
+SPILL_MAX_RETRY_DELAY = float(getenv('SPILL_MAX_RETRY_DELAY', 30))
+
+
+SPILLED = 'spilled'
+
+
+class InfluxDBWriter:
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.client = InfluxDBClient(host=INFLUXDB_HOST, port=INFLUXDB_PORT,
+                                     db=INFLUXDB_DB, timeout=INFLUXDB_TIMEOUT,
+                                     loop=loop)
+        self.semaphore = asyncio.Semaphore(INFLUXDB_MAX_IN_FLIGHT)
+        self.session_created = False
+        self.pending_tasks = set()
+        self.queued = 0
+
+        # failed requests are kept on the disk and written later
+        self.spill_queue = SpillQueue() if INFLUXDB_SPILL else None
+        self.sink_available = True
+        self.drain_handle = None
+        self.drain_delay = SPILL_RETRY_DELAY
+        self.closing = False
+        if self.spill_queue:
+            self._schedule_drain(0)
+
+    @staticmethod
+    def serialize(entries):
+        bodies = []
+        for start in range(0, len(entries), INFLUXDB_BATCH_SIZE):
+            chunk = entries[start:start + INFLUXDB_BATCH_SIZE]
+            bodies.append((serialize(chunk), len(chunk)))
+        return bodies
+
+    def write(self, entries):
+        if not entries:
+            return None
+
+        bodies = self.serialize(entries)
+        task = self.loop.create_task(self.write_bodies(bodies))
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+        return task
+
+    async def _create_session(self):
+        # a single keep-alive pool is shared by all the requests
+        self.session_created = True
+        await self.client.create_session(
+            connector=aiohttp.TCPConnector(limit=INFLUXDB_MAX_IN_FLIGHT)
+        )
+
+    async def write_bodies(self, bodies):
+        if not self.session_created:
+            await self._create_session()
+
+        start_time = monotonic()
+        results = await asyncio.gather(*(self._write_or_spill(body, points)
+                                         for body, points in bodies))
+        duration = monotonic() - start_time
+
+        written = spilled = 0
+        for (_, points), result in zip(bodies, results):
+            if result is True:
+                written += points
+            elif result is SPILLED:
+                spilled += points
+        failed = sum(points for _, points in bodies) - written - spilled
+        metrics.INFLUXDB_POINTS_WRITTEN.inc(written)
+        metrics.INFLUXDB_POINTS_LOST.inc(failed)
+        logger.info(f'{written} points were written with {len(bodies)} '
+                    f'requests in {duration:.03f} seconds'
+                    + (f', {spilled} points were spilled' if spilled else '')
+                    + (f', {failed} points were lost' if failed else ''))
+
+    async def _write_or_spill(self, body, points):
+        spill_queue = self.spill_queue
+        if spill_queue is not None and (not self.sink_available
+                                        or self.queued >= INFLUXDB_MAX_QUEUED):
+            # the sink is down or slow, memory usage stays flat
+            return await self._spill(body, points)
+
+        self.queued += 1
+        try:
+            result = await self._write_body(body)
+        finally:
+            self.queued -= 1
+
+        if result is None and spill_queue is not None:
+            return await self._spill(body, points)
+        return bool(result)
+
+    async def _spill(self, body, points):
+        try:
+            await self.loop.run_in_executor(None, self.spill_queue.put,
+                                            body, points)
+        except OSError:
+            logger.exception('Spilling of %s points has failed', points)
+            return False
+
+        metrics.SPILLED_POINTS.inc(points)
+        self._schedule_drain(self.drain_delay)
+        return SPILLED
+
+    def _schedule_drain(self, delay):
+        if self.drain_handle is None and not self.closing:
+            self.drain_handle = self.loop.call_later(delay, self._start_drain)
+
+    def _start_drain(self):
+        # a single record per task, so stopping never waits for the drainer
+        self.drain_handle = None
+        task = self.loop.create_task(self._drain_once())
+        self.pending_tasks.add(task)
+        task.add_done_callback(self.pending_tasks.discard)
+
+    async def _drain_once(self):
+        if not self.session_created:
+            await self._create_session()
+
+        entry = await self.loop.run_in_executor(None, self.spill_queue.peek)
+        if entry is None:
+            return
+        segment, body, points = entry
+
+        async with self.semaphore:
+            try:
+                await self.client.write(body)
+            except (InfluxDBWriteError, aiohttp.ClientError,
+                    asyncio.TimeoutError) as error:
+                if isinstance(error, InfluxDBWriteError) and (
+                    error.status < 500 and error.status != 429
+                ):
+                    logger.error('Spilled points have been rejected: %s',
+                                 error)
+                else:
+                    self.sink_available = False
+                    self.drain_delay = min(self.drain_delay * 2,
+                                           SPILL_MAX_RETRY_DELAY)
+                    self._schedule_drain(self.drain_delay)
+                    return
+
+        await self.loop.run_in_executor(None, self.spill_queue.ack,
+                                        segment, body)
+        metrics.DRAINED_POINTS.inc(points)
+        self.sink_available = True
+        self.drain_delay = SPILL_RETRY_DELAY
+        # the rate of draining is limited to let the sink recover
+        self._schedule_drain(points / SPILL_DRAIN_RATE)
+
+    async def _write_body(self, body):
+        for attempt in range(INFLUXDB_RETRIES + 1):
+            # a connection is held for a single request only,
+            # other requests go on while this one is backing off
+            async with self.semaphore:
+                start_time = monotonic()
+                try:
+                    await self.client.write(body)
+                    self.sink_available = True
+                    return True
+                except InfluxDBWriteError as error:
+                    if error.status < 500 and error.status != 429:
+                        logger.error('Points have been rejected: %s', error)
+                        return False
+                    reason = error
+                except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                    reason = str(error) or error.__class__.__name__
+                finally:
+                    metrics.INFLUXDB_REQUEST_SECONDS.observe(
+                        monotonic() - start_time
+                    )
+
+            if attempt < INFLUXDB_RETRIES:
+                delay = INFLUXDB_RETRY_DELAY * 2 ** attempt
+                metrics.INFLUXDB_RETRIES.inc()
+                logger.warning(f'Writing has failed ({reason}), '
+                               f'retrying in {delay:.02f} seconds')
+                await asyncio.sleep(delay)
+
+        logger.error('Writing has failed after %s attempts: %s',
+                     INFLUXDB_RETRIES + 1, reason)
+        self.sink_available = False
+        # None means that the request may be retried later
+        return None
+
+    async def close(self):
+        self.closing = True
+        if self.drain_handle is not None:
+            self.drain_handle.cancel()
+        if self.pending_tasks:
+            await asyncio.wait(self.pending_tasks)
+        if self.spill_queue is not None:
+            self.spill_queue.close()
+        await self.client.close()
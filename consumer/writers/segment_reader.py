@@ -0,0 +1,204 @@
+import mmap
+import os
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from zlib import crc32
+
+from .codecs import CODEC_NONE, get_decompressor
+from .segment_writer import (
+    BLOCK_HEADER, INDEX_BLOCKS_HEADER, INDEX_HEADER, INDEX_MAGIC,
+    INDEX_SUFFIX, RECORD_HEADER, SEGMENT_HEADER, SEGMENT_MAGIC,
+)
+
+
+class SegmentError(Exception):
+    pass
+
+
+def parse_segment_time(path):
+    # segments are named after the UTC time they were opened at
+    try:
+        opened_at = datetime.fromisoformat(os.path.basename(path))
+    except ValueError:
+        return None
+    return int(opened_at.replace(tzinfo=timezone.utc).timestamp() * 10 ** 9)
+
+
+def _read_array(data, position, count):
+    values = array('Q')
+    values.frombytes(data[position:position + count * values.itemsize])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values, position + count * values.itemsize
+
+
+class SegmentReader:
+
+    # Records are returned as memoryviews of the mapped file (or of the
+    # decompressed block): they must be released before the reader
+    # is closed, so don't keep them around.
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as segment_file:
+            if os.fstat(segment_file.fileno()).st_size:
+                self.mmap = mmap.mmap(segment_file.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+            else:
+                self.mmap = None
+        self.view = memoryview(self.mmap) if self.mmap else memoryview(b'')
+
+        if len(self.view) < SEGMENT_HEADER.size:
+            raise SegmentError(f'{path} is not a complete segment')
+        magic, _, codec, _ = SEGMENT_HEADER.unpack_from(self.view)
+        if magic != SEGMENT_MAGIC:
+            raise SegmentError(f'{path} is not a raw data segment')
+        self.codec = codec
+        self.decompress = (get_decompressor(codec)
+                           if codec != CODEC_NONE else None)
+
+        self.block_offsets = self.block_starts = None
+        self.timestamps = None
+        if not self._read_index():
+            self._scan()
+
+    def _read_index(self):
+        try:
+            with open(self.path + INDEX_SUFFIX, 'rb') as index_file:
+                data = index_file.read()
+        except FileNotFoundError:
+            return False
+
+        magic, _, count, _, _ = INDEX_HEADER.unpack_from(data)
+        if magic != INDEX_MAGIC:
+            raise SegmentError(f'{self.path} index is corrupted')
+
+        position = INDEX_HEADER.size
+        self.offsets, position = _read_array(data, position, count)
+        self.timestamps, position = _read_array(data, position, count)
+        if self.codec != CODEC_NONE:
+            blocks, = INDEX_BLOCKS_HEADER.unpack_from(data, position)
+            position += INDEX_BLOCKS_HEADER.size
+            self.block_offsets, position = _read_array(data, position,
+                                                       blocks)
+            self.block_starts, position = _read_array(data, position,
+                                                      blocks)
+        return True
+
+    def _scan(self):
+        # segments of crashed consumers have no index,
+        # the last record or block may be incomplete there
+        if self.codec == CODEC_NONE:
+            self.offsets = self._scan_records(self.view, SEGMENT_HEADER.size)
+            return
+
+        self.offsets = array('Q')
+        self.block_offsets = array('Q')
+        self.block_starts = array('Q')
+        view = self.view
+        position = SEGMENT_HEADER.size
+        stream_offset = 0
+        end = len(view)
+        while position + BLOCK_HEADER.size <= end:
+            size, raw_size, _, _ = BLOCK_HEADER.unpack_from(view, position)
+            if position + BLOCK_HEADER.size + size > end:
+                break
+            block = self._read_block(position)
+            self.offsets.extend(
+                stream_offset + offset
+                for offset in self._scan_records(block, 0)
+            )
+            self.block_offsets.append(position)
+            self.block_starts.append(stream_offset)
+            position += BLOCK_HEADER.size + size
+            stream_offset += raw_size
+
+    @staticmethod
+    def _scan_records(view, position):
+        offsets = array('Q')
+        end = len(view)
+        while position + RECORD_HEADER.size <= end:
+            size, _ = RECORD_HEADER.unpack_from(view, position)
+            if position + RECORD_HEADER.size + size > end:
+                break
+            offsets.append(position)
+            position += RECORD_HEADER.size + size
+        return offsets
+
+    def _read_block(self, offset):
+        size, _, _, checksum = BLOCK_HEADER.unpack_from(self.view, offset)
+        start = offset + BLOCK_HEADER.size
+        compressed = self.view[start:start + size]
+        if crc32(compressed) != checksum:
+            raise SegmentError(f'{self.path} block at {offset} '
+                               f'is corrupted')
+        return memoryview(self.decompress(compressed))
+
+    @property
+    def time_range(self):
+        if self.timestamps:
+            return self.timestamps[0], self.timestamps[-1]
+        opened_at = parse_segment_time(self.path)
+        return opened_at, opened_at
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def records(self, start_time=None, end_time=None, verify=False):
+        first, last = 0, len(self.offsets)
+        if self.timestamps:
+            if start_time is not None:
+                first = bisect_left(self.timestamps, start_time)
+            if end_time is not None:
+                last = bisect_right(self.timestamps, end_time)
+
+        if self.codec == CODEC_NONE:
+            return self._read_records(self.view, self.offsets[first:last],
+                                      0, verify)
+        return self._read_blocks(self.offsets[first:last], verify)
+
+    def _read_blocks(self, offsets, verify):
+        # every block is decompressed once and only when it is needed
+        block_starts = self.block_starts
+        position = 0
+        while position < len(offsets):
+            block_index = bisect_right(block_starts, offsets[position]) - 1
+            block_start = block_starts[block_index]
+            if block_index + 1 < len(block_starts):
+                block_end = block_starts[block_index + 1]
+            else:
+                block_end = offsets[-1] + 1
+            block_records = bisect_left(offsets, block_end, position)
+
+            block = self._read_block(self.block_offsets[block_index])
+            yield from self._read_records(block, offsets[position:
+                                                         block_records],
+                                          block_start, verify)
+            block.release()
+            position = block_records
+
+    def _read_records(self, view, offsets, base_offset, verify):
+        header_size = RECORD_HEADER.size
+        unpack_from = RECORD_HEADER.unpack_from
+        for offset in offsets:
+            offset -= base_offset
+            size, checksum = unpack_from(view, offset)
+            start = offset + header_size
+            record = view[start:start + size]
+            if verify and crc32(record) != checksum:
+                raise SegmentError(f'{self.path} record at {offset} '
+                                   f'is corrupted')
+            yield record
+
+    def close(self):
+        self.view.release()
+        if self.mmap:
+            self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,365 @@
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+from array import array
+from os import getenv
+from time import perf_counter, time_ns
+from zlib import crc32
+
+import metrics
+
+from .codecs import CODEC_NONE, get_compressor
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+RAW_BUFFER_SIZE = int(getenv('RAW_BUFFER_SIZE', 4 * 2 ** 20))
+RAW_BUFFERS = int(getenv('RAW_BUFFERS', 8))
+RAW_CLOSE_TIMEOUT = float(getenv('RAW_CLOSE_TIMEOUT', 10))
+
+SEGMENT_MAGIC = b'HLRD'
+SEGMENT_VERSION = 1
+
+# magic, version, codec, reserved
+SEGMENT_HEADER = struct.Struct('<4sBBH')
+# payload length, payload crc32
+RECORD_HEADER = struct.Struct('<II')
+# compressed length, raw length, records count, compressed data crc32;
+# records of compressed segments are stored in independent blocks
+BLOCK_HEADER = struct.Struct('<IIII')
+
+INDEX_SUFFIX = '.idx'
+INDEX_MAGIC = b'HLRI'
+INDEX_VERSION = 1
+# magic, version, records count, first and last record timestamps (ns),
+# followed by the arrays of record offsets and timestamps (uint64);
+# compressed segments have the blocks count and arrays of block file
+# offsets and their starts in the uncompressed records stream in addition
+INDEX_HEADER = struct.Struct('<4sB3xQQQ')
+INDEX_BLOCKS_HEADER = struct.Struct('<Q')
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+_OPEN = 'open'
+_DATA = 'data'
+_CLOSE = 'close'
+_STOP = 'stop'
+
+
+class _Segment:
+
+    # state of an open segment, owned by the writer thread
+
+    def __init__(self, path, fd, codec):
+        self.path = path
+        self.fd = fd
+        self.codec = codec
+        self.offset = SEGMENT_HEADER.size
+        self.stream_offset = 0
+        self.offsets = array('Q')
+        self.timestamps = array('Q')
+        self.block_offsets = array('Q')
+        self.block_starts = array('Q')
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.processing_time = 0
+
+
+class SegmentWriter:
+
+    # Records are accumulated in a fixed pool of large buffers on the loop
+    # thread. Full buffers are transformed, compressed, indexed and written
+    # by a single writer thread.
+
+    def __init__(self, codec=CODEC_NONE, compression_level=None,
+                 transform=None):
+        self.codec = codec
+        self.compress = (get_compressor(codec, compression_level)
+                         if codec != CODEC_NONE else None)
+        self.transform = transform
+
+        self.buffers_count = max(RAW_BUFFERS, 2)
+        self.free_buffers = queue.SimpleQueue()
+        for _ in range(self.buffers_count):
+            self.free_buffers.put(bytearray(RAW_BUFFER_SIZE))
+        self.commands = queue.SimpleQueue()
+
+        self.fd = None
+        self.buffer = None
+        self.view = None
+        self.timestamps = None
+        self.position = 0
+        self.dropped = 0
+
+        metrics.RAW_BACKLOG.set_function(self.get_backlog)
+
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name='segment-writer')
+        self.thread.start()
+
+    def get_backlog(self):
+        # buffers submitted to the writer thread and not returned yet
+        filling = 1 if self.buffer is not None else 0
+        return self.buffers_count - self.free_buffers.qsize() - filling
+
+    def _acquire_buffer(self):
+        try:
+            self.buffer = self.free_buffers.get_nowait()
+        except queue.Empty:
+            self.buffer = self.view = None
+            return False
+        self.view = memoryview(self.buffer)
+        self.timestamps = array('Q')
+        self.position = 0
+        return True
+
+    def _submit_buffer(self):
+        if self.buffer is not None and self.position:
+            self.commands.put((_DATA, self.fd, self.buffer, self.position,
+                               self.timestamps))
+            self.buffer = self.view = self.timestamps = None
+
+    def open(self, path):
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        self.dropped = 0
+        self.commands.put((_OPEN, self.fd, path))
+
+    def append(self, data):
+        size = len(data)
+        record_size = RECORD_HEADER.size + size
+
+        if record_size > RAW_BUFFER_SIZE:
+            # keeping the order of records
+            self._submit_buffer()
+            record = RECORD_HEADER.pack(size, crc32(data)) + bytes(data)
+            self.commands.put((_DATA, self.fd, record, None,
+                               array('Q', (time_ns(),))))
+            return
+
+        position = self.position
+        if self.buffer is None or position + record_size > RAW_BUFFER_SIZE:
+            self._submit_buffer()
+            if not self._acquire_buffer():
+                # the disk can't keep up, memory usage stays fixed
+                self.dropped += 1
+                metrics.RAW_DROPPED_PACKETS.inc()
+                return
+            position = 0
+
+        RECORD_HEADER.pack_into(self.buffer, position, size, crc32(data))
+        position += RECORD_HEADER.size
+        self.view[position:position + size] = data
+        self.position = position + size
+        self.timestamps.append(time_ns())
+
+    def rotate(self, path):
+        if self.fd is not None:
+            self.close_segment()
+        self.open(path)
+
+    def close_segment(self):
+        # does not wait for the writer thread, which closes the file
+        # and writes the sidecar index itself
+        self._submit_buffer()
+        self.commands.put((_CLOSE, self.fd))
+        if self.dropped:
+            logger.warning(f'{self.dropped} raw packets were dropped '
+                           f'because all the buffers were busy')
+        self.fd = None
+
+    def close(self):
+        if self.fd is not None:
+            self.close_segment()
+        self.commands.put((_STOP,))
+        self.thread.join(RAW_CLOSE_TIMEOUT)
+        if self.thread.is_alive():
+            logger.error('Raw data writing has not been completed in %s '
+                         'seconds', RAW_CLOSE_TIMEOUT)
+
+    def _run(self):
+        commands = self.commands
+        segments = {}
+        while True:
+            batch = [commands.get()]
+            # everything queued so far goes out with a single writev
+            while True:
+                try:
+                    batch.append(commands.get_nowait())
+                except queue.Empty:
+                    break
+
+            chunks = []
+            buffers = []
+            fd = None
+            for command in batch:
+                kind = command[0]
+                if chunks and (kind != _DATA or command[1] != fd):
+                    self._write(fd, chunks, buffers)
+                    chunks = []
+                    buffers = []
+
+                if kind == _DATA:
+                    _, fd, data, length, timestamps = command
+                    chunk, buffer = self._process(segments[fd], data, length,
+                                                  timestamps)
+                    chunks.append(chunk)
+                    if buffer is not None:
+                        buffers.append(buffer)
+                elif kind == _OPEN:
+                    _, fd, path = command
+                    segments[fd] = _Segment(path, fd, self.codec)
+                    chunks.append(SEGMENT_HEADER.pack(
+                        SEGMENT_MAGIC, SEGMENT_VERSION, self.codec, 0
+                    ))
+                elif kind == _CLOSE:
+                    segment = segments.pop(command[1])
+                    os.close(segment.fd)
+                    self._finish(segment)
+                else:
+                    return
+            if chunks:
+                self._write(fd, chunks, buffers)
+
+    def _process(self, segment, data, length, timestamps):
+        # returns the chunk to write and the pooled buffer it still refers to
+        start_time = perf_counter()
+        view = memoryview(data)[:length]
+        raw_size = len(view)
+        pooled = length is not None
+
+        if self.transform:
+            view = memoryview(self._transform_records(view))
+            if pooled:
+                self.free_buffers.put(data)
+                pooled = False
+
+        segment.timestamps.extend(timestamps)
+        if segment.codec == CODEC_NONE:
+            records = self._index_records(segment, view, segment.offset)
+            segment.offset += len(view)
+            chunk = view
+        else:
+            records = self._index_records(segment, view,
+                                          segment.stream_offset)
+            compressed = self.compress(view)
+            if pooled:
+                self.free_buffers.put(data)
+                pooled = False
+
+            segment.block_offsets.append(segment.offset)
+            segment.block_starts.append(segment.stream_offset)
+            chunk = BLOCK_HEADER.pack(len(compressed), len(view), records,
+                                      crc32(compressed)) + compressed
+            segment.stream_offset += len(view)
+            segment.offset += len(chunk)
+
+        metrics.RAW_WRITTEN_RECORDS.inc(records)
+        segment.raw_bytes += raw_size
+        segment.stored_bytes += len(chunk)
+        segment.processing_time += perf_counter() - start_time
+        return chunk, data if pooled else None
+
+    @staticmethod
+    def _index_records(segment, view, base_offset):
+        offsets = segment.offsets
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        position = 0
+        records = 0
+        end = len(view)
+        while position < end:
+            size, _ = unpack_from(view, position)
+            offsets.append(base_offset + position)
+            position += header_size + size
+            records += 1
+        return records
+
+    def _transform_records(self, view):
+        transform = self.transform
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        output = bytearray()
+        position = 0
+        end = len(view)
+        while position < end:
+            size, checksum = unpack_from(view, position)
+            position += header_size
+            record = view[position:position + size]
+            position += size
+            try:
+                transformed = transform(record)
+            except Exception:
+                # invalid packets are archived as they are
+                output += RECORD_HEADER.pack(size, checksum)
+                output += record
+            else:
+                output += RECORD_HEADER.pack(len(transformed),
+                                             crc32(transformed))
+                output += transformed
+        return output
+
+    def _finish(self, segment):
+        self._write_index(segment)
+        if not (self.transform or self.compress) or not segment.raw_bytes:
+            return
+
+        ratio = segment.raw_bytes / max(segment.stored_bytes, 1)
+        throughput = (segment.raw_bytes / 2 ** 20 /
+                      max(segment.processing_time, 1e-9))
+        logger.info(f'{len(segment.offsets)} raw packets of '
+                    f'{segment.raw_bytes} bytes were stored in '
+                    f'{segment.stored_bytes} bytes ({ratio:.02f}x) '
+                    f'at {throughput:.02f} MiB/s')
+
+    @staticmethod
+    def _write_index(segment):
+        timestamps = segment.timestamps
+        sections = [segment.offsets, timestamps]
+        header = INDEX_HEADER.pack(
+            INDEX_MAGIC, INDEX_VERSION, len(segment.offsets),
+            timestamps[0] if timestamps else 0,
+            timestamps[-1] if timestamps else 0,
+        )
+        if segment.codec != CODEC_NONE:
+            blocks = INDEX_BLOCKS_HEADER.pack(len(segment.block_offsets))
+            sections += [blocks, segment.block_offsets, segment.block_starts]
+
+        index_path = segment.path + INDEX_SUFFIX
+        temporary_path = index_path + '.tmp'
+        try:
+            with open(temporary_path, 'wb') as index_file:
+                index_file.write(header)
+                for values in sections:
+                    if sys.byteorder != 'little' and isinstance(values,
+                                                                array):
+                        values.byteswap()
+                    index_file.write(values)
+            os.replace(temporary_path, index_path)
+        except OSError:
+            logger.exception('Raw data index writing has failed')
+
+    def _write(self, fd, chunks, buffers):
+        views = [memoryview(chunk) for chunk in chunks]
+        try:
+            while views:
+                start_time = perf_counter()
+                written = os.writev(fd, views[:IOV_MAX])
+                metrics.RAW_WRITE_SECONDS.observe(perf_counter() - start_time)
+                metrics.RAW_WRITTEN_BYTES.inc(written)
+                while views and written >= len(views[0]):
+                    written -= len(views.pop(0))
+                if written:
+                    views[0] = views[0][written:]
+        except OSError:
+            logger.exception('Raw data writing has failed')
+
+        for buffer in buffers:
+            self.free_buffers.put(buffer)
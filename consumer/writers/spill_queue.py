@@ -0,0 +1,190 @@
+import fcntl
+import logging
+import os
+import struct
+import threading
+from os import getenv
+from time import time_ns
+from zlib import crc32
+
+import metrics
+
+
+SPILL_PATH = getenv('SPILL_PATH', 'spill')
+SPILL_SEGMENT_SIZE = int(getenv('SPILL_SEGMENT_SIZE', 16 * 2 ** 20))
+SPILL_MAX_BYTES = int(getenv('SPILL_MAX_BYTES', 2 ** 30))
+SPILL_FSYNC = getenv('SPILL_FSYNC', '1') == '1'
+
+SPILL_SUFFIX = '.spill'
+OFFSET_SUFFIX = '.offset'
+# body length, points count, body crc32
+SPILL_HEADER = struct.Struct('<III')
+OFFSET = struct.Struct('<Q')
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class _SpillSegment:
+
+    def __init__(self, path, fd, size, offset=0):
+        self.path = path
+        self.fd = fd
+        self.size = size
+        self.offset = offset
+        self.offset_fd = None
+
+
+class SpillQueue:
+
+    # An append-only queue of serialized write requests split into segment
+    # files. Every segment is locked by its process, so segments left by
+    # stopped or crashed consumers are adopted and drained by others.
+    # Methods are blocking, they are called from executor threads.
+
+    def __init__(self, path=SPILL_PATH):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.segments = []
+        self.writing = None
+        self._adopt_segments()
+
+        metrics.SPILL_BYTES.set_function(self.get_size)
+
+    def _adopt_segments(self):
+        for filename in sorted(os.listdir(self.path)):
+            if not filename.endswith(SPILL_SUFFIX):
+                continue
+            path = os.path.join(self.path, filename)
+            fd = os.open(path, os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # still owned by a running consumer
+                os.close(fd)
+                continue
+
+            segment = _SpillSegment(path, fd, os.fstat(fd).st_size,
+                                    self._read_offset(path))
+            self.segments.append(segment)
+            logger.info('%s spilled bytes of %s have been adopted',
+                        segment.size - segment.offset, path)
+
+    @staticmethod
+    def _read_offset(path):
+        try:
+            with open(path + OFFSET_SUFFIX, 'rb') as offset_file:
+                offset, = OFFSET.unpack(offset_file.read(OFFSET.size))
+        except (FileNotFoundError, struct.error):
+            return 0
+        return offset
+
+    def _open_segment(self):
+        path = os.path.join(self.path,
+                            f'{time_ns():020d}-{os.getpid()}{SPILL_SUFFIX}')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | os.O_APPEND,
+                     0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        self.writing = _SpillSegment(path, fd, 0)
+        self.segments.append(self.writing)
+
+    def get_size(self):
+        return sum(segment.size - segment.offset for segment in self.segments)
+
+    def __bool__(self):
+        return any(segment.size > segment.offset for segment in self.segments)
+
+    def put(self, body, points):
+        record = SPILL_HEADER.pack(len(body), points, crc32(body)) + body
+        with self.lock:
+            if self.writing is None or self.writing.size >= SPILL_SEGMENT_SIZE:
+                self._open_segment()
+            segment = self.writing
+            os.write(segment.fd, record)
+            if SPILL_FSYNC:
+                os.fdatasync(segment.fd)
+            segment.size += len(record)
+            self._enforce_limit()
+
+    def _enforce_limit(self):
+        # the oldest data goes first, the segment being written stays
+        while (self.get_size() > SPILL_MAX_BYTES
+               and self.segments[0] is not self.writing):
+            segment = self.segments[0]
+            lost = segment.size - segment.offset
+            self._remove(segment)
+            metrics.SPILL_DROPPED_BYTES.inc(lost)
+            logger.error('%s spilled bytes have been dropped, the spill '
+                         'queue is limited to %s bytes', lost,
+                         SPILL_MAX_BYTES)
+
+    def peek(self):
+        # returns (segment, body, points) of the oldest record or None,
+        # the record stays in the queue until it is acknowledged
+        with self.lock:
+            while self.segments:
+                segment = self.segments[0]
+                if segment.offset + SPILL_HEADER.size <= segment.size:
+                    header = os.pread(segment.fd, SPILL_HEADER.size,
+                                      segment.offset)
+                    length, points, checksum = SPILL_HEADER.unpack(header)
+                    body = os.pread(segment.fd, length,
+                                    segment.offset + SPILL_HEADER.size)
+                    if len(body) == length and crc32(body) == checksum:
+                        return segment, body, points
+                    logger.error('Spill segment %s is corrupted at %s, '
+                                 'the rest of it is skipped', segment.path,
+                                 segment.offset)
+                    segment.offset = segment.size
+
+                if segment is self.writing:
+                    # nothing to drain until the next put
+                    if segment.offset:
+                        self._remove(segment)
+                    return None
+                self._remove(segment)
+            return None
+
+    def ack(self, segment, body):
+        with self.lock:
+            if segment.fd is None:
+                # the segment was dropped because of the limit
+                return
+            segment.offset += SPILL_HEADER.size + len(body)
+            os.pwrite(self._offset_fd(segment), OFFSET.pack(segment.offset),
+                      0)
+
+    @staticmethod
+    def _offset_fd(segment):
+        if segment.offset_fd is None:
+            segment.offset_fd = os.open(segment.path + OFFSET_SUFFIX,
+                                        os.O_WRONLY | os.O_CREAT, 0o644)
+        return segment.offset_fd
+
+    @staticmethod
+    def _close_segment(segment):
+        if segment.offset_fd is not None:
+            os.close(segment.offset_fd)
+        os.close(segment.fd)
+        segment.fd = segment.offset_fd = None
+
+    def _remove(self, segment):
+        self.segments.remove(segment)
+        if segment is self.writing:
+            self.writing = None
+        for path in (segment.path, segment.path + OFFSET_SUFFIX):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._close_segment(segment)
+
+    def close(self):
+        # undrained segments are kept for the next start
+        with self.lock:
+            for segment in self.segments:
+                self._close_segment(segment)
+            self.segments = []
+            self.writing = None